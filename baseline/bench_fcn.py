@@ -0,0 +1,63 @@
+"""
+Agreement and speedup of the fully convolutional inference mode.
+Restores the trained model of train_dir (see tf_aerial_images.py) and predicts
+training images both patchwise and with model_fcn. It reports the latency of
+each path, the share of patch labels on which they agree, and the error and
+road F1 of each against the groundtruth. The two cannot agree exactly: in
+the FCN the convolutions see the neighbouring patches where the patchwise
+model sees zero padding.
+
+Usage: python bench_fcn.py [first image] [num_images] [--train_dir=tmp/]
+"""
+
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+
+import tf_aerial_images
+from evaluation import ConfusionMatrix
+from patch_extraction import patch_label_values, values_to_classes
+
+FIRST_IMAGE = 81
+NUM_IMAGES = 20
+
+def main(argv):
+    first = int(argv[1]) if len(argv) > 1 else FIRST_IMAGE
+    num_images = int(argv[2]) if len(argv) > 2 else NUM_IMAGES
+    config = tf_aerial_images.Config()
+    patch_size = config.img_patch_size
+    filenames = tf_aerial_images.image_filenames(config.train_data_dir, first + num_images - 1)[first - 1:]
+    gt_filenames = tf_aerial_images.image_filenames(config.train_labels_dir, first + num_images - 1)[first - 1:]
+    imgs = tf_aerial_images.read_images(filenames, config.loader_processes)
+    truth = [values_to_classes(patch_label_values(gt, patch_size, patch_size))
+             for gt in tf_aerial_images.read_images(gt_filenames, config.loader_processes)]
+
+    predictor = tf_aerial_images.Predictor.from_checkpoint(config)
+    paths = [('patchwise', predictor.predict_patches), ('fcn', predictor.predict_patches_fcn)]
+    results = {}
+    for (name, predict) in paths:
+        # Warm up the session before timing
+        predict(imgs[0])
+        (confusion, latencies, predictions) = (ConfusionMatrix(), [], [])
+        for (img, labels) in zip(imgs, truth):
+            start = time.time()
+            prediction = predict(img)
+            latencies.append(time.time() - start)
+            confusion.update(prediction, labels)
+            predictions.append(np.argmax(prediction, 1))
+        results[name] = (confusion, np.array(latencies), np.concatenate(predictions))
+    predictor.close()
+
+    agreement = 100.0 * np.mean(results['fcn'][2] == results['patchwise'][2])
+    print('%d images (%d to %d), %d patches' % (len(imgs), first, first + len(imgs) - 1, len(results['fcn'][2])))
+    print('%10s %12s %12s %8s %7s' % ('path', 'ms/img p50', 'ms/img mean', 'error', 'F1'))
+    for (name, _) in paths:
+        (confusion, latencies, _) = results[name]
+        print('%10s %12.1f %12.1f %7.2f%% %7.4f' % (name, np.median(latencies) * 1000, latencies.mean() * 1000,
+                                                   confusion.error_rate(), confusion.f1()))
+    print('FCN speedup: %.1fx, label agreement with patchwise: %.2f%%'
+          % (results['patchwise'][1].mean() / results['fcn'][1].mean(), agreement))
+
+if __name__ == '__main__':
+    tf.app.run()
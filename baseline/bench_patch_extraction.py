@@ -0,0 +1,132 @@
+"""
+Benchmark of the vectorized patch extraction against the original img_crop loop.
+Checks that both produce the same patch and label tensors and reports the time
+and peak memory of each implementation, and how far that peak exceeds the
+returned patch tensor.
+
+Usage: python bench_patch_extraction.py [num_images] [patch_size] [stride] [num_of_transformations]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+import matplotlib.image as mpimg
+import numpy as np
+
+import patch_extraction
+
+TRAIN_DATA_DIR = 'data/training/images/'
+TRAIN_LABELS_DIR = 'data/training/groundtruth/'
+
+######## Original implementation, kept verbatim as the reference ########
+
+def legacy_subtract_mean(img):
+    gray_img = 0.2989*img[:,:,0] + 0.5870*img[:,:,1] + 0.1140*img[:,:,2]
+    img -= np.matrix(gray_img).mean()
+
+def legacy_augment_image(img, out_ls, num_of_transformations):
+    out_ls.append(img)
+    if num_of_transformations > 0:
+        out_ls.append(np.fliplr(img))
+    if num_of_transformations > 1:
+        out_ls.append(np.flipud(img))
+    if num_of_transformations > 2:
+        out_ls.append(np.rot90(img))
+    if num_of_transformations > 3:
+        out_ls.append(np.rot90(np.rot90(img)))
+
+# copy_patches=True crops every patch from an untouched copy. The original
+# code subtracts the mean through a view, so with stride < patch_size the
+# overlapping patches see pixels already shifted by their neighbours.
+def legacy_img_crop(im, patch_size, stride, num_of_transformations, copy_patches=False):
+    list_patches = []
+    imgwidth = im.shape[0]
+    imgheight = im.shape[1]
+    is_2d = len(im.shape) < 3
+
+    for i in range(0,imgheight - patch_size + 1, stride):
+        for j in range(0,imgwidth - patch_size + 1, stride):
+            if is_2d:
+                im_patch = [im[j:j+patch_size, i:i+patch_size]]
+            else:
+                im_patch = im[j:j+patch_size, i:i+patch_size, :]
+                if copy_patches:
+                    im_patch = im_patch.copy()
+                legacy_subtract_mean(im_patch)
+            legacy_augment_image(im_patch, list_patches, num_of_transformations)
+    return list_patches
+
+def legacy_extract_data(imgs, patch_size, stride, num_of_transformations, copy_patches=False):
+    img_patches = [legacy_img_crop(img.copy(), patch_size, stride, num_of_transformations, copy_patches) for img in imgs]
+    data = [img_patches[i][j] for i in range(len(img_patches)) for j in range(len(img_patches[i]))]
+    return np.asarray(data)
+
+def legacy_extract_labels(gt_imgs, patch_size, stride, num_of_transformations):
+    # The label only depends on the patch mean, so the original 2D augmentation
+    # (which flips the wrapping list rather than the patch) is not replayed.
+    gt_patches = [legacy_img_crop(gt, patch_size, stride, 0) for gt in gt_imgs]
+    values = [np.mean(p) for patches in gt_patches for p in patches]
+    labels = np.asarray([[0, 1] if v > patch_extraction.FOREGROUND_THRESHOLD else [1, 0] for v in values])
+    return np.repeat(labels, 1 + num_of_transformations, axis=0).astype(np.float32)
+
+######## Benchmark ########
+
+def load_images(dirname, num_images):
+    imgs = []
+    for i in range(1, num_images+1):
+        image_filename = dirname + "satImage_%.3d" % i + ".png"
+        if os.path.isfile(image_filename):
+            imgs.append(mpimg.imread(image_filename))
+    return imgs
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.time()
+    result = fn(*args)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (result, elapsed, peak)
+
+def main(argv):
+    num_images = int(argv[1]) if len(argv) > 1 else 10
+    patch_size = int(argv[2]) if len(argv) > 2 else 16
+    stride = int(argv[3]) if len(argv) > 3 else 8
+    num_of_transformations = int(argv[4]) if len(argv) > 4 else 4
+
+    imgs = load_images(TRAIN_DATA_DIR, num_images)
+    gt_imgs = load_images(TRAIN_LABELS_DIR, num_images)
+    print('%d images, patch size %d, stride %d, %d transformations' % (len(imgs), patch_size, stride, num_of_transformations))
+
+    params = (patch_size, stride, num_of_transformations)
+    (legacy, t_legacy, m_legacy) = measure(legacy_extract_data, imgs, *params)
+    (fast, t_fast, m_fast) = measure(patch_extraction.extract_patches_from_images, imgs, *params)
+    # Both return the same tensor, so the peak above its size is the working memory of each
+    size = fast.nbytes / 2.0**20
+    print('patch tensor:      %8.1f MB' % size)
+    print('legacy img_crop:   %8.3f s  peak %8.1f MB (%.1f MB above the tensor)' % (t_legacy, m_legacy / 2.0**20, m_legacy / 2.0**20 - size))
+    print('extract_patches:   %8.3f s  peak %8.1f MB (%.1f MB above the tensor)' % (t_fast, m_fast / 2.0**20, m_fast / 2.0**20 - size))
+    print('speedup:           %8.1fx' % (t_legacy / t_fast))
+
+    ok = True
+    if stride >= patch_size:
+        same = legacy.shape == fast.shape and np.array_equal(legacy, fast)
+        print('patches identical to img_crop: %s' % same)
+        ok = ok and same
+    else:
+        reference = legacy_extract_data(imgs, *params, copy_patches=True)
+        same = reference.shape == fast.shape and np.array_equal(reference, fast)
+        print('patches identical to img_crop on independent patches: %s' % same)
+        print('max deviation from in-place img_crop (overlap aliasing): %.6f' % np.abs(legacy - fast).max())
+        ok = ok and same
+
+    (legacy_labels, t_legacy, _) = measure(legacy_extract_labels, gt_imgs, *params)
+    (fast_labels, t_fast, _) = measure(patch_extraction.extract_labels_from_images, gt_imgs, *params)
+    same = np.array_equal(legacy_labels, fast_labels)
+    print('labels: legacy %.3f s, vectorized %.3f s, identical: %s' % (t_legacy, t_fast, same))
+    ok = ok and same
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,138 @@
+"""
+Benchmark of the postprocessing filters: time per mask when run as one batch
+and effect on the patch error against the training groundtruth.
+Also checks that the 'isolated' filter matches set_to_zero_if_no_neighbours.
+
+By default the predictions are those of the trained model of train_dir (see
+tf_aerial_images.py) on the training images 81 to 100, which the reference
+run holds out (validation_images = 20). They can also come from a
+submission-format CSV over the training images (image ids are the satImage
+numbers). --flip-rate instead uses the groundtruth labels with a fraction of
+randomly flipped patches; its error column then only shows how much noise
+each filter removes, not the error on real predictions.
+
+TensorFlow is only imported by the script itself, so that the tests can
+import the reference loop without it.
+
+Usage: python bench_postprocessing.py [predictions.csv | --flip-rate 0.1] [--first 81] [--num-images 20]
+                                      [--train_dir=tmp/]
+"""
+
+import argparse
+import time
+import matplotlib.image as mpimg
+import numpy as np
+
+from mask_to_submission import patch_labels
+from prediction_masks import label_to_img
+from postprocessing import FILTERS, remove_isolated, postprocess_masks
+from submission_to_mask import Submission
+
+FIRST_IMAGE = 81
+NUM_IMAGES = 20
+
+CONFIGURATIONS = [
+    [],
+    [('isolated', {})],
+    [('median', {'size': 3})],
+    [('opening', {'size': 2})],
+    [('closing', {'size': 2})],
+    [('closing', {'size': 3})],
+    [('components', {'min_size': 4})],
+    [('isolated', {}), ('components', {'min_size': 4})],
+    [('closing', {'size': 2}), ('components', {'min_size': 8})],
+]
+
+# The original loop, kept verbatim as the reference
+def legacy_set_to_zero_if_no_neighbours(mask):
+    (height, width) = mask.shape
+    for i in range(1, height - 1):
+        for j in range(1, width - 1):
+            if mask[i][j] == 1 \
+            and mask[i + 1][j] == 0 \
+            and mask[i - 1][j] == 0 \
+            and mask[i][j + 1] == 0 \
+            and mask[i][j - 1] == 0:
+                mask[i][j] = 0
+            if mask[i][j] == 0 \
+            and mask[i + 1][j] == 1 \
+            and mask[i - 1][j] == 1 \
+            and mask[i][j + 1] == 1 \
+            and mask[i][j - 1] == 1:
+                mask[i][j] = 1
+    return mask
+
+def load_truth(config, numbers):
+    masks = []
+    for i in numbers:
+        gt = mpimg.imread(config.train_labels_dir + "satImage_%.3d" % i + ".png")
+        masks.append(patch_labels(gt, config.img_patch_size))
+    return np.asarray(masks)
+
+def model_predictions(config, numbers):
+    """Patch masks [image, patch row, patch column] predicted by the trained
+    model of train_dir for the given training images."""
+    import tf_aerial_images
+    filenames = [config.train_data_dir + "satImage_%.3d" % i + ".png" for i in numbers]
+    imgs = tf_aerial_images.read_images(filenames, config.loader_processes)
+    predictor = tf_aerial_images.Predictor.from_checkpoint(config)
+    predictions = predictor.predict_images(imgs)
+    predictor.close()
+    patch_size = config.img_patch_size
+    return np.asarray([label_to_img(-(-img.shape[0] // patch_size), -(-img.shape[1] // patch_size), 1, 1, prediction)
+                       for (img, prediction) in zip(imgs, predictions)])
+
+def describe(pipeline):
+    if not pipeline:
+        return 'none'
+    return ' + '.join(name + ''.join('(%s=%s)' % kv for kv in sorted(params.items())) for (name, params) in pipeline)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Speed and error of the postprocessing filters.')
+    parser.add_argument('predictions', nargs='?', help='submission-format CSV over the training images')
+    parser.add_argument('--flip-rate', type=float, help='flip this fraction of the groundtruth labels instead')
+    parser.add_argument('--first', type=int, default=FIRST_IMAGE)
+    parser.add_argument('--num-images', type=int, default=NUM_IMAGES)
+    args = parser.parse_args(argv[1:])
+
+    import tf_aerial_images
+    config = tf_aerial_images.Config()
+    numbers = range(args.first, args.first + args.num_images)
+    truth = load_truth(config, numbers)
+    error_column = 'error'
+    if args.predictions:
+        submission = Submission(args.predictions, patch_size=config.img_patch_size)
+        predictions = np.asarray([submission.image_labels(i) for i in numbers])
+        source = args.predictions
+    elif args.flip_rate is not None:
+        rng = np.random.RandomState(0)
+        predictions = np.where(rng.rand(*truth.shape) < args.flip_rate, 1 - truth, truth)
+        source = 'groundtruth with %.0f%% flipped patches' % (100 * args.flip_rate)
+        error_column = 'noise left'
+    else:
+        predictions = model_predictions(config, numbers)
+        source = 'model of %s on images %d to %d' % (config.train_dir, numbers[0], numbers[-1])
+    predictions = predictions.astype(np.float64)
+    print('%d masks of %dx%d patches, predictions: %s' % ((len(truth),) + truth.shape[1:] + (source,)))
+
+    start = time.time()
+    reference = np.asarray([legacy_set_to_zero_if_no_neighbours(m.copy()) for m in predictions])
+    t_legacy = (time.time() - start) / len(predictions)
+    start = time.time()
+    same = np.array_equal(reference, remove_isolated(predictions))
+    t_fast = (time.time() - start) / len(predictions)
+    print('isolated filter identical to set_to_zero_if_no_neighbours: %s (%.1f us vs %.1f us per mask)' % (same, t_fast * 1e6, t_legacy * 1e6))
+
+    print('%-45s %12s %10s' % ('pipeline', 'us / mask', error_column))
+    for pipeline in CONFIGURATIONS:
+        start = time.time()
+        masks = postprocess_masks(predictions, pipeline)
+        elapsed = (time.time() - start) / len(predictions)
+        error = 100.0 * np.mean(masks != truth)
+        print('%-45s %12.1f %9.2f%%' % (describe(pipeline), elapsed * 1e6, error))
+    return 0 if same else 1
+
+if __name__ == '__main__':
+    import tensorflow as tf
+    import tf_aerial_images # Defines --train_dir before tf.app.run parses the flags
+    tf.app.run()
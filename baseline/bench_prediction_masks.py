@@ -0,0 +1,104 @@
+"""
+Checks the vectorized prediction_to_mask, mask_to_prediction and label_to_img
+against the original loops on random inputs (including non-square grids,
+borderline probabilities and images that are not a multiple of the patch
+size), then times both implementations on a 608x608 test image.
+
+Usage: python bench_prediction_masks.py [num_trials]
+"""
+
+import sys
+import time
+import numpy as np
+
+import prediction_masks
+
+######## Original implementations, kept verbatim as the reference ########
+
+def legacy_prediction_to_mask(labels, width, height):
+    mask = np.zeros([height, width])
+    idx = 0
+    for i in range(0,height):
+        for j in range(0,width):
+            mask[i][j] = 0 if labels[idx][0] > 0.5 else 1
+            idx = idx + 1
+    return mask
+
+def legacy_mask_to_prediction(mask):
+    (height, width) = mask.shape;
+    prediction = np.zeros([height * width, 2])
+    idx = 0
+    for i in range(0,height):
+        for j in range(0,width):
+            if mask[i][j] == 1:
+                prediction[idx][1] = 1
+            else:
+                prediction[idx][0] = 1
+            idx = idx + 1
+    return prediction
+
+def legacy_label_to_img(imgwidth, imgheight, w, h, labels):
+    array_labels = np.zeros([imgwidth, imgheight])
+    idx = 0
+    for i in range(0,imgheight,h):
+        for j in range(0,imgwidth,w):
+            if labels[idx][0] > 0.5:
+                l = 0
+            else:
+                l = 1
+            array_labels[j:j+w, i:i+h] = l
+            idx = idx + 1
+    return array_labels
+
+######## Checks ########
+
+def random_predictions(rng, n):
+    p = rng.rand(n).astype(np.float32)
+    # Exercise the threshold itself
+    p[rng.rand(n) < 0.1] = 0.5
+    return np.column_stack((p, 1 - p))
+
+def check(rng, num_trials):
+    for trial in range(num_trials):
+        width = rng.randint(1, 50)
+        height = rng.randint(1, 50)
+        labels = random_predictions(rng, width * height + rng.randint(0, 3))
+        assert np.array_equal(legacy_prediction_to_mask(labels, width, height),
+                              prediction_masks.prediction_to_mask(labels, width, height))
+
+        mask = rng.randint(0, 3, (height, width)).astype(np.float64)
+        assert np.array_equal(legacy_mask_to_prediction(mask), prediction_masks.mask_to_prediction(mask))
+
+        w = rng.randint(1, 20)
+        h = rng.randint(1, 20)
+        imgwidth = rng.randint(1, 200)
+        imgheight = rng.randint(1, 200)
+        labels = random_predictions(rng, (-(-imgwidth // w)) * (-(-imgheight // h)))
+        assert np.array_equal(legacy_label_to_img(imgwidth, imgheight, w, h, labels),
+                              prediction_masks.label_to_img(imgwidth, imgheight, w, h, labels))
+
+def timed(fn, *args):
+    start = time.time()
+    for i in range(10):
+        fn(*args)
+    return (time.time() - start) / 10
+
+def main(argv):
+    num_trials = int(argv[1]) if len(argv) > 1 else 200
+    rng = np.random.RandomState(0)
+    check(rng, num_trials)
+    print('%d random trials: vectorized functions identical to the original loops' % num_trials)
+
+    labels = random_predictions(rng, 38 * 38)
+    mask = prediction_masks.prediction_to_mask(labels, 38, 38)
+    cases = [('prediction_to_mask', legacy_prediction_to_mask, prediction_masks.prediction_to_mask, (labels, 38, 38)),
+             ('mask_to_prediction', legacy_mask_to_prediction, prediction_masks.mask_to_prediction, (mask,)),
+             ('label_to_img', legacy_label_to_img, prediction_masks.label_to_img, (608, 608, 16, 16, labels))]
+    for (name, legacy, fast, args) in cases:
+        t_legacy = timed(legacy, *args)
+        t_fast = timed(fast, *args)
+        print('%-20s legacy %9.1f us  vectorized %7.1f us  (%.0fx)' % (name, t_legacy * 1e6, t_fast * 1e6, t_legacy / t_fast))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
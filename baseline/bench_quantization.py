@@ -0,0 +1,111 @@
+"""
+Accuracy against speed of the reduced precision inference modes.
+Reduces a float32 model exported by export_model.py to every precision of
+numpy_inference.PRECISIONS (int8 calibrated on patches of the images trained
+on, as export_model.py does) and evaluates each on the held-out validation
+images saved with the model, which were never trained on. The images are
+scored on the validation grid, as Trainer.validate does. Reports the weight
+size, the throughput, the error and road F1 against the groundtruth, and the
+share of patch labels that agree with the float32 model. --tf adds the
+float32 TensorFlow forward pass of the same weights for comparison.
+The NumPy backend computes every precision in float32 (see
+numpy_inference.py), so the reduced precisions only save size; their
+slowdown against float32 is reported after the table.
+Models trained without held-out images (validation_images = 0) are refused.
+
+Usage: python bench_quantization.py model.npz [--calibration-patches 2000] [--repeats 3] [--tf]
+                                   [--output quantization_report.json]
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import tf_aerial_images
+from evaluation import ConfusionMatrix, image_patches, update_on_grid
+from export_model import CALIBRATION_PATCHES, calibration_data
+from numpy_inference import BATCH_SIZE, PRECISIONS, NumpyModel, load_weights, quantize, weights_bytes
+
+REPEATS = 3 # Timed passes over the validation images, the fastest is reported
+
+def best_time(predict, data, repeats):
+    """(predictions, seconds of the fastest of repeats passes) of predict(data)."""
+    predict(data[:BATCH_SIZE])
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        predictions = predict(data)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (predictions, best)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Accuracy against speed of the inference precisions.')
+    parser.add_argument('model', help='float32 .npz written by export_model.py')
+    parser.add_argument('--calibration-patches', type=int, default=CALIBRATION_PATCHES)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--tf', action='store_true', help='also time the TensorFlow float32 forward pass')
+    parser.add_argument('--output', help='also write the report to this JSON file')
+    args = parser.parse_args(argv[1:])
+
+    (weights, meta) = load_weights(args.model)
+    if meta.get('precision', 'float32') != 'float32':
+        raise ValueError('%s is a %s model, export a float32 one' % (args.model, meta['precision']))
+    if not meta.get('validation_images'):
+        raise ValueError('%s has no held-out validation images, train with validation_images > 0 and export again'
+                         % args.model)
+    # The settings of the training run, so that calibration stays on the images trained on
+    config = tf_aerial_images.Config(img_patch_size=meta['patch_size'], training_size=meta['training_size'],
+                                     validation_images=len(meta['validation_images']),
+                                     validation_grid=meta['validation_grid'])
+    (imgs, truth) = tf_aerial_images.load_validation_images(config)
+    patches = [image_patches(img, config.img_patch_size) for img in imgs]
+    data = np.concatenate(patches)
+    splits = np.cumsum([len(p) for p in patches])[:-1] # Where the patches of each image start in data
+    calibration = np.asarray(calibration_data(config, args.calibration_patches), dtype=np.float32)
+    print('Validation images %d to %d: %d patches; %d calibration patches'
+          % (meta['validation_images'][0], meta['validation_images'][-1], len(data), len(calibration)))
+
+    runs = []
+    for precision in PRECISIONS:
+        (reduced, reduced_meta) = quantize(weights, meta, precision, calibration)
+        model = NumpyModel(reduced, reduced_meta)
+        runs.append((precision, 'numpy', weights_bytes(reduced), model.predict))
+    if args.tf:
+        from predict import tf_predict_function
+        runs.append(('float32', 'tf', weights_bytes(weights), tf_predict_function(weights, meta, BATCH_SIZE)))
+
+    report = []
+    reference = None
+    print('%9s %7s %10s %12s %8s %7s %9s %8s' % ('precision', 'backend', 'weights KB', 'patches/sec', 'error',
+                                                 'F1', 'agreement', 'speedup'))
+    for (precision, backend, size, predict) in runs:
+        (predictions, elapsed) = best_time(predict, data, args.repeats)
+        confusion = ConfusionMatrix()
+        for (img, labels, image_predictions) in zip(imgs, truth, np.split(predictions, splits)):
+            update_on_grid(confusion, image_predictions, img.shape, labels, config.img_patch_size, config.validation_grid)
+        if reference is None:
+            reference = (np.argmax(predictions, 1), elapsed)
+        result = {'precision': precision, 'backend': backend, 'weights_bytes': size,
+                  'patches_per_sec': len(data) / elapsed, 'error': confusion.error_rate(), 'f1': confusion.f1(),
+                  'agreement': 100.0 * np.mean(np.argmax(predictions, 1) == reference[0]),
+                  'speedup': reference[1] / elapsed}
+        report.append(result)
+        print('%9s %7s %10.0f %12.0f %7.2f%% %7.4f %8.2f%% %7.2fx'
+              % (precision, backend, size / 1024.0, result['patches_per_sec'], result['error'], result['f1'],
+                 result['agreement'], result['speedup']))
+    for result in report:
+        if result['precision'] != 'float32' and result['speedup'] < 1:
+            print('%s is %.2fx slower than float32: it only saves size' % (result['precision'], 1 / result['speedup']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'model': args.model, 'validation_images': meta['validation_images'],
+                       'validation_grid': config.validation_grid, 'validation_patches': len(data),
+                       'calibration_patches': len(calibration), 'runs': report}, f, indent=2, sort_keys=True)
+        print('Report written to %s' % args.output)
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,115 @@
+"""
+Benchmark of the vectorized submission encoder.
+Rebuilds the masks behind submission74.csv, encodes them again with the
+original per-patch implementations and with write_submission, and checks that
+the result is byte-for-byte identical to submission74.csv.
+
+Usage: python bench_submission.py [submission.csv]
+"""
+
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+from mask_to_submission import write_submission
+
+PATCH_SIZE = 16
+IMG_SIZE = 608
+
+######## Original implementations, kept verbatim as the reference ########
+
+def legacy_patch_to_label(patch):
+    df = np.mean(patch)
+    if df > 0.25:
+        return 1
+    else:
+        return 0
+
+# mask_to_submission.mask_to_submission_strings, on an already decoded mask
+def legacy_mask_to_submission_strings(img_number, im):
+    patch_size = 16
+    for j in range(0, im.shape[1], patch_size):
+        for i in range(0, im.shape[0], patch_size):
+            patch = im[i:i + patch_size, j:j + patch_size]
+            label = legacy_patch_to_label(patch)
+            yield("{:03d}_{}_{},{}".format(img_number, j, i, label))
+
+def legacy_masks_to_submission(submission_filename, masks, img_numbers):
+    with open(submission_filename, 'w') as f:
+        f.write('id,prediction\n')
+        for (n, im) in zip(img_numbers, masks):
+            f.writelines('{}\n'.format(s) for s in legacy_mask_to_submission_strings(n, im))
+
+# The row loop at the end of tf_aerial_images.main()
+def legacy_main_rows(i, prediction):
+    prediction = prediction.astype(int)
+    num_rows = prediction.shape[0]
+    num_cols = prediction.shape[1]
+    rows_out = np.empty((0,2))
+    for x in range(0, num_rows, PATCH_SIZE):
+        for y in range(0, num_cols, PATCH_SIZE):
+            id = str(i).zfill(3) + "_" + str(x) + "_" + str(y)
+            next_row = np.array([[id, str(prediction[y,x])]])
+            rows_out = np.concatenate((rows_out, next_row))
+    return rows_out
+
+######## Benchmark ########
+
+# Minimal parser, so that the benchmark does not depend on the code it checks
+def read_masks(submission_filename):
+    masks = {}
+    with open(submission_filename) as f:
+        next(f)
+        for line in f:
+            (id, label) = line.strip().split(',')
+            (n, x, y) = [int(t) for t in id.split('_')]
+            if n not in masks:
+                masks[n] = np.zeros((IMG_SIZE, IMG_SIZE), dtype=np.float32)
+            masks[n][y:y + PATCH_SIZE, x:x + PATCH_SIZE] = int(label)
+    img_numbers = sorted(masks)
+    return ([masks[n] for n in img_numbers], img_numbers)
+
+def read_bytes(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def main(argv):
+    submission_filename = argv[1] if len(argv) > 1 else 'submission74.csv'
+    (masks, img_numbers) = read_masks(submission_filename)
+    expected = read_bytes(submission_filename)
+    tmp_dir = tempfile.mkdtemp()
+    legacy_filename = os.path.join(tmp_dir, 'legacy.csv')
+    fast_filename = os.path.join(tmp_dir, 'fast.csv')
+
+    start = time.time()
+    legacy_masks_to_submission(legacy_filename, masks, img_numbers)
+    t_legacy = time.time() - start
+    start = time.time()
+    write_submission(fast_filename, masks, img_numbers, PATCH_SIZE)
+    t_fast = time.time() - start
+
+    # The main() loop is quadratic, so only a few images are timed
+    num_main = min(3, len(masks))
+    start = time.time()
+    main_rows = [legacy_main_rows(n, m) for (n, m) in zip(img_numbers[:num_main], masks[:num_main])]
+    t_main = (time.time() - start) * len(masks) / num_main
+
+    print('%d masks, %d rows' % (len(masks), expected.count(b'\n') - 1))
+    print('mask_to_submission loop:  %8.3f s' % t_legacy)
+    print('main() row loop (est.):   %8.3f s' % t_main)
+    print('write_submission:         %8.3f s' % t_fast)
+    print('speedup vs generator:     %8.1fx' % (t_legacy / t_fast))
+
+    fast = read_bytes(fast_filename)
+    same_file = fast == expected
+    same_legacy = read_bytes(legacy_filename) == expected
+    fast_lines = fast.decode().split('\n')[1:]
+    main_lines = [','.join(row) for rows in main_rows for row in rows]
+    same_main = main_lines == fast_lines[:len(main_lines)]
+    print('identical to %s: %s (legacy generator: %s, main() rows: %s)' % (submission_filename, same_file, same_legacy, same_main))
+    return 0 if same_file and same_main else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
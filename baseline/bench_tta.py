@@ -0,0 +1,76 @@
+"""
+Accuracy gain against latency of test-time augmentation.
+Restores the trained model of train_dir (see tf_aerial_images.py), predicts the
+held-out training images with every (window stride, augmentations) setting of
+CONFIGURATIONS and scores them against the groundtruth on the validation grid,
+as Trainer.validate does. The first configuration is the plain patchwise
+prediction, which the others are compared to.
+
+validation_images is the number of last training images the training run of
+the checkpoint held out (see tf_aerial_images.py); the model must not have
+been trained on them, so models trained on every image are refused.
+
+Usage: python bench_tta.py [validation_images] [--train_dir=tmp/]
+"""
+
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+
+import tf_aerial_images
+from evaluation import ConfusionMatrix, update_on_grid
+from patch_extraction import pad_to_patches
+from test_time_augmentation import num_evaluations
+
+# (window stride, number of augmentations); a stride of 0 means the patch size
+CONFIGURATIONS = [
+    (0, 0),
+    (0, 1),
+    (0, 4),
+    (8, 0),
+    (8, 1),
+    (8, 4),
+    (4, 0),
+    (4, 4),
+]
+
+def main(argv):
+    config = tf_aerial_images.Config()
+    if len(argv) > 1:
+        config.update(validation_images=int(argv[1]))
+    if config.validation_images == 0:
+        raise ValueError('No held-out images (validation_images = 0): give the number of images the training run '
+                         'of %s held out, and train with validation_images > 0 if there were none' % config.train_dir)
+    patch_size = config.img_patch_size
+    (imgs, truth) = tf_aerial_images.load_validation_images(config)
+    # Padded to whole patches, so that the predictions are those update_on_grid expects
+    padded = [pad_to_patches(img, patch_size) for img in imgs]
+    first = tf_aerial_images.num_training_images(config) + 1
+    print('Held-out images %d to %d, scored on a %d pixel grid' % (first, config.training_size, config.validation_grid))
+
+    predictor = tf_aerial_images.Predictor.from_checkpoint(config)
+    print('%6s %5s %12s %12s %8s %7s %10s %8s' % ('stride', 'augs', 'patches/img', 'ms/img', 'error', 'F1',
+                                                 'error gain', 'slowdown'))
+    reference = None
+    for (stride, augmentations) in CONFIGURATIONS:
+        predictor.config = config.replace(tta_stride=stride, tta_augmentations=augmentations)
+        confusion = ConfusionMatrix()
+        # Warm up the session before timing
+        predictor.predict_patches_tta(padded[0])
+        start = time.time()
+        for (img, padded_img, labels) in zip(imgs, padded, truth):
+            update_on_grid(confusion, predictor.predict_patches_tta(padded_img), img.shape, labels, patch_size,
+                           config.validation_grid)
+        latency = (time.time() - start) / len(imgs)
+        if reference is None:
+            reference = (confusion.error_rate(), latency)
+        print('%6d %5d %12d %12.1f %7.2f%% %7.4f %9.2f%% %7.1fx'
+              % (stride or patch_size, augmentations,
+                 num_evaluations(padded[0].shape, patch_size, stride or patch_size, augmentations),
+                 latency * 1000, confusion.error_rate(), confusion.f1(),
+                 reference[0] - confusion.error_rate(), latency / reference[1]))
+    predictor.close()
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,335 @@
+"""
+Reproducible benchmark suite for the whole pipeline, run offline on the bundled
+data/training and data/test_set images:
+    extraction      extract_patches_parallel / extract_labels_parallel
+    loading         scaling of extract_patches_parallel with the number of
+                    workers, forked processes or threads (see parallel_loading.py)
+    training        training steps/sec of the patch model
+    inference       per-image latency, patchwise or fully convolutional (with
+                    the share of FCN labels that differ from the patchwise ones)
+    postprocessing  postprocess_masks per mask
+    submission      write_submission encoding and Submission parsing
+Every benchmark runs over a matrix of parameters (MATRIX, or QUICK_MATRIX with
+--quick), with fixed seeds and inputs, and keeps the median of REPEATS runs.
+Results are saved as JSON; with --baseline they are compared against a stored
+result file and metrics worse by more than --tolerance are flagged, the exit
+status being 1 if there is any regression.
+
+Metrics ending in _per_sec are better when higher, the others (_s, _ms, _pct)
+when lower.
+
+benchmark_baseline.json holds the full matrix recorded on a single-core Linux
+host (see its environment); timings only compare on similar hardware, so
+record a baseline of your own machine with --save-baseline before comparing.
+Two full runs on that host differed by up to 50% on the p99 latencies and
+on the sub-millisecond metrics, so a regression there wants a second run.
+
+Usage: python benchmark_suite.py [--quick] [--only training,inference]
+                                 [--output benchmark_results.json]
+                                 [--baseline benchmark_baseline.json] [--save-baseline]
+                                 [--tolerance 0.15]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import parallel_loading
+from mask_to_submission import patch_labels, write_submission
+from parallel_loading import decode_images, extract_patches_parallel, extract_labels_parallel
+from postprocessing import postprocess_masks
+from submission_to_mask import Submission
+
+TRAIN_DATA_DIR = 'data/training/images/'
+TRAIN_LABELS_DIR = 'data/training/groundtruth/'
+TEST_DATA_DIR = 'data/test_set/'
+NUM_TRAIN_IMAGES = 20 # Training images used by the extraction and training benchmarks
+NUM_TEST_IMAGES = 10 # Test images used by the inference benchmark
+NUM_TRANSFORMATIONS = 4
+NUM_PROCESSES = multiprocessing.cpu_count()
+REPEATS = 3
+WARMUP_STEPS = 5
+TRAINING_STEPS = 30
+SEED = 201
+
+MATRIX = {
+    'extraction': {'patch_size': [8, 16, 32], 'stride': [8, 16]},
+    'loading': {'workers': [1, 2, 4, 8], 'pool': ['processes', 'threads']},
+    'training': {'patch_size': [16, 32], 'batch_size': [32, 64, 128],
+                 'conv_depths': [[32, 64, 64], [128, 64, 64]]},
+    'inference': {'patch_size': [16], 'conv_depths': [[32, 64, 64], [128, 64, 64]],
+                  'batch_size': [256, 1024], 'fcn': [False, True]},
+    'postprocessing': {'pipeline': ['isolated', 'median', 'closing+components']},
+    'submission': {'patch_size': [8, 16]},
+}
+
+QUICK_MATRIX = {
+    'extraction': {'patch_size': [16], 'stride': [8]},
+    'loading': {'workers': [1, 4], 'pool': ['processes']},
+    'training': {'patch_size': [16], 'batch_size': [64], 'conv_depths': [[128, 64, 64]]},
+    'inference': {'patch_size': [16], 'conv_depths': [[128, 64, 64]], 'batch_size': [1024], 'fcn': [False, True]},
+    'postprocessing': {'pipeline': ['isolated']},
+    'submission': {'patch_size': [16]},
+}
+
+PIPELINES = {
+    'isolated': [('isolated', {})],
+    'median': [('median', {'size': 3})],
+    'closing+components': [('closing', {'size': 2}), ('components', {'min_size': 8})],
+}
+
+def training_filenames(directory, num_images):
+    return [directory + 'satImage_%.3d.png' % i for i in range(1, num_images + 1)]
+
+def test_filenames(num_images):
+    return [TEST_DATA_DIR + 'test_%d.png' % i for i in range(1, num_images + 1)]
+
+def parameter_grid(axes):
+    """All combinations of the parameter values, in a fixed order."""
+    grid = [{}]
+    for name in sorted(axes):
+        grid = [dict(params, **{name: value}) for params in grid for value in axes[name]]
+    return grid
+
+def median_of(runs):
+    """Per-metric median of the metric dicts of several runs."""
+    return dict((name, float(np.median([run[name] for run in runs]))) for name in runs[0])
+
+######## Benchmarks: each one returns the metrics of one run ########
+
+def bench_extraction(params, cache):
+    files = training_filenames(TRAIN_DATA_DIR, NUM_TRAIN_IMAGES)
+    gt_files = training_filenames(TRAIN_LABELS_DIR, NUM_TRAIN_IMAGES)
+    start = time.time()
+    data = extract_patches_parallel(files, params['patch_size'], params['stride'], NUM_TRANSFORMATIONS, NUM_PROCESSES)
+    t_data = time.time() - start
+    start = time.time()
+    extract_labels_parallel(gt_files, params['patch_size'], params['stride'], NUM_TRANSFORMATIONS, NUM_PROCESSES)
+    t_labels = time.time() - start
+    return {'extract_data_s': t_data, 'extract_labels_s': t_labels, 'patches_per_sec': len(data) / t_data}
+
+def bench_loading(params, cache):
+    files = training_filenames(TRAIN_DATA_DIR, NUM_TRAIN_IMAGES)
+    # Threads are what the loaders fall back to once a TensorFlow session is open
+    forked = not parallel_loading.fork_unsafe
+    parallel_loading.fork_unsafe = params['pool'] == 'threads' or not forked
+    try:
+        start = time.time()
+        data = extract_patches_parallel(files, 16, 8, NUM_TRANSFORMATIONS, params['workers'])
+        elapsed = time.time() - start
+    finally:
+        parallel_loading.fork_unsafe = not forked
+    return {'extract_data_s': elapsed, 'patches_per_sec': len(data) / elapsed}
+
+def training_patches(patch_size, cache):
+    key = ('patches', patch_size)
+    if key not in cache:
+        files = training_filenames(TRAIN_DATA_DIR, NUM_TRAIN_IMAGES)
+        gt_files = training_filenames(TRAIN_LABELS_DIR, NUM_TRAIN_IMAGES)
+        cache[key] = (extract_patches_parallel(files, patch_size, patch_size, 0, NUM_PROCESSES),
+                      extract_labels_parallel(gt_files, patch_size, patch_size, 0, NUM_PROCESSES))
+    return cache[key]
+
+def bench_training(params, cache):
+    import tensorflow as tf
+    from model import PatchModel
+    (patch_size, batch_size) = (params['patch_size'], params['batch_size'])
+    (data, labels) = training_patches(patch_size, cache)
+    random = np.random.RandomState(SEED)
+    with tf.Graph().as_default():
+        data_node = tf.placeholder(tf.float32, shape=(batch_size, patch_size, patch_size, data.shape[3]))
+        labels_node = tf.placeholder(tf.float32, shape=(batch_size, labels.shape[1]))
+        net = PatchModel(patch_size, data.shape[3], labels.shape[1], conv_depths=params['conv_depths'])
+        loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(net.model(data_node, True), labels_node))
+        optimizer = tf.train.MomentumOptimizer(0.01, 0.9).minimize(loss)
+        parallel_loading.threads_started()
+        with tf.Session() as s:
+            tf.initialize_all_variables().run()
+            durations = []
+            for step in range(WARMUP_STEPS + TRAINING_STEPS):
+                indices = random.randint(0, len(data), batch_size)
+                feed_dict = {data_node: data[indices], labels_node: labels[indices]}
+                start = time.time()
+                s.run(optimizer, feed_dict=feed_dict)
+                durations.append(time.time() - start)
+    durations = np.array(durations[WARMUP_STEPS:])
+    return {'steps_per_sec': len(durations) / durations.sum(),
+            'examples_per_sec': len(durations) * batch_size / durations.sum(),
+            'step_p50_ms': np.percentile(durations, 50) * 1000,
+            'step_p99_ms': np.percentile(durations, 99) * 1000}
+
+def bench_inference(params, cache):
+    import tensorflow as tf
+    from model import PatchModel
+    from tf_aerial_images import InferenceEngine
+    from patch_extraction import extract_patches
+    if 'test_images' not in cache:
+        cache['test_images'] = decode_images(test_filenames(NUM_TEST_IMAGES), NUM_PROCESSES)
+    imgs = cache['test_images']
+    patch_size = params['patch_size']
+    with tf.Graph().as_default():
+        net = PatchModel(patch_size, imgs.shape[3], conv_depths=params['conv_depths'])
+        engine = InferenceEngine(net.model, net.model_fcn, patch_size, params['batch_size'])
+        parallel_loading.threads_started()
+        with tf.Session() as s:
+            tf.initialize_all_variables().run()
+            durations = []
+            disagreements = []
+            # The first image only warms up the session
+            for img in [imgs[0]] + list(imgs):
+                start = time.time()
+                if params['fcn']:
+                    predictions = engine.predict_image(s, img)
+                else:
+                    predictions = engine.predict(s, extract_patches(img, patch_size, patch_size, 0))
+                durations.append(time.time() - start)
+                if params['fcn']:
+                    # Patch labels that differ from the patchwise model (untimed)
+                    patchwise = engine.predict(s, extract_patches(img, patch_size, patch_size, 0))
+                    disagreements.append(np.mean(np.argmax(predictions, 1) != np.argmax(patchwise, 1)))
+    durations = np.array(durations[1:])
+    metrics = {'image_p50_ms': np.percentile(durations, 50) * 1000,
+               'image_p99_ms': np.percentile(durations, 99) * 1000,
+               'images_per_sec': len(durations) / durations.sum()}
+    if params['fcn']:
+        metrics['label_disagreement_pct'] = 100.0 * np.mean(disagreements[1:])
+    return metrics
+
+def truth_masks(patch_size, cache):
+    key = ('truth', patch_size)
+    if key not in cache:
+        gt_imgs = decode_images(training_filenames(TRAIN_LABELS_DIR, NUM_TRAIN_IMAGES), NUM_PROCESSES)
+        cache[key] = np.asarray([patch_labels(gt, patch_size) for gt in gt_imgs])
+    return cache[key]
+
+def bench_postprocessing(params, cache):
+    truth = truth_masks(16, cache)
+    # Groundtruth with 10% flipped patches stands in for predictions
+    random = np.random.RandomState(SEED)
+    masks = np.where(random.rand(*truth.shape) < 0.1, 1 - truth, truth).astype(np.float64)
+    start = time.time()
+    postprocess_masks(masks, PIPELINES[params['pipeline']])
+    elapsed = time.time() - start
+    return {'mask_ms': elapsed / len(masks) * 1000}
+
+def bench_submission(params, cache):
+    gt_imgs = decode_images(training_filenames(TRAIN_LABELS_DIR, NUM_TRAIN_IMAGES), NUM_PROCESSES)
+    (handle, filename) = tempfile.mkstemp(suffix='.csv')
+    os.close(handle)
+    try:
+        start = time.time()
+        write_submission(filename, gt_imgs, range(1, len(gt_imgs) + 1), params['patch_size'])
+        t_write = time.time() - start
+        start = time.time()
+        Submission(filename, patch_size=params['patch_size'])
+        t_parse = time.time() - start
+    finally:
+        os.remove(filename)
+    return {'write_ms_per_image': t_write / len(gt_imgs) * 1000, 'parse_ms_per_image': t_parse / len(gt_imgs) * 1000}
+
+BENCHMARKS = [
+    ('extraction', bench_extraction),
+    ('loading', bench_loading),
+    ('training', bench_training),
+    ('inference', bench_inference),
+    ('postprocessing', bench_postprocessing),
+    ('submission', bench_submission),
+]
+
+######## Running and comparing ########
+
+def environment():
+    env = {'python': platform.python_version(), 'platform': platform.platform(),
+           'numpy': np.__version__, 'cpu_count': multiprocessing.cpu_count()}
+    try:
+        import tensorflow as tf
+        env['tensorflow'] = tf.__version__
+    except ImportError:
+        env['tensorflow'] = None
+    try:
+        env['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        env['commit'] = None
+    return env
+
+def result_key(result):
+    return result['benchmark'] + ' ' + json.dumps(result['params'], sort_keys=True)
+
+def run(matrix, only=None):
+    results = []
+    cache = {}
+    for (name, fn) in BENCHMARKS:
+        if only and name not in only:
+            continue
+        for params in parameter_grid(matrix[name]):
+            metrics = median_of([fn(params, cache) for i in range(REPEATS)])
+            results.append({'benchmark': name, 'params': params, 'metrics': metrics})
+            print('%-15s %-60s %s' % (name, json.dumps(params, sort_keys=True),
+                  '  '.join('%s=%.3f' % kv for kv in sorted(metrics.items()))))
+            sys.stdout.flush()
+    return results
+
+def regressions(results, baseline, tolerance):
+    """(key, metric, baseline value, new value) of every metric worse than the
+    baseline by more than the relative tolerance.
+    """
+    reference = dict((result_key(r), r['metrics']) for r in baseline['results'])
+    found = []
+    for result in results:
+        old = reference.get(result_key(result))
+        if old is None:
+            continue
+        for (metric, value) in sorted(result['metrics'].items()):
+            if metric not in old or old[metric] <= 0:
+                continue
+            if metric.endswith('_per_sec'):
+                worse = value < old[metric] * (1 - tolerance)
+            else:
+                worse = value > old[metric] * (1 + tolerance)
+            if worse:
+                found.append((result_key(result), metric, old[metric], value))
+    return found
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark suite of the road segmentation pipeline.')
+    parser.add_argument('--quick', action='store_true', help='run the small QUICK_MATRIX')
+    parser.add_argument('--only', default='', help='comma separated benchmarks to run')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, help='result file to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='also write the results to --baseline')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='relative slowdown flagged as regression')
+    args = parser.parse_args(argv[1:])
+
+    np.random.seed(SEED)
+    only = [name for name in args.only.split(',') if name]
+    matrix = QUICK_MATRIX if args.quick else MATRIX
+    report = {'environment': environment(), 'matrix': matrix, 'repeats': REPEATS,
+              'results': run(matrix, only)}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Results written to %s' % args.output)
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Baseline written to %s' % args.baseline)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(report['results'], baseline, args.tolerance)
+        for (key, metric, old, new) in found:
+            print('REGRESSION %s %s: %.3f -> %.3f' % (key, metric, old, new))
+        print('%d regression(s) against %s (tolerance %.0f%%)' % (len(found), args.baseline, 100 * args.tolerance))
+        return 1 if found else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
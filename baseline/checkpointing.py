@@ -0,0 +1,89 @@
+"""
+Resumable training checkpoints.
+CheckpointManager saves the weights through a tf.train.Saver every
+every_steps training steps and every every_secs seconds of wall-clock time,
+together with the training state needed to resume at the exact step: the
+global step, the training time spent so far, the seeds of the data order and
+the state of the numpy random generator. Only the keep most recent checkpoints
+are kept (all of them with keep=0); they are listed, oldest first, in checkpoints.json.
+"""
+
+import glob
+import json
+import os
+import pickle
+import time
+
+MANIFEST_FILENAME = 'checkpoints.json'
+STATE_SUFFIX = '.state'
+
+class CheckpointManager(object):
+
+    def __init__(self, saver, directory, keep=3, every_steps=0, every_secs=0, prefix='model.ckpt'):
+        self.saver = saver
+        self.directory = directory
+        self.keep = keep
+        self.every_steps = every_steps
+        self.every_secs = every_secs
+        self.prefix = prefix
+        self.last_time = time.time()
+
+    def manifest_filename(self):
+        return os.path.join(self.directory, MANIFEST_FILENAME)
+
+    def checkpoints(self):
+        """[{'step', 'path', 'time'}] of the kept checkpoints, oldest first."""
+        if not os.path.isfile(self.manifest_filename()):
+            return []
+        with open(self.manifest_filename()) as f:
+            return json.load(f)
+
+    def write_manifest(self, checkpoints):
+        tmp_filename = self.manifest_filename() + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(checkpoints, f, indent=1, sort_keys=True)
+        os.rename(tmp_filename, self.manifest_filename())
+
+    def restart_timer(self):
+        """Starts the time interval of the next save now, e.g. when training starts."""
+        self.last_time = time.time()
+
+    def due(self, step):
+        """Whether a checkpoint is due after step training steps: step is a
+        multiple of every_steps, or every_secs passed since the last save.
+        """
+        if self.every_steps > 0 and step % self.every_steps == 0:
+            return True
+        return self.every_secs > 0 and time.time() - self.last_time >= self.every_secs
+
+    def save(self, session, step, state):
+        """Saves the weights and state (a picklable dict) of step, then drops the
+        checkpoints beyond the keep most recent ones. Returns the checkpoint path.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.saver.save(session, os.path.join(self.directory, self.prefix), global_step=step)
+        state = dict(state, step=step, path=path)
+        tmp_filename = path + STATE_SUFFIX + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(state, f, 2)
+        os.rename(tmp_filename, path + STATE_SUFFIX)
+
+        checkpoints = [c for c in self.checkpoints() if c['path'] != path]
+        checkpoints.append({'step': step, 'path': path, 'time': time.time()})
+        (removed, checkpoints) = (checkpoints[:-self.keep], checkpoints[-self.keep:])
+        self.write_manifest(checkpoints)
+        for old in removed:
+            for filename in glob.glob(old['path'] + '.*') + glob.glob(old['path']):
+                os.remove(filename)
+        self.last_time = time.time()
+        return path
+
+    def latest(self):
+        """The state of the most recent checkpoint, None if there is none."""
+        for checkpoint in reversed(self.checkpoints()):
+            filename = checkpoint['path'] + STATE_SUFFIX
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    return pickle.load(f)
+        return None
@@ -0,0 +1,100 @@
+"""
+Class statistics and balancing for arrays of 1-hot labels.
+Balancing never copies the patches: an IndexSampler only hands out arrays of
+patch indices, and the training loop gathers every minibatch from the
+unmodified patch array (or patch store) with them.
+Modes:
+    'none'        every patch once per epoch
+    'truncate'    the first min_c patches of every class, min_c being the size
+                  of the smallest class (the original behaviour, biased toward
+                  the first images)
+    'stratified'  min_c patches of every class drawn at random without
+                  replacement, once
+    'weighted'    all patches, every draw picking a class uniformly and then a
+                  patch of that class, so a new balanced set is seen every epoch
+"""
+
+import numpy as np
+
+BALANCING_MODES = ('none', 'truncate', 'stratified', 'weighted')
+
+def class_histogram(labels):
+    """Number of patches per class."""
+    labels = np.asarray(labels)
+    return np.bincount(np.argmax(labels, axis=1), minlength=labels.shape[1])
+
+def class_indices(labels):
+    """For every class, the increasing indices of its patches."""
+    labels = np.asarray(labels)
+    classes = np.argmax(labels, axis=1)
+    return [np.flatnonzero(classes == c) for c in range(labels.shape[1])]
+
+def truncated_indices(labels):
+    """The first min_c patches of every class, in the order of the original loop."""
+    per_class = class_indices(labels)
+    min_c = min(len(idx) for idx in per_class)
+    return np.concatenate([idx[:min_c] for idx in per_class])
+
+def stratified_indices(labels, random=np.random):
+    """min_c patches of every class drawn uniformly, returned in increasing order."""
+    per_class = class_indices(labels)
+    min_c = min(len(idx) for idx in per_class)
+    return np.sort(np.concatenate([random.choice(idx, min_c, replace=False) for idx in per_class]))
+
+class IndexSampler(object):
+    """Hands out the patch indices of every training epoch for one balancing mode."""
+
+    def __init__(self, labels, mode='stratified', seed=None):
+        if mode not in BALANCING_MODES:
+            raise ValueError('Unknown balancing mode %r, expected one of %s' % (mode, ', '.join(BALANCING_MODES)))
+        self.mode = mode
+        self.random = np.random.RandomState(seed)
+        # Seeds the numbered epochs, see epoch()
+        self.seed = int(self.random.randint(0, 2 ** 31 - 1)) if seed is None else seed
+        self.num_labels = len(labels)
+        if mode == 'none':
+            self.indices = np.arange(self.num_labels)
+        elif mode == 'truncate':
+            self.indices = truncated_indices(labels)
+        elif mode == 'stratified':
+            self.indices = stratified_indices(labels, self.random)
+        else:
+            self.indices = None
+            self.class_indices = [idx for idx in class_indices(labels) if len(idx) > 0]
+
+    @property
+    def size(self):
+        """Number of patch indices per epoch."""
+        return self.num_labels if self.indices is None else len(self.indices)
+
+    def sample(self, num, random=None):
+        """num indices drawn with replacement from the patches of the epoch."""
+        random = self.random if random is None else random
+        if self.indices is not None:
+            return self.indices[random.randint(0, len(self.indices), num)]
+        classes = random.randint(0, len(self.class_indices), num)
+        out = np.empty(num, dtype=np.int64)
+        for (c, idx) in enumerate(self.class_indices):
+            selected = np.flatnonzero(classes == c)
+            out[selected] = idx[random.randint(0, len(idx), len(selected))]
+        return out
+
+    def epoch(self, number=None):
+        """The shuffled patch indices of one epoch.
+        A numbered epoch only depends on the seed and its number, so a resumed
+        run sees the same data order; without a number the next random epoch
+        is drawn.
+        """
+        random = self.random if number is None else np.random.RandomState([self.seed, number])
+        if self.indices is None:
+            return self.sample(self.num_labels, random)
+        return random.permutation(self.indices)
+
+    def distinct(self, num):
+        """Up to num distinct indices of the next random epoch, in increasing
+        order. A 'weighted' epoch draws with replacement and repeats patches,
+        which must not be counted twice in a validation set.
+        """
+        epoch = self.epoch()
+        (_, first) = np.unique(epoch, return_index=True)
+        return np.sort(epoch[np.sort(first)[:num]])
@@ -0,0 +1,105 @@
+"""
+Streaming evaluation of patch predictions.
+The patches are fed to the model in fixed-size chunks and only a confusion
+matrix is kept between chunks, so neither the graph nor the peak memory grows
+with the size of the evaluation set.
+evaluate_images() scores whole images instead, on a label grid that does not
+depend on the patch size, so that models of different patch sizes compare.
+"""
+
+import numpy as np
+
+from mask_to_submission import patch_labels
+from patch_extraction import extract_patches, pad_to_patches
+from prediction_masks import label_to_img
+
+ROAD = 1 # Class index of road patches
+
+class ConfusionMatrix(object):
+    """Patch counts [true class, predicted class], accumulated batch by batch."""
+
+    def __init__(self, num_labels=2):
+        self.num_labels = num_labels
+        self.counts = np.zeros((num_labels, num_labels), dtype=np.int64)
+
+    def update(self, predictions, labels):
+        """Adds a batch of predictions (scores or 1-hot) and their 1-hot labels."""
+        k = self.num_labels
+        pairs = np.argmax(labels, 1) * k + np.argmax(predictions, 1)
+        self.counts += np.bincount(pairs, minlength=k * k).reshape(k, k)
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    def error_rate(self):
+        """Percentage of misclassified patches, as error_rate() in tf_aerial_images.py."""
+        if self.total == 0:
+            return 0.0
+        return 100.0 - 100.0 * np.trace(self.counts) / self.total
+
+    def precision(self, c=ROAD):
+        predicted = self.counts[:, c].sum()
+        return self.counts[c, c] / float(predicted) if predicted else 0.0
+
+    def recall(self, c=ROAD):
+        actual = self.counts[c, :].sum()
+        return self.counts[c, c] / float(actual) if actual else 0.0
+
+    def f1(self, c=ROAD):
+        (p, r) = (self.precision(c), self.recall(c))
+        return 2 * p * r / (p + r) if p + r else 0.0
+
+    def summary(self):
+        lines = ['%d patches, error %.2f%%, road F1 %.4f (precision %.4f, recall %.4f)'
+                 % (self.total, self.error_rate(), self.f1(), self.precision(), self.recall())]
+        for c in range(self.num_labels):
+            lines.append('  true class %d: %s' % (c, ' '.join('%10d' % n for n in self.counts[c])))
+        return '\n'.join(lines)
+
+def evaluate(predict, data, labels, batch_size, indices=None, num_labels=2):
+    """Confusion matrix of predict() over the patches data[indices] (all of data by default).
+    predict maps a batch of patches to scores; it never sees more than batch_size
+    patches, and only one batch of data is gathered at a time.
+    """
+    confusion = ConfusionMatrix(num_labels)
+    num = len(data) if indices is None else len(indices)
+    for begin in range(0, num, batch_size):
+        end = min(begin + batch_size, num)
+        if indices is None:
+            (batch_data, batch_labels) = (data[begin:end], labels[begin:end])
+        else:
+            batch_indices = indices[begin:end]
+            (batch_data, batch_labels) = (data[batch_indices], labels[batch_indices])
+        confusion.update(predict(batch_data), batch_labels)
+    return confusion
+
+def evaluate_images(predict, imgs, truth, patch_size, grid, batch_size, num_labels=2):
+    """Confusion matrix of predict() over whole images, on a grid of grid pixels.
+    Every image is padded to whole patches and predicted patch by patch, at most
+    batch_size patches at a time; the road patches are painted into a pixel
+    mask, which is labelled on the grid like a submission (see
+    mask_to_submission.patch_labels) and compared to truth, the labels of the
+    groundtruth [grid row, grid column] of every image.
+    """
+    confusion = ConfusionMatrix(num_labels)
+    for (img, labels) in zip(imgs, truth):
+        patches = image_patches(img, patch_size)
+        predictions = np.concatenate([predict(patches[begin:begin + batch_size])
+                                      for begin in range(0, len(patches), batch_size)])
+        update_on_grid(confusion, predictions, img.shape, labels, patch_size, grid)
+    return confusion
+
+def image_patches(img, patch_size):
+    """The patches of img padded to whole patches, as evaluate_images predicts them."""
+    return extract_patches(pad_to_patches(img, patch_size), patch_size, patch_size, 0)
+
+def update_on_grid(confusion, predictions, shape, labels, patch_size, grid):
+    """Adds to confusion the predictions of image_patches() of an image of the
+    given shape, labelled on the grid, against its grid labels.
+    """
+    padded = (-(-shape[0] // patch_size) * patch_size, -(-shape[1] // patch_size) * patch_size)
+    mask = label_to_img(padded[0], padded[1], patch_size, patch_size, predictions)
+    predicted = patch_labels(mask[:shape[0], :shape[1]], grid)
+    one_hot = np.eye(confusion.num_labels)
+    confusion.update(one_hot[predicted.ravel()], one_hot[np.asarray(labels).ravel()])
@@ -0,0 +1,102 @@
+"""
+Exports a trained checkpoint as a standalone inference artifact for predict.py.
+Only the trained convolution and fully connected weights are kept (no
+optimizer slots, summaries or training graph), as float32 arrays of a .npz
+file together with the settings needed to use them: patch size, architecture
+and postprocessing pipeline.
+
+--precision float16 stores the weights as float16, --precision int8 quantizes
+them after training (see numpy_inference.quantize); the int8 activation scales
+are calibrated on patches of a few of the images trained on. The numbers of the
+held-out validation images of the configuration (validation_images, see
+Trainer.validate) are saved with the weights; bench_quantization.py evaluates
+the precisions on them.
+
+Usage: python export_model.py [--output model.npz] [--checkpoint tmp/model.ckpt]
+                              [--precision float32|float16|int8] [--calibration-patches 2000] [--train_dir=tmp/]
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import tf_aerial_images
+from model import PatchModel
+from numpy_inference import PRECISIONS, WEIGHT_NAMES, quantize
+from patch_extraction import extract_patches_from_images
+from prediction_cache import checkpoint_digest
+
+EXPORT_FILENAME = 'model.npz'
+CALIBRATION_PATCHES = 2000 # Training patches that calibrate the int8 activation scales
+CALIBRATION_IMAGES = 8 # Training images the calibration patches are drawn from
+CALIBRATION_SEED = 201 # Draws the calibration images and patches, the same ones for every export
+
+def calibration_data(config, num_patches=CALIBRATION_PATCHES, num_images=CALIBRATION_IMAGES):
+    """num_patches training patches drawn at random from num_images random
+    images trained on, never from the held-out validation images. Only these
+    images are read, the training set is not extracted.
+    """
+    random = np.random.RandomState(CALIBRATION_SEED)
+    filenames = tf_aerial_images.image_filenames(config.train_data_dir, tf_aerial_images.num_training_images(config))
+    chosen = np.sort(random.choice(len(filenames), min(num_images, len(filenames)), replace=False))
+    imgs = tf_aerial_images.read_images([filenames[i] for i in chosen], config.loader_processes)
+    patches = extract_patches_from_images(imgs, config.img_patch_size, config.img_patch_stride, config.num_transformations)
+    return patches[np.sort(random.choice(len(patches), min(num_patches, len(patches)), replace=False))]
+
+def validation_image_numbers(config):
+    """Numbers of the held-out training images, never trained on."""
+    return list(range(tf_aerial_images.num_training_images(config) + 1, config.training_size + 1))
+
+def export_model(config, filename=EXPORT_FILENAME, checkpoint=None, precision='float32', calibration=None):
+    """Writes the weights of checkpoint (model.ckpt of train_dir by default) to
+    filename, at the given precision. int8 calibrates on the calibration
+    patches, or on calibration_data() when there are none.
+    """
+    checkpoint = checkpoint or config.train_dir + "/model.ckpt"
+    graph = tf.Graph()
+    with graph.as_default():
+        net = PatchModel(config.img_patch_size, tf_aerial_images.NUM_CHANNELS, tf_aerial_images.NUM_LABELS,
+                         conv_sizes=config.conv_sizes, conv_depths=config.conv_depths,
+                         fc_depth=config.fc_depth, seed=config.seed)
+        saver = tf.train.Saver()
+    with tf.Session(graph=graph) as session:
+        saver.restore(session, checkpoint)
+        values = session.run([getattr(net, name) for name in WEIGHT_NAMES])
+    meta = {'patch_size': config.img_patch_size, 'num_channels': tf_aerial_images.NUM_CHANNELS,
+            'num_labels': tf_aerial_images.NUM_LABELS, 'conv_sizes': list(config.conv_sizes),
+            'conv_depths': list(config.conv_depths), 'fc_depth': config.fc_depth,
+            'postprocessing': config.postprocessing, 'checkpoint': checkpoint,
+            'checkpoint_digest': checkpoint_digest(checkpoint), 'exported': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'training_size': config.training_size, 'validation_images': validation_image_numbers(config),
+            'validation_grid': config.validation_grid}
+    arrays = dict((name, np.asarray(value, dtype=np.float32)) for (name, value) in zip(WEIGHT_NAMES, values))
+    if precision == 'int8' and calibration is None:
+        calibration = calibration_data(config)
+    (arrays, meta) = quantize(arrays, meta, precision, calibration)
+    with open(filename, 'wb') as f:
+        np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+    return meta
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Export a checkpoint for predict.py.')
+    parser.add_argument('--output', default=EXPORT_FILENAME)
+    parser.add_argument('--checkpoint', help='checkpoint to export, model.ckpt of train_dir by default')
+    parser.add_argument('--precision', default='float32', choices=PRECISIONS)
+    parser.add_argument('--calibration-patches', type=int, default=CALIBRATION_PATCHES,
+                        help='training patches that calibrate int8 models')
+    args = parser.parse_args(argv[1:])
+    config = tf_aerial_images.Config()
+    calibration = None
+    if args.precision == 'int8':
+        calibration = calibration_data(config, args.calibration_patches)
+    meta = export_model(config, args.output, args.checkpoint, args.precision, calibration)
+    print('Exported %s to %s (patch size %d, %s)' % (meta['checkpoint'], args.output, meta['patch_size'],
+                                                    meta['precision']))
+    if not meta['validation_images']:
+        print('No held-out validation images (validation_images = 0), bench_quantization.py cannot evaluate it')
+
+if __name__ == '__main__':
+    tf.app.run()
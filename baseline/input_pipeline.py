@@ -0,0 +1,227 @@
+"""
+Input pipeline for training.
+Instead of materializing every patch, PatchSampler keeps the decoded source
+images and cuts class-balanced minibatches out of them on demand;
+IndexedBatchSource gathers minibatches from materialized patches following the
+epochs of an IndexSampler. A BatchPrefetcher prepares the next minibatches of
+either source in background threads while the current step runs.
+
+Both sources can also build the minibatch of a given training step,
+batch_at(seq, batch_size), which only depends on their seed and on seq: a run
+resumed at step seq from a checkpoint sees the same data order as the
+uninterrupted run.
+"""
+
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+from patch_extraction import (MAX_TRANSFORMATIONS, num_patch_positions, patch_label_values,
+                              subtract_patch_means, transform_patches, values_to_classes)
+
+class PatchSampler(object):
+    """Samples minibatches of (patch, 1-hot label) pairs from whole images.
+    Only the images and one label value per patch position are kept in memory.
+    With balance=True both classes are drawn with equal probability.
+    """
+
+    def __init__(self, imgs, gt_imgs, patch_size, stride, num_of_transformations, balance=True, seed=None):
+        self.imgs = np.asarray(imgs)
+        self.patch_size = patch_size
+        self.stride = stride
+        self.num_of_transformations = min(num_of_transformations, MAX_TRANSFORMATIONS)
+        self.balance = balance
+        self.random = np.random.RandomState(seed)
+        # Seeds the minibatches of batch_at()
+        self.seed = int(self.random.randint(0, 2 ** 31 - 1)) if seed is None else seed
+        self.lock = threading.Lock()
+
+        (self.n0, self.n1) = num_patch_positions(self.imgs[0], patch_size, stride)
+        values = np.concatenate([patch_label_values(gt, patch_size, stride) for gt in gt_imgs])
+        self.labels = values_to_classes(values)
+        # Positions are numbered image by image, in extract_patches order.
+        self.class_positions = [np.flatnonzero(self.labels[:, c] == 1) for c in range(self.labels.shape[1])]
+
+    def class_counts(self):
+        return [len(p) for p in self.class_positions]
+
+    @property
+    def epoch_size(self):
+        """Number of patches in one pass over the (balanced) augmented data."""
+        if self.balance:
+            num_positions = min(self.class_counts()) * len(self.class_positions)
+        else:
+            num_positions = len(self.labels)
+        return num_positions * (1 + self.num_of_transformations)
+
+    def sample_positions(self, batch_size, random=None):
+        random = self.random if random is None else random
+        if not self.balance:
+            return random.randint(0, len(self.labels), batch_size)
+        classes = random.randint(0, len(self.class_positions), batch_size)
+        positions = np.empty(batch_size, dtype=np.int64)
+        for c in range(len(self.class_positions)):
+            selected = np.flatnonzero(classes == c)
+            positions[selected] = random.choice(self.class_positions[c], len(selected))
+        return positions
+
+    def patches_at(self, positions, transformations):
+        """Cut, mean-subtract and transform the patches at the given positions."""
+        per_image = self.n0 * self.n1
+        image_idx = positions // per_image
+        local = positions % per_image
+        y0 = (local % self.n0) * self.stride
+        x0 = (local // self.n0) * self.stride
+        offsets = np.arange(self.patch_size)
+        rows = (y0[:, np.newaxis] + offsets)[:, :, np.newaxis]
+        cols = (x0[:, np.newaxis] + offsets)[:, np.newaxis, :]
+        patches = self.imgs[image_idx[:, np.newaxis, np.newaxis], rows, cols]
+        subtract_patch_means(patches)
+        return transform_patches(patches, transformations)
+
+    def next_batch(self, batch_size):
+        # Only the random draws are serialized, the patches are cut concurrently
+        with self.lock:
+            positions = self.sample_positions(batch_size)
+            transformations = self.random.randint(0, 1 + self.num_of_transformations, batch_size)
+        return (self.patches_at(positions, transformations), self.labels[positions])
+
+    def batch_at(self, seq, batch_size):
+        """The minibatch of training step seq, drawn from its own random state."""
+        random = np.random.RandomState([self.seed, seq])
+        positions = self.sample_positions(batch_size, random)
+        transformations = random.randint(0, 1 + self.num_of_transformations, batch_size)
+        return (self.patches_at(positions, transformations), self.labels[positions])
+
+class IndexedBatchSource(object):
+    """Minibatches gathered from materialized patches (array, memmap or PatchStore).
+    Epochs follow index_sampler.epoch(), the consecutive minibatches of an epoch
+    being consecutive slices of its indices. Safe to call from several threads.
+    """
+
+    def __init__(self, data, labels, index_sampler):
+        self.data = data
+        self.labels = labels
+        self.index_sampler = index_sampler
+        self.lock = threading.Lock()
+        self.epoch_indices = np.empty(0, dtype=np.int64)
+        self.cursor = 0
+        # Numbered epochs of batch_at, the last two are kept for the prefetch threads
+        self.epochs = {}
+
+    def next_indices(self, batch_size):
+        with self.lock:
+            if self.cursor + batch_size > len(self.epoch_indices):
+                self.epoch_indices = self.index_sampler.epoch()
+                self.cursor = 0
+            indices = self.epoch_indices[self.cursor:self.cursor + batch_size]
+            self.cursor += batch_size
+        # Increasing indices read the patch store shards sequentially
+        return np.sort(indices)
+
+    def next_batch(self, batch_size):
+        indices = self.next_indices(batch_size)
+        return (self.data[indices], self.labels[indices])
+
+    def epoch_indices_of(self, number):
+        with self.lock:
+            if number not in self.epochs:
+                self.epochs[number] = self.index_sampler.epoch(number)
+                for old in [n for n in self.epochs if n < number - 1]:
+                    del self.epochs[old]
+            return self.epochs[number]
+
+    def batch_at(self, seq, batch_size):
+        """The minibatch of training step seq: slice seq % steps_per_epoch of
+        epoch seq // steps_per_epoch, see IndexSampler.epoch(number).
+        """
+        steps_per_epoch = max(1, self.index_sampler.size // batch_size)
+        begin = (seq % steps_per_epoch) * batch_size
+        indices = np.sort(self.epoch_indices_of(seq // steps_per_epoch)[begin:begin + batch_size])
+        return (self.data[indices], self.labels[indices])
+
+class BatchPrefetcher(object):
+    """Runs batch_at(seq, batch_size) for seq = start, start + 1, ... in
+    num_threads background threads and keeps up to capacity minibatches ready in
+    a bounded queue. get() returns them in seq order, whatever thread finished
+    first.
+    get() records the queue depth it finds and the time it waits, see stats().
+    """
+
+    def __init__(self, batch_at, batch_size, capacity, num_threads=1, start=0):
+        self.batch_at = batch_at
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self.queue = queue.Queue(maxsize=capacity)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.next_seq = start
+        # Minibatches taken from the queue ahead of their turn, by seq
+        self.pending = {}
+        self.expected = start
+        self.reset_stats()
+        self.threads = [threading.Thread(target=self._run) for i in range(num_threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                seq = self.next_seq
+                self.next_seq += 1
+            try:
+                batch = self.batch_at(seq, self.batch_size)
+            except Exception as e:
+                # Hand the error over to the consumer instead of blocking it forever.
+                batch = e
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put((seq, batch), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self):
+        depth = self.queue.qsize() + len(self.pending)
+        start = time.time()
+        while self.expected not in self.pending:
+            (seq, batch) = self.queue.get()
+            self.pending[seq] = batch
+        batch = self.pending.pop(self.expected)
+        self.expected += 1
+        self.stall_time += time.time() - start
+        self.num_batches += 1
+        self.depth_sum += depth
+        if depth == 0:
+            self.num_stalls += 1
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def reset_stats(self):
+        self.num_batches = 0
+        self.num_stalls = 0
+        self.stall_time = 0.0
+        self.depth_sum = 0
+
+    def stats(self):
+        """Consumer-side metrics since the last reset_stats(): mean queue depth
+        seen by get(), number of get() calls that found the queue empty and the
+        total time spent waiting for minibatches.
+        """
+        return {'batches': self.num_batches,
+                'queue_depth': self.depth_sum / float(max(1, self.num_batches)),
+                'capacity': self.capacity,
+                'stalls': self.num_stalls,
+                'stall_time': self.stall_time}
+
+    def close(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
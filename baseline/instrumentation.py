@@ -0,0 +1,175 @@
+"""
+Lightweight timers and counters for the stages of the pipeline.
+Stages are timed with a context manager or a decorator on the shared default
+instance, e.g.
+    with timer('decode'):
+        ...
+    @timed('submission_encoding')
+    def write_submission(...):
+        ...
+and counters are incremented with count(name, n). Every duration is kept, so
+the run report gives exact latency percentiles per stage. A long-lived process
+sets a window instead: the percentiles are then those of the last window calls
+of every stage, while call counts and total times stay exact.
+Stages nest (mask_rendering calls postprocessing, validation runs
+inference_batch), so a stage's total_s includes the stages timed inside it.
+The report also gives exclusive_s, the time of the stage minus that of its
+nested stages, and lists the enclosing stages under 'within'; the exclusive
+times add up to the timed time without double counting. A stage entered again
+inside itself is only timed once, by its outermost call.
+"""
+
+import array
+import functools
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+class Instrumentation(object):
+    """Durations per stage name and counters, safe to update from several threads.
+    With a window, only the last window durations of every stage are kept.
+    """
+
+    def __init__(self, window=None):
+        self.lock = threading.Lock()
+        self.window = window
+        # Stack of [stage, time of nested stages] per thread
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.durations = defaultdict(lambda: array.array('d'))
+            self.calls = defaultdict(int)
+            self.totals = defaultdict(float)
+            self.exclusive = defaultdict(float)
+            self.parents = defaultdict(set)
+            self.counters = defaultdict(int)
+            self.started = time.time()
+
+    def record(self, name, seconds, exclusive=None, parent=None):
+        with self.lock:
+            durations = self.durations[name]
+            durations.append(seconds)
+            # Trimmed by halves, so the buffer stays below twice the window
+            if self.window is not None and len(durations) >= 2 * self.window:
+                del durations[:len(durations) - self.window]
+            self.calls[name] += 1
+            self.totals[name] += seconds
+            self.exclusive[name] += seconds if exclusive is None else exclusive
+            if parent is not None:
+                self.parents[name].add(parent)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    @contextmanager
+    def timer(self, name):
+        stack = self.local.__dict__.setdefault('stack', [])
+        if stack and stack[-1][0] == name:
+            yield
+            return
+        frame = [name, 0.0]
+        stack.append(frame)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            stack.pop()
+            parent = None
+            if stack:
+                stack[-1][1] += elapsed
+                parent = stack[-1][0]
+            self.record(name, elapsed, elapsed - frame[1], parent)
+
+    def timed(self, name=None):
+        """Decorator timing every call of the function (under its own name by default)."""
+        def decorator(fn):
+            stage = name or fn.__name__
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def total(self, name):
+        with self.lock:
+            return self.totals.get(name, 0.0)
+
+    def counter_values(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def rate(self, counter, stage):
+        """counter per second of time spent in stage, e.g. examples/sec of training."""
+        total = self.total(stage)
+        with self.lock:
+            n = self.counters.get(counter, 0)
+        return n / total if total > 0 else 0.0
+
+    def stage_summary(self, name, last=None):
+        """Call count, total time and mean/p50/p99 latency (ms) of a stage,
+        over its last calls only if given. Over all calls, also the exclusive
+        time and the enclosing stages; the percentiles are then those of the
+        kept window.
+        """
+        with self.lock:
+            durations = np.frombuffer(self.durations[name], dtype=np.float64).copy() if name in self.durations else np.empty(0)
+            (calls, total) = (self.calls.get(name, 0), self.totals.get(name, 0.0))
+            exclusive = self.exclusive.get(name, 0.0)
+            parents = sorted(self.parents.get(name, ()))
+        if last is not None:
+            durations = durations[-last:]
+            (calls, total) = (len(durations), float(durations.sum()))
+        elif self.window is not None:
+            durations = durations[-self.window:]
+        if len(durations) == 0:
+            return {'count': 0, 'total_s': 0.0}
+        (p50, p99) = np.percentile(durations, [50, 99]) * 1000
+        summary = {'count': calls, 'total_s': total,
+                   'mean_ms': total / calls * 1000, 'p50_ms': float(p50), 'p99_ms': float(p99)}
+        if last is None:
+            summary['exclusive_s'] = exclusive
+            if parents:
+                summary['within'] = parents
+        return summary
+
+    def report(self, **extra):
+        """Structured run report: wall time, stages, counters and any extra fields."""
+        with self.lock:
+            names = sorted(self.durations)
+        counters = self.counter_values()
+        report = {'wall_time_s': time.time() - self.started,
+                  'stages': dict((name, self.stage_summary(name)) for name in names),
+                  'counters': counters}
+        report.update(extra)
+        return report
+
+    def write_report(self, filename, **extra):
+        report = self.report(**extra)
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        return report
+
+    def scalars(self, names, last=None):
+        """(tag, value) pairs of the p50/p99 latency of the given stages, for TensorBoard."""
+        values = []
+        for name in names:
+            summary = self.stage_summary(name, last)
+            if summary['count']:
+                values.append((name + '/p50_ms', summary['p50_ms']))
+                values.append((name + '/p99_ms', summary['p99_ms']))
+        return values
+
+# Shared by every module of the pipeline
+default = Instrumentation()
+timer = default.timer
+timed = default.timed
+count = default.count
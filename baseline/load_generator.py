@@ -0,0 +1,138 @@
+"""
+Load generator for prediction_server.py.
+Keeps --concurrency clients sending the test images to the server, each as
+soon as the answer to its previous request arrived, and reports the client
+side throughput and latency percentiles together with the /stats of the
+server (batch sizes and model run latency).
+
+Usage: python load_generator.py [--url http://127.0.0.1:8000 | --socket server.sock]
+                                [--concurrency 8] [--requests 400] [--format rows]
+                                [--images 50] [--output load_report.json]
+"""
+
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+try:
+    from http.client import HTTPConnection
+    from urllib.parse import urlparse
+except ImportError:
+    from httplib import HTTPConnection
+    from urlparse import urlparse
+
+import numpy as np
+
+TEST_DATA_DIR = 'data/test_set/'
+NUM_IMAGES = 50
+CONCURRENCY = 8
+NUM_REQUESTS = 400
+
+class UnixHTTPConnection(HTTPConnection):
+    """HTTP over a Unix socket."""
+
+    def __init__(self, path):
+        HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+def connect(args):
+    if args.socket:
+        return UnixHTTPConnection(args.socket)
+    url = urlparse(args.url)
+    return HTTPConnection(url.hostname, url.port or 80)
+
+def request(connection, method, path, body=None):
+    connection.request(method, path, body)
+    response = connection.getresponse()
+    return (response.status, response.read())
+
+def client(args, images, next_request, latencies, errors):
+    connection = connect(args)
+    while True:
+        i = next_request()
+        if i is None:
+            break
+        path = '/predict?format=%s&image_id=%d' % (args.format, i % len(images) + 1)
+        start = time.time()
+        try:
+            (status, _) = request(connection, 'POST', path, images[i % len(images)])
+        except (IOError, OSError) as e:
+            (status, connection) = (str(e), connect(args))
+        if status == 200:
+            latencies.append(time.time() - start)
+        else:
+            errors.append(status)
+    connection.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Load generator for prediction_server.py.')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--socket', help='Unix socket of the server, instead of --url')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--requests', type=int, default=NUM_REQUESTS)
+    parser.add_argument('--format', default='rows', choices=['mask', 'labels', 'rows'])
+    parser.add_argument('--images', type=int, default=NUM_IMAGES, help='number of test images sent in turn')
+    parser.add_argument('--output', help='also write the report to this JSON file')
+    args = parser.parse_args(argv[1:])
+
+    images = []
+    for i in range(1, args.images + 1):
+        with open(TEST_DATA_DIR + 'test_%d.png' % i, 'rb') as f:
+            images.append(f.read())
+
+    lock = threading.Lock()
+    issued = [0]
+    def next_request():
+        with lock:
+            if issued[0] >= args.requests:
+                return None
+            issued[0] += 1
+            return issued[0] - 1
+
+    (latencies, errors) = ([], [])
+    threads = [threading.Thread(target=client, args=(args, images, next_request, latencies, errors))
+               for i in range(args.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies = np.array(latencies) * 1000
+    report = {'concurrency': args.concurrency, 'requests': len(latencies), 'errors': len(errors),
+              'elapsed_s': elapsed, 'requests_per_sec': len(latencies) / elapsed}
+    if len(latencies):
+        (p50, p90, p99) = np.percentile(latencies, [50, 90, 99])
+        report.update({'latency_mean_ms': latencies.mean(), 'latency_p50_ms': p50, 'latency_p90_ms': p90,
+                       'latency_p99_ms': p99, 'latency_max_ms': latencies.max()})
+    connection = connect(args)
+    (status, body) = request(connection, 'GET', '/stats')
+    connection.close()
+    if status == 200:
+        report['server'] = json.loads(body.decode('utf-8'))
+
+    print('%d requests (%d errors) from %d clients in %.2f s: %.1f requests/sec'
+          % (report['requests'], report['errors'], args.concurrency, elapsed, report['requests_per_sec']))
+    if len(latencies):
+        print('Latency: mean %.1f ms, p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms'
+              % (report['latency_mean_ms'], p50, p90, p99, report['latency_max_ms']))
+    if 'server' in report:
+        server = report['server']
+        print('Server: %.1f patches/sec, %.1f requests and %.0f patches per model run (max %d patches, wait %.1f ms)'
+              % (server['patches_per_sec'], server['requests_per_batch'], server['patches_per_batch'],
+                 server['max_batch_size'], server['max_wait_s'] * 1000))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Report written to %s' % args.output)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
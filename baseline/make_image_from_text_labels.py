@@ -1,51 +1,26 @@
 #!/usr/bin/python
 import os
 import sys
-import Image
-import math
+from PIL import Image
 import matplotlib.image as mpimg
 import numpy as np
 
+from submission_to_mask import Submission, binary_to_uint8
+
 label_file = "sample_submission.txt"
 
 h = 16
 w = h
-imgwidth = int(math.ceil((600.0/w))*w)
-imgheight = int(math.ceil((600.0/h))*h)
 nc = 3
 
-# Convert an array of binary labels to a uint8
-def binary_to_uint8(img):
-    rimg = (img * 255).round().astype(np.uint8)
-    return rimg
-
-def reconstruct_from_labels(image_id):
-    im = np.zeros((imgwidth, imgheight), dtype=np.uint8)
-    f = open(label_file)
-    lines = f.readlines()
-    image_id_str = '%.3d_' % image_id
-    for i in range(1, len(lines)):
-        line = lines[i]
-        if not image_id_str in line:
-            continue
-
-        tokens = line.split(' ')
-        id = tokens[0]
-        prediction = int(tokens[1])
-        tokens = id.split('_')
-        i = int(tokens[1])
-        j = int(tokens[2])
-
-        je = min(j+w, imgwidth)
-        ie = min(i+h, imgheight)
-        if prediction == 0:
-            adata = np.zeros((w,h))
-        else:
-            adata = np.ones((w,h))
-
-        im[j:je, i:ie] = binary_to_uint8(adata)
+def reconstruct_from_labels(image_id, submission=None):
+    if submission is None:
+        submission = Submission(label_file, delimiter=' ', patch_size=h)
+    im = binary_to_uint8(submission.mask(image_id))
 
     Image.fromarray(im).save('prediction_' + '%.3d' % image_id + '.png')
 
-for i in range(1, 2):
-	reconstruct_from_labels(i)
\ No newline at end of file
+if __name__ == '__main__':
+    submission = Submission(label_file, delimiter=' ', patch_size=h)
+    for i in range(1, 2):
+        reconstruct_from_labels(i, submission)
@@ -2,9 +2,10 @@
 
 import os
 import numpy as np
-import matplotlib.image as mpimg
 import re
 
+from instrumentation import timed, count
+
 foreground_threshold = 0.25 # percentage of pixels > 1 required to assign a foreground label to a patch
 
 # assign a label to a patch
@@ -16,24 +17,61 @@ def patch_to_label(patch):
         return 0
 
 
+def patch_labels(mask, patch_size=16):
+    """Labels of all patches of a mask at once, as an array [patch row, patch column].
+    Patches at the right and bottom border may be smaller than patch_size."""
+    mask = np.asarray(mask, dtype=np.float64)
+    if mask.ndim == 3:
+        mask = mask.mean(axis=2)
+    row_starts = np.arange(0, mask.shape[0], patch_size)
+    col_starts = np.arange(0, mask.shape[1], patch_size)
+    sums = np.add.reduceat(np.add.reduceat(mask, row_starts, axis=0), col_starts, axis=1)
+    counts = np.outer(np.diff(np.append(row_starts, mask.shape[0])), np.diff(np.append(col_starts, mask.shape[1])))
+    return (sums / counts > foreground_threshold).astype(np.uint8)
+
+
+@timed('submission_encoding')
+def mask_to_submission_text(mask, img_number, patch_size=16):
+    """All submission lines of one mask, as a single string.
+    Lines go column by column, each as "<image>_<x>_<y>,<label>"."""
+    return labels_to_submission_text(patch_labels(mask, patch_size), img_number, patch_size)
+
+
+def labels_to_submission_text(labels, img_number, patch_size=16, row_offset=0, col_offset=0):
+    """Submission lines of a block of patch labels [patch row, patch column]
+    whose first patch is at (row_offset, col_offset) in the patch grid."""
+    (num_rows, num_cols) = labels.shape
+    xs = np.repeat(np.arange(col_offset, col_offset + num_cols) * patch_size, num_rows)
+    ys = np.tile(np.arange(row_offset, row_offset + num_rows) * patch_size, num_cols)
+    values = np.column_stack((xs, ys, np.asarray(labels).T.ravel())).ravel().tolist()
+    line_format = '{:03d}_%d_%d,%d\n'.format(img_number)
+    return (line_format * len(xs)) % tuple(values)
+
+
+@timed('submission_writing')
+def write_submission(submission_filename, masks, img_numbers, patch_size=16):
+    """Writes a submission file for a stack of masks in one buffered call"""
+    text = ''.join(mask_to_submission_text(mask, n, patch_size) for (mask, n) in zip(masks, img_numbers))
+    with open(submission_filename, 'w') as f:
+        f.write('id,prediction\n' + text)
+    count('submission_bytes', len(text))
+
+
 def mask_to_submission_strings(image_filename):
     """Reads a single image and outputs the strings that should go into the submission file"""
+    import matplotlib.image as mpimg
     img_number = int(re.search(r"\d+", image_filename).group(0))
     im = mpimg.imread(image_filename)
-    patch_size = 16
-    for j in range(0, im.shape[1], patch_size):
-        for i in range(0, im.shape[0], patch_size):
-            patch = im[i:i + patch_size, j:j + patch_size]
-            label = patch_to_label(patch)
-            yield("{:03d}_{}_{},{}".format(img_number, j, i, label))
+    for line in mask_to_submission_text(im, img_number).splitlines():
+        yield line
 
 
 def masks_to_submission(submission_filename, *image_filenames):
     """Converts images into a submission file"""
-    with open(submission_filename, 'w') as f:
-        f.write('id,prediction\n')
-        for fn in image_filenames[0:]:
-            f.writelines('{}\n'.format(s) for s in mask_to_submission_strings(fn))
+    import matplotlib.image as mpimg
+    masks = [mpimg.imread(fn) for fn in image_filenames]
+    img_numbers = [int(re.search(r"\d+", fn).group(0)) for fn in image_filenames]
+    write_submission(submission_filename, masks, img_numbers)
 
 
 if __name__ == '__main__':
@@ -41,6 +79,6 @@ if __name__ == '__main__':
     image_filenames = []
     for i in range(1, 51):
         image_filename = 'training/groundtruth/satImage_' + '%.3d' % i + '.png'
-        print image_filename
+        print(image_filename)
         image_filenames.append(image_filename)
-    masks_to_submission(submission_filename, *image_filenames)
\ No newline at end of file
+    masks_to_submission(submission_filename, *image_filenames)
@@ -0,0 +1,143 @@
+"""
+The patch classifier: three convolution + pooling layers followed by two fully
+connected layers. PatchModel holds the trainable weights; model() and
+model_fcn() build graphs from them, so every graph shares the same parameters.
+"""
+
+import tensorflow as tf
+
+PIXEL_DEPTH = 255
+SEED = 201
+CONV_SIZES = (9, 7, 3) # Filter sizes of the convolution layers
+CONV_DEPTHS = (128, 64, 64) # Number of filters of the convolution layers
+FC_DEPTH = 512 # Width of the hidden fully connected layer
+
+# Make an image summary for 4d tensor image with index idx
+def get_image_summary(img, idx = 0):
+    V = tf.slice(img, (0, 0, 0, idx), (1, -1, -1, 1))
+    img_w = img.get_shape().as_list()[1]
+    img_h = img.get_shape().as_list()[2]
+    min_value = tf.reduce_min(V)
+    V = V - min_value
+    max_value = tf.reduce_max(V)
+    V = V / (max_value*PIXEL_DEPTH)
+    V = tf.reshape(V, (img_w, img_h, 1))
+    V = tf.transpose(V, (2, 0, 1))
+    V = tf.reshape(V, (-1, img_w, img_h, 1))
+    return V
+
+# Make an image summary for 3d tensor image with index idx
+def get_image_summary_3d(img):
+    V = tf.slice(img, (0, 0, 0), (1, -1, -1))
+    img_w = img.get_shape().as_list()[1]
+    img_h = img.get_shape().as_list()[2]
+    V = tf.reshape(V, (img_w, img_h, 1))
+    V = tf.transpose(V, (2, 0, 1))
+    V = tf.reshape(V, (-1, img_w, img_h, 1))
+    return V
+
+class PatchModel(object):
+    """The trainable weights of the classifier, for patches of patch_size pixels
+    (a multiple of 8). The variables are created in the same order as they
+    always were, so existing checkpoints restore unchanged.
+    """
+
+    def __init__(self, patch_size, num_channels=3, num_labels=2,
+                 conv_sizes=CONV_SIZES, conv_depths=CONV_DEPTHS, fc_depth=FC_DEPTH, seed=SEED):
+        self.patch_size = patch_size
+        self.num_labels = num_labels
+        self.conv_depths = conv_depths
+        self.fc_depth = fc_depth
+        self.seed = seed
+        # The variables below hold all the trainable weights. They are passed an
+        # initial value which will be assigned when when we call:
+        # {tf.initialize_all_variables().run()}
+        self.conv1_weights = tf.Variable(
+            tf.truncated_normal([conv_sizes[0], conv_sizes[0], num_channels, conv_depths[0]],
+                                stddev=0.1,
+                                seed=seed))
+        self.conv1_biases = tf.Variable(tf.zeros([conv_depths[0]]))
+        self.conv2_weights = tf.Variable(
+            tf.truncated_normal([conv_sizes[1], conv_sizes[1], conv_depths[0], conv_depths[1]],
+                                stddev=0.1,
+                                seed=seed))
+        self.conv2_biases = tf.Variable(tf.constant(0.1, shape=[conv_depths[1]]))
+        self.conv3_weights = tf.Variable(
+            tf.truncated_normal([conv_sizes[2], conv_sizes[2], conv_depths[1], conv_depths[2]],
+                                stddev=0.1,
+                                seed=seed))
+        self.conv3_biases = tf.Variable(tf.constant(0.1, shape=[conv_depths[2]]))
+        self.fc1_weights = tf.Variable(  # fully connected, depth fc_depth.
+            tf.truncated_normal([int((patch_size / 8) * (patch_size / 8) * conv_depths[2]), fc_depth],
+                                stddev=0.1,
+                                seed=seed))
+        self.fc1_biases = tf.Variable(tf.constant(0.1, shape=[fc_depth]))
+        self.fc2_weights = tf.Variable(
+            tf.truncated_normal([fc_depth, num_labels],
+                                stddev=0.1,
+                                seed=seed))
+        self.fc2_biases = tf.Variable(tf.constant(0.1, shape=[num_labels]))
+
+    def conv_layers(self, data):
+        """The convolutional part of the model, shared by model() and model_fcn()."""
+        # 2D convolution, with 'SAME' padding (i.e. the output feature map has
+        # the same size as the input). Note that {strides} is a 4D array whose
+        # shape matches the data layout: [image index, y, x, depth].
+        # LAYER 1
+        conv = tf.nn.conv2d(data, self.conv1_weights, strides=[1, 1, 1, 1], padding='SAME')
+        # Bias and rectified linear non-linearity.
+        relu = tf.nn.relu(tf.nn.bias_add(conv, self.conv1_biases))
+        # Max pooling. The kernel size spec {ksize} also follows the layout of
+        # the data. Here we have a pooling window of 2, and a stride of 2.
+        pool = tf.nn.max_pool(relu, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME')
+        # LAYER 2
+        conv2 = tf.nn.conv2d(pool, self.conv2_weights, strides=[1, 1, 1, 1], padding='SAME')
+        relu2 = tf.nn.relu(tf.nn.bias_add(conv2, self.conv2_biases))
+        pool2 = tf.nn.max_pool(relu2, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME')
+        # LAYER 3
+        conv3 = tf.nn.conv2d(pool2, self.conv3_weights, strides=[1, 1, 1, 1], padding='SAME')
+        relu3 = tf.nn.relu(tf.nn.bias_add(conv3, self.conv3_biases))
+        pool3 = tf.nn.max_pool(relu3, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME')
+        return (conv, pool, conv2, pool2, conv3, pool3)
+
+    def model(self, data, train=False):
+        """The Model definition."""
+        (conv, pool, conv2, pool2, conv3, pool3) = self.conv_layers(data)
+
+        # Reshape the feature map cuboid into a 2D matrix to feed it to the
+        # fully connected layers.
+        pool_shape = pool3.get_shape().as_list()
+        reshape = tf.reshape(
+            pool3,
+            [-1, pool_shape[1] * pool_shape[2] * pool_shape[3]])
+        # Fully connected layer. Note that the '+' operation automatically
+        # broadcasts the biases.
+        hidden = tf.nn.relu(tf.matmul(reshape, self.fc1_weights) + self.fc1_biases)
+        # Add a 50% dropout during training only. Dropout also scales
+        # activations such that no rescaling is needed at evaluation time.
+        if train:
+           hidden = tf.nn.dropout(hidden, 0.5, seed=self.seed)
+        out = tf.matmul(hidden, self.fc2_weights) + self.fc2_biases
+
+        if train == True:
+            tf.image_summary('summary_data', get_image_summary(data))
+            tf.image_summary('summary_conv', get_image_summary(conv))
+            tf.image_summary('summary_pool', get_image_summary(pool))
+            tf.image_summary('summary_conv2', get_image_summary(conv2))
+            tf.image_summary('summary_pool2', get_image_summary(pool2))
+            tf.image_summary('summary_conv3', get_image_summary(conv3))
+            tf.image_summary('summary_pool3', get_image_summary(pool3))
+        return out
+
+    # Fully convolutional version of model() for whole-image inference. The
+    # fully connected layers are applied as convolutions: fc1 covers the pooled
+    # footprint of one patch and moves by one patch, fc2 is a 1x1 convolution.
+    # Returns logits [image index, patch row, patch column, label].
+    def model_fcn(self, data):
+        (_, _, _, _, _, pool3) = self.conv_layers(data)
+        pooled_patch_size = self.patch_size // 8
+        fc1_filter = tf.reshape(self.fc1_weights, [pooled_patch_size, pooled_patch_size, self.conv_depths[2], self.fc_depth])
+        hidden = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(pool3, fc1_filter,
+            strides=[1, pooled_patch_size, pooled_patch_size, 1], padding='VALID'), self.fc1_biases))
+        fc2_filter = tf.reshape(self.fc2_weights, [1, 1, self.fc_depth, self.num_labels])
+        return tf.nn.bias_add(tf.nn.conv2d(hidden, fc2_filter, strides=[1, 1, 1, 1], padding='VALID'), self.fc2_biases)
@@ -0,0 +1,173 @@
+"""
+NumPy forward pass of the patch classifier (model.py), from the weights
+exported by export_model.py. Importing this module does not import
+TensorFlow, so predictions start as soon as the weights are read.
+Every convolution is one matrix product over the strided windows of its
+input, evaluated batch_size patches at a time to bound the memory.
+
+Models can be reduced to a lower precision with quantize():
+    float16  weights stored as float16, activations rounded to float16
+             between layers
+    int8     weights quantized per output channel to int8, layer inputs
+             quantized to 8 bits with scales calibrated on sample patches
+             (post-training quantization)
+The products are still evaluated by the BLAS, in float32 at every precision:
+NumPy has no faster float16 or int8 product, so the reduced precisions only
+make the model smaller (2x and 4x), not faster, and rounding the layer inputs
+costs some time on top (bench_quantization.py reports the slowdown).
+For int8 the float32 sums of the integer products are rounded: a conv2 output
+sums 7*7*128 products of up to 255*127, beyond the 2^24 integers float32
+holds exactly. The error of such a sum stays below 7*7*128 * 2^-24 (0.04%)
+of the sum of its absolute products, and is typically far smaller.
+"""
+
+import json
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Arrays of an exported model, named as the attributes of PatchModel
+WEIGHT_NAMES = ('conv1_weights', 'conv1_biases', 'conv2_weights', 'conv2_biases', 'conv3_weights',
+                'conv3_biases', 'fc1_weights', 'fc1_biases', 'fc2_weights', 'fc2_biases')
+BATCH_SIZE = 256 # Patches per forward pass
+PRECISIONS = ('float32', 'float16', 'int8')
+LAYERS = ('conv1', 'conv2', 'conv3', 'fc1', 'fc2')
+UNSIGNED_INPUTS = ('conv2', 'conv3', 'fc1', 'fc2') # Layer inputs that follow a ReLU, quantized to [0, 255]
+CALIBRATION_PERCENTILE = 99.99 # Of the absolute layer inputs, mapped to the largest quantized value
+
+def conv2d_relu(data, weights, biases, scale=None):
+    """relu(conv2d(data, weights) * scale + biases) with stride 1 and 'SAME' padding."""
+    (k0, k1, channels, depth) = weights.shape
+    (n, height, width, _) = data.shape
+    # 'SAME' puts the odd padding pixel after the data, as TensorFlow does
+    padded = np.pad(data, ((0, 0), ((k0 - 1) // 2, k0 // 2), ((k1 - 1) // 2, k1 // 2), (0, 0)), mode='constant')
+    s = padded.strides
+    windows = as_strided(padded, shape=(n, height, width, k0, k1, channels), strides=(s[0], s[1], s[2], s[1], s[2], s[3]))
+    out = np.dot(windows.reshape(n * height * width, k0 * k1 * channels), weights.reshape(-1, depth))
+    if scale is not None:
+        out *= scale
+    out += biases
+    return np.maximum(out, 0, out=out).reshape(n, height, width, depth)
+
+def max_pool(data):
+    """2x2 max pooling with stride 2 and 'SAME' padding."""
+    (n, height, width, depth) = data.shape
+    if height % 2 or width % 2:
+        data = np.pad(data, ((0, 0), (0, height % 2), (0, width % 2), (0, 0)), mode='constant', constant_values=-np.inf)
+    return data.reshape(n, (height + 1) // 2, 2, (width + 1) // 2, 2, depth).max(axis=(2, 4))
+
+def dense(data, weights, biases, scale=None):
+    out = np.dot(data.reshape(len(data), -1), weights)
+    if scale is not None:
+        out *= scale
+    return out + biases
+
+def softmax(logits):
+    e = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+class NumpyModel(object):
+    """The inference part of PatchModel.model(), on NumPy arrays.
+    meta holds the settings saved by export_model.py (patch size, precision, ...).
+    """
+
+    def __init__(self, weights, meta):
+        self.meta = meta
+        self.patch_size = meta['patch_size']
+        self.precision = meta.get('precision', 'float32')
+        self.activation_scales = meta.get('activation_scales')
+        # float16 and int8 values are exact in float32, their sums are not (see above)
+        self.weights = dict((name, weights[name].astype(np.float32)) for name in WEIGHT_NAMES)
+        # Rescaling of the int8 products, per output channel
+        self.scales = {}
+        if self.precision == 'int8':
+            for layer in LAYERS:
+                self.scales[layer] = weights[layer + '_scale'] * np.float32(self.activation_scales[layer])
+
+    def layer_input(self, layer, data, observe=None):
+        if observe is not None:
+            observe(layer, data)
+        if self.precision == 'float16':
+            return data.astype(np.float16).astype(np.float32)
+        if self.precision == 'int8':
+            low = 0 if layer in UNSIGNED_INPUTS else -127
+            data = np.round(data / np.float32(self.activation_scales[layer]))
+            return np.clip(data, low, 255 if low == 0 else 127, out=data)
+        return data
+
+    def logits(self, patches, observe=None):
+        """Logits of a batch; observe(layer, data) sees the input of every layer."""
+        (w, s) = (self.weights, self.scales.get)
+        data = self.layer_input('conv1', patches, observe)
+        pool = max_pool(conv2d_relu(data, w['conv1_weights'], w['conv1_biases'], s('conv1')))
+        data = self.layer_input('conv2', pool, observe)
+        pool2 = max_pool(conv2d_relu(data, w['conv2_weights'], w['conv2_biases'], s('conv2')))
+        data = self.layer_input('conv3', pool2, observe)
+        pool3 = max_pool(conv2d_relu(data, w['conv3_weights'], w['conv3_biases'], s('conv3')))
+        data = self.layer_input('fc1', pool3, observe)
+        hidden = np.maximum(dense(data, w['fc1_weights'], w['fc1_biases'], s('fc1')), 0)
+        data = self.layer_input('fc2', hidden, observe)
+        return dense(data, w['fc2_weights'], w['fc2_biases'], s('fc2'))
+
+    def predict(self, patches, batch_size=BATCH_SIZE, observe=None):
+        """Probabilities [patch, label] of any number of patches."""
+        predictions = np.empty((len(patches), self.weights['fc2_biases'].shape[0]), dtype=np.float32)
+        for begin in range(0, len(patches), batch_size):
+            batch = np.asarray(patches[begin:begin + batch_size], dtype=np.float32)
+            predictions[begin:begin + len(batch)] = softmax(self.logits(batch, observe))
+        return predictions
+
+def quantize(weights, meta, precision, calibration=None):
+    """(weights, meta) of a float32 model reduced to the given precision. int8
+    needs calibration patches, whose layer inputs set the activation scales.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision %r, expected one of %s' % (precision, ', '.join(PRECISIONS)))
+    meta = dict(meta, precision=precision)
+    if precision == 'float32':
+        return (dict(weights), meta)
+    if precision == 'float16':
+        return (dict((name, w.astype(np.float16) if name.endswith('_weights') else w)
+                     for (name, w) in weights.items()), meta)
+    if calibration is None:
+        raise ValueError('int8 quantization needs calibration patches')
+    maxima = dict((layer, 0.0) for layer in LAYERS)
+    def observe(layer, data):
+        maxima[layer] = max(maxima[layer], float(np.percentile(np.abs(data), CALIBRATION_PERCENTILE)))
+    NumpyModel(weights, dict(meta, precision='float32')).predict(calibration, observe=observe)
+    meta['activation_scales'] = dict((layer, max(maxima[layer], 1e-8) / (255.0 if layer in UNSIGNED_INPUTS else 127.0))
+                                     for layer in LAYERS)
+    quantized = {}
+    for layer in LAYERS:
+        w = weights[layer + '_weights']
+        w_max = np.abs(w.reshape(-1, w.shape[-1])).max(axis=0)
+        scale = np.where(w_max > 0, w_max / 127.0, 1.0).astype(np.float32)
+        quantized[layer + '_weights'] = np.clip(np.round(w / scale), -127, 127).astype(np.int8)
+        quantized[layer + '_scale'] = scale
+        quantized[layer + '_biases'] = weights[layer + '_biases']
+    return (quantized, meta)
+
+def float32_weights(weights, meta):
+    """The float32 weights closest to those of a model of any precision."""
+    out = {}
+    for layer in LAYERS:
+        w = weights[layer + '_weights'].astype(np.float32)
+        if meta.get('precision') == 'int8':
+            w *= weights[layer + '_scale']
+        out[layer + '_weights'] = w
+        out[layer + '_biases'] = weights[layer + '_biases'].astype(np.float32)
+    return out
+
+def weights_bytes(weights):
+    return sum(w.nbytes for w in weights.values())
+
+def load_weights(filename):
+    """(arrays by name, meta) of an exported model."""
+    with np.load(filename) as f:
+        weights = dict((name, f[name]) for name in f.files if name != 'meta')
+        meta = json.loads(str(f['meta']))
+    return (weights, meta)
+
+def load_model(filename):
+    (weights, meta) = load_weights(filename)
+    return NumpyModel(weights, meta)
@@ -0,0 +1,130 @@
+"""
+Parallel image decoding and patch extraction with a process pool.
+The parent allocates the output arrays in shared memory before starting the
+workers; every worker decodes its images and writes the decoded pixels or the
+extracted patches straight into its slice of the shared array, so results are
+never pickled back to the parent.
+All images of one call must have the same shape.
+Worker processes are forked, which is only safe while the caller runs a single
+thread: a child forked next to a TensorFlow session or the prefetch threads of
+the input pipeline can deadlock on a lock that another thread held. Callers
+declare with threads_started() that such threads exist (tf_aerial_images does
+when it opens a session), after which the same work runs in a thread pool of
+the same size; PNG decoding and most of the extraction release the GIL.
+(Spawned or forkserver workers would re-import the main script, TensorFlow
+included, on every call.)
+"""
+
+import ctypes
+import multiprocessing
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+import matplotlib.image as mpimg
+import numpy as np
+
+from patch_extraction import extract_patches, extract_patch_labels, num_patches
+
+NUM_PROCESSES = multiprocessing.cpu_count()
+
+# Shared output arrays of the current call, set in every worker by init_worker
+shared_arrays = {}
+
+# Set by threads_started(), see can_fork()
+fork_unsafe = False
+
+def threads_started():
+    """Declares that the process now runs threads a forked child could
+    deadlock on; later calls use threads instead of processes.
+    """
+    global fork_unsafe
+    fork_unsafe = True
+
+def can_fork():
+    return hasattr(os, 'fork') and not fork_unsafe and threading.active_count() == 1
+
+def init_worker(buffers):
+    shared_arrays.clear()
+    shared_arrays.update(buffers)
+
+def shared_array(name):
+    (raw, shape, dtype) = shared_arrays[name]
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+def allocate(shape, dtype):
+    """A buffer in shared memory for an array of the given shape, and its view."""
+    dtype = np.dtype(dtype)
+    raw = multiprocessing.RawArray(ctypes.c_byte, max(1, int(np.prod(shape)) * dtype.itemsize))
+    return ((raw, shape, dtype), np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape))
+
+def read_image(filename, shape):
+    img = mpimg.imread(filename)
+    if img.shape != shape:
+        raise ValueError('%s has shape %s, expected %s' % (filename, img.shape, shape))
+    return img
+
+def decode_task(task):
+    (index, filename) = task
+    images = shared_array('images')
+    images[index] = read_image(filename, images.shape[1:])
+
+def extract_task(task):
+    (filename, begin, end, patch_size, stride, num_of_transformations) = task
+    data = shared_array('data')
+    img = read_image(filename, shared_arrays['image_shape'])
+    extract_patches(img, patch_size, stride, num_of_transformations, out=data[begin:end])
+
+def labels_task(task):
+    (filename, begin, end, patch_size, stride, num_of_transformations) = task
+    labels = shared_array('labels')
+    gt_img = read_image(filename, shared_arrays['image_shape'])
+    labels[begin:end] = extract_patch_labels(gt_img, patch_size, stride, num_of_transformations)
+
+def run(fn, tasks, buffers, num_processes):
+    if num_processes <= 1 or len(tasks) <= 1:
+        init_worker(buffers)
+        for task in tasks:
+            fn(task)
+        return
+    if can_fork():
+        # Explicitly forked, the workers inherit the shared arrays
+        context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+        pool = context.Pool(min(num_processes, len(tasks)), init_worker, (buffers,))
+    else:
+        init_worker(buffers)
+        pool = ThreadPool(min(num_processes, len(tasks)))
+    try:
+        pool.map(fn, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def decode_images(filenames, num_processes = NUM_PROCESSES):
+    """Decode the images into one array [image index, y, x(, channels)]."""
+    first = mpimg.imread(filenames[0])
+    (buffer, images) = allocate((len(filenames),) + first.shape, first.dtype)
+    images[0] = first
+    run(decode_task, list(enumerate(filenames))[1:], {'images': buffer}, num_processes)
+    return images
+
+def patch_tasks(filenames, img, patch_size, stride, num_of_transformations):
+    count = num_patches(img, patch_size, stride, num_of_transformations)
+    return [(filename, i * count, (i + 1) * count, patch_size, stride, num_of_transformations)
+            for (i, filename) in enumerate(filenames)]
+
+def extract_patches_parallel(filenames, patch_size, stride, num_of_transformations, num_processes = NUM_PROCESSES):
+    """Same result as extract_patches_from_images on the decoded images."""
+    first = mpimg.imread(filenames[0])
+    tasks = patch_tasks(filenames, first, patch_size, stride, num_of_transformations)
+    (buffer, data) = allocate((tasks[-1][2], patch_size, patch_size) + first.shape[2:], first.dtype)
+    run(extract_task, tasks, {'data': buffer, 'image_shape': first.shape}, num_processes)
+    return data
+
+def extract_labels_parallel(filenames, patch_size, stride, num_of_transformations, num_processes = NUM_PROCESSES):
+    """Same result as extract_labels_from_images on the decoded groundtruth images."""
+    first = mpimg.imread(filenames[0])
+    tasks = patch_tasks(filenames, first, patch_size, stride, num_of_transformations)
+    (buffer, labels) = allocate((tasks[-1][2], 2), np.float32)
+    run(labels_task, tasks, {'labels': buffer, 'image_shape': first.shape}, num_processes)
+    return labels
@@ -0,0 +1,163 @@
+"""
+Vectorized patch extraction for the road segmentation baseline.
+Patches are read through a strided view of the source image and written once
+into a preallocated array, so no per-patch Python objects are created.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Weights used to compute the gray level whose mean is removed from every patch
+GRAY_WEIGHTS = (0.2989, 0.5870, 0.1140)
+FOREGROUND_THRESHOLD = 0.25 # percentage of pixels > 1 required to assign a foreground label to a patch
+MAX_TRANSFORMATIONS = 4
+MEAN_CHUNK = 256 # Patches whose gray levels are computed at a time, bounds the temporaries
+
+# Number of patch positions along the two image axes
+def num_patch_positions(im, patch_size, stride):
+    n0 = (im.shape[0] - patch_size) // stride + 1
+    n1 = (im.shape[1] - patch_size) // stride + 1
+    return (max(n0, 0), max(n1, 0))
+
+def num_patches(im, patch_size, stride, num_of_transformations):
+    (n0, n1) = num_patch_positions(im, patch_size, stride)
+    return n0 * n1 * (1 + min(num_of_transformations, MAX_TRANSFORMATIONS))
+
+def patch_window_grid(im, patch_size, stride):
+    """Return a read-only view [axis 1 offset, axis 0 offset, patch_size, patch_size(, channels)] on im."""
+    (n0, n1) = num_patch_positions(im, patch_size, stride)
+    s0 = im.strides[0]
+    s1 = im.strides[1]
+    shape = (n1, n0, patch_size, patch_size) + im.shape[2:]
+    strides = (stride * s1, stride * s0, s0, s1) + im.strides[2:]
+    return as_strided(im, shape=shape, strides=strides, writeable=False)
+
+def patch_windows(im, patch_size, stride):
+    """Return the windows [position, patch_size, patch_size(, channels)] of im.
+    Positions are ordered like img_crop: the offset along axis 1 is the outer
+    loop and the offset along axis 0 the inner one. Overlapping windows cannot
+    be flattened into one view, so this is a copy; patch_window_grid is not.
+    """
+    grid = patch_window_grid(im, patch_size, stride)
+    return grid.reshape((grid.shape[0] * grid.shape[1],) + grid.shape[2:])
+
+def patch_means(patches):
+    """Mean gray level of every patch [..., y, x, channels], a batched
+    reduction over about MEAN_CHUNK patches at a time.
+    """
+    means = np.empty(patches.shape[:-3], dtype=patches.dtype)
+    step = max(1, MEAN_CHUNK * len(patches) // max(1, means.size))
+    for begin in range(0, len(patches), step):
+        # A contiguous chunk keeps the summation order, and so the means, of img_crop
+        chunk = np.ascontiguousarray(patches[begin:begin + step])
+        gray = GRAY_WEIGHTS[0]*chunk[...,0] + GRAY_WEIGHTS[1]*chunk[...,1] + GRAY_WEIGHTS[2]*chunk[...,2]
+        means[begin:begin + step] = gray.mean(axis=(-2, -1))
+    return means
+
+def subtract_patch_means(patches):
+    """Remove the mean gray level of every patch in place."""
+    patches -= patch_means(patches)[:, np.newaxis, np.newaxis, np.newaxis]
+
+def transformed_views(patches, num_of_transformations):
+    """Views of patches [..., y, x, channels]: the identity, then fliplr, flipud,
+    rot90 and rot180 (the order of augment_image), up to num_of_transformations.
+    """
+    views = [patches, patches[..., :, ::-1, :], patches[..., ::-1, :, :],
+             patches[..., :, ::-1, :].swapaxes(-3, -2), patches[..., ::-1, ::-1, :]]
+    return views[:1 + num_of_transformations]
+
+def extract_patches(im, patch_size, stride, num_of_transformations, out=None):
+    """Extract the mean-subtracted (and augmented) patches of an RGB image.
+    Returns an array [patch index, y, x, channels] laid out like the list built
+    by img_crop. If out is given, the patches are written into it instead.
+    The source image is never modified.
+    """
+    num_of_transformations = min(num_of_transformations, MAX_TRANSFORMATIONS)
+    grid = patch_window_grid(im, patch_size, stride)
+    (n1, n0) = grid.shape[:2]
+    k = 1 + num_of_transformations
+    if out is None:
+        out = np.empty((n1 * n0 * k,) + grid.shape[2:], dtype=im.dtype)
+    # The patches are centered while they are read from the windows of the
+    # image, so no uncentered copy is ever materialized
+    means = patch_means(grid)[..., np.newaxis, np.newaxis, np.newaxis]
+    slots = out.reshape((n1, n0, k) + grid.shape[2:])
+    np.subtract(grid, means, out=slots[:, :, 0])
+    # The copies are made row by row of positions, which bounds the temporary
+    # that numpy allocates for a source and target in the same array
+    for row in slots:
+        for (t, patches) in enumerate(transformed_views(row[:, 0], num_of_transformations)[1:], 1):
+            row[:, t] = patches
+    return out
+
+def patch_label_values(gt_im, patch_size, stride):
+    """Mean groundtruth value of every patch position."""
+    windows = np.ascontiguousarray(patch_windows(gt_im, patch_size, stride))
+    return windows.reshape(windows.shape[0], -1).mean(axis=1)
+
+def values_to_classes(values):
+    """Vectorized value_to_class: 1-hot [non-road, road] rows."""
+    road = values > FOREGROUND_THRESHOLD
+    labels = np.empty((len(values), 2), dtype=np.float32)
+    labels[:, 0] = ~road
+    labels[:, 1] = road
+    return labels
+
+def extract_patch_labels(gt_im, patch_size, stride, num_of_transformations):
+    """1-hot labels of the patches returned by extract_patches for the same image.
+    Flips and rotations do not change the mean, so every transformed copy
+    shares the label of its source patch.
+    """
+    k = 1 + min(num_of_transformations, MAX_TRANSFORMATIONS)
+    labels = values_to_classes(patch_label_values(gt_im, patch_size, stride))
+    return np.repeat(labels, k, axis=0)
+
+def extract_patches_from_images(imgs, patch_size, stride, num_of_transformations):
+    """Extract the patches of a list of images into one preallocated array."""
+    counts = [num_patches(im, patch_size, stride, num_of_transformations) for im in imgs]
+    data = np.empty((sum(counts), patch_size, patch_size) + imgs[0].shape[2:], dtype=imgs[0].dtype)
+    offset = 0
+    for (im, count) in zip(imgs, counts):
+        extract_patches(im, patch_size, stride, num_of_transformations, out=data[offset:offset + count])
+        offset += count
+    return data
+
+def extract_labels_from_images(gt_imgs, patch_size, stride, num_of_transformations):
+    return np.concatenate([extract_patch_labels(gt, patch_size, stride, num_of_transformations) for gt in gt_imgs])
+
+def transform_patches(patches, transformations):
+    """Apply augmentation number transformations[i] (0 = identity, then the
+    order of transformed_views) to patches[i], in place.
+    """
+    for t in range(1, MAX_TRANSFORMATIONS + 1):
+        selected = np.flatnonzero(transformations == t)
+        if len(selected) == 0:
+            continue
+        src = patches[selected]
+        if t == 1:
+            patches[selected] = src[:, :, ::-1]
+        elif t == 2:
+            patches[selected] = src[:, ::-1]
+        elif t == 3:
+            patches[selected] = src[:, :, ::-1].swapaxes(1, 2)
+        else:
+            patches[selected] = src[:, ::-1, ::-1]
+    return patches
+
+def pad_to_patches(im, patch_size):
+    """im padded at the far borders, by repeating its last pixels, to a whole
+    number of patches along both axes.
+    """
+    padding = ((0, -im.shape[0] % patch_size), (0, -im.shape[1] % patch_size)) + ((0, 0),) * (im.ndim - 2)
+    return np.pad(im, padding, mode='edge')
+
+def subtract_block_means(im, patch_size):
+    """Whole-image counterpart of extract_patches(im, patch_size, patch_size, 0).
+    Returns a copy of im cropped to whole blocks where every patch_size block
+    has its own mean gray level subtracted, i.e. the patches laid back in place.
+    """
+    (n0, n1) = num_patch_positions(im, patch_size, patch_size)
+    patches = extract_patches(im, patch_size, patch_size, 0)
+    blocks = patches.reshape((n1, n0, patch_size, patch_size) + im.shape[2:])
+    order = (1, 2, 0, 3) + tuple(range(4, blocks.ndim))
+    return blocks.transpose(order).reshape((n0 * patch_size, n1 * patch_size) + im.shape[2:])
@@ -0,0 +1,189 @@
+"""
+On-disk patch cache shared between training runs.
+Patches and labels are stored as one pair of .npy shards per source image and
+opened with mmap_mode='r', so processes on the same host share the page cache
+instead of each holding a private copy. A manifest records the extraction
+parameters and the hashes of the source files; shards that no longer match
+are re-extracted, the others are reused, and shards of other images or of
+other parameters are deleted. Files are written through unique temporary
+files, so concurrent syncs of the same store never clobber each other.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import matplotlib.image as mpimg
+import numpy as np
+
+from patch_extraction import extract_patches, extract_patch_labels
+from parallel_loading import NUM_PROCESSES, run
+
+MANIFEST_VERSION = 1
+MANIFEST_FILENAME = 'manifest.json'
+
+def file_hash(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def atomic_file(filename):
+    """(file object, temporary filename) to write filename through; the
+    temporary name is unique, so concurrent writers never share it.
+    """
+    (fd, tmp_filename) = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                                          prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    # mkstemp creates the file readable by its owner only
+    os.chmod(tmp_filename, 0o644)
+    return (os.fdopen(fd, 'wb'), tmp_filename)
+
+# Write through a temporary file so readers never see a partial shard
+def save_atomic(filename, array):
+    (f, tmp_filename) = atomic_file(filename)
+    with f:
+        np.save(f, array)
+    os.rename(tmp_filename, filename)
+
+def build_shard(task):
+    (data_filename, labels_filename, image_filename, gt_filename, patch_size, stride, num_of_transformations) = task
+    print('Extracting patches of ' + image_filename)
+    img = mpimg.imread(image_filename)
+    gt_img = mpimg.imread(gt_filename)
+    save_atomic(data_filename, extract_patches(img, patch_size, stride, num_of_transformations))
+    save_atomic(labels_filename, extract_patch_labels(gt_img, patch_size, stride, num_of_transformations))
+
+class PatchStore(object):
+    """Sharded, memory-mapped patch tensor [patch index, y, x, channels].
+    Indexing with an array of patch indices gathers them from the shards;
+    select() restricts the store to a subset without copying any patch.
+    """
+
+    def __init__(self, directory, patch_size, stride, num_of_transformations):
+        self.directory = directory
+        self.params = {'patch_size': patch_size,
+                       'stride': stride,
+                       'num_of_transformations': num_of_transformations}
+        self.shards = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.labels = np.zeros((0, 2), dtype=np.float32)
+        self.index = None
+
+    def manifest_filename(self):
+        return os.path.join(self.directory, MANIFEST_FILENAME)
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_filename()) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION or manifest.get('params') != self.params:
+            print('Patch store parameters changed, rebuilding all shards.')
+            return {}
+        return manifest.get('shards', {})
+
+    def write_manifest(self, shards):
+        manifest = {'version': MANIFEST_VERSION, 'params': self.params, 'shards': shards}
+        (f, tmp_filename) = atomic_file(self.manifest_filename())
+        with f:
+            f.write(json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+        os.rename(tmp_filename, self.manifest_filename())
+
+    def remove_stale_shards(self, shard_ids):
+        """Deletes the shards of the directory that are not in shard_ids, e.g.
+        left by other parameters or images; temporary files are left alone.
+        """
+        keep = set(f for shard_id in shard_ids for f in self.shard_filenames(shard_id))
+        for name in os.listdir(self.directory):
+            filename = os.path.join(self.directory, name)
+            if (name.startswith('patches_') or name.startswith('labels_')) and name.endswith('.npy') \
+                    and filename not in keep:
+                os.remove(filename)
+
+    def shard_filenames(self, shard_id):
+        return (os.path.join(self.directory, 'patches_' + shard_id + '.npy'),
+                os.path.join(self.directory, 'labels_' + shard_id + '.npy'))
+
+    def sync(self, image_filenames, gt_filenames, num_processes = NUM_PROCESSES):
+        """Bring the store up to date with the given source images and open it.
+        Only the shards whose source files or parameters changed are rebuilt,
+        in parallel over num_processes workers.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        old_shards = self.read_manifest()
+        shards = {}
+        order = []
+        tasks = []
+        for (image_filename, gt_filename) in zip(image_filenames, gt_filenames):
+            shard_id = os.path.splitext(os.path.basename(image_filename))[0]
+            entry = {'image': image_filename,
+                     'image_sha1': file_hash(image_filename),
+                     'groundtruth': gt_filename,
+                     'groundtruth_sha1': file_hash(gt_filename)}
+            existing = all(os.path.isfile(f) for f in self.shard_filenames(shard_id))
+            if not existing or old_shards.get(shard_id) != entry:
+                p = self.params
+                tasks.append(self.shard_filenames(shard_id) + (image_filename, gt_filename,
+                             p['patch_size'], p['stride'], p['num_of_transformations']))
+            shards[shard_id] = entry
+            order.append(shard_id)
+        run(build_shard, tasks, {}, num_processes)
+
+        self.remove_stale_shards(order)
+        self.write_manifest(shards)
+        self.open(order)
+        return self
+
+    def open(self, shard_ids):
+        self.shards = []
+        labels = []
+        for shard_id in shard_ids:
+            (data_filename, labels_filename) = self.shard_filenames(shard_id)
+            self.shards.append(np.load(data_filename, mmap_mode='r'))
+            labels.append(np.load(labels_filename))
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.labels = np.concatenate(labels)
+        self.index = None
+
+    def select(self, indices):
+        """Return a store restricted to the given patch indices (no patch is copied)."""
+        subset = PatchStore.__new__(PatchStore)
+        subset.__dict__.update(self.__dict__)
+        indices = np.asarray(indices)
+        subset.index = indices if self.index is None else self.index[indices]
+        subset.labels = self.labels[indices]
+        return subset
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def shape(self):
+        return (len(self),) + self.shards[0].shape[1:]
+
+    @property
+    def dtype(self):
+        return self.shards[0].dtype
+
+    def __getitem__(self, key):
+        # Accepts train_data[indices] as well as train_data[indices, :, :, :]
+        if isinstance(key, tuple):
+            key = key[0]
+        if isinstance(key, slice):
+            indices = np.arange(*key.indices(len(self)))
+        else:
+            indices = np.asarray(key)
+        if self.index is not None:
+            indices = self.index[indices]
+        scalar = np.ndim(indices) == 0
+        indices = np.atleast_1d(indices)
+        shard_of = np.searchsorted(self.offsets, indices, side='right') - 1
+        out = np.empty((len(indices),) + self.shards[0].shape[1:], dtype=self.dtype)
+        for shard_id in np.unique(shard_of):
+            selected = np.flatnonzero(shard_of == shard_id)
+            out[selected] = self.shards[shard_id][indices[selected] - self.offsets[shard_id]]
+        return out[0] if scalar else out
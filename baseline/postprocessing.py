@@ -0,0 +1,69 @@
+"""
+Postprocessing filters for patch masks.
+Every filter takes a stack of binary patch masks [mask index, row, column] and
+returns the filtered stack, so many images are processed in one call. A
+pipeline is a list of (filter name, parameters) pairs, e.g.
+    [('isolated', {}), ('median', {'size': 3})]
+"""
+
+import numpy as np
+import scipy.ndimage
+
+def remove_isolated(masks):
+    """Vectorized set_to_zero_if_no_neighbours.
+    A road patch whose 4 neighbours are all background becomes background, and
+    a background patch surrounded by road becomes road. The original updates
+    the mask in place in row-major order, so a patch sees the new values of its
+    upper and left neighbours; this is reproduced exactly by sweeping the
+    anti-diagonals, every sweep being a vectorized step over all masks.
+    """
+    masks = np.array(masks, copy=True)
+    (_, height, width) = masks.shape
+    for d in range(2, height + width - 3):
+        i = np.arange(max(1, d - (width - 2)), min(height - 2, d - 1) + 1)
+        j = d - i
+        center = masks[:, i, j]
+        neighbours = np.stack((masks[:, i + 1, j], masks[:, i - 1, j], masks[:, i, j + 1], masks[:, i, j - 1]))
+        no_road = np.all(neighbours == 0, axis=0)
+        all_road = np.all(neighbours == 1, axis=0)
+        center = np.where((center == 1) & no_road, 0, center)
+        center = np.where((center == 0) & all_road, 1, center)
+        masks[:, i, j] = center
+    return masks
+
+def median(masks, size=3):
+    return scipy.ndimage.median_filter(masks, size=(1, size, size), mode='nearest')
+
+def opening(masks, size=3):
+    """Removes road structures thinner than size patches."""
+    return scipy.ndimage.grey_opening(masks, size=(1, size, size), mode='nearest')
+
+def closing(masks, size=3):
+    """Fills background gaps narrower than size patches."""
+    return scipy.ndimage.grey_closing(masks, size=(1, size, size), mode='nearest')
+
+def remove_small_components(masks, min_size=4):
+    """Removes 4-connected road components smaller than min_size patches."""
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = scipy.ndimage.generate_binary_structure(2, 1)
+    (components, _) = scipy.ndimage.label(masks == 1, structure=structure)
+    sizes = np.bincount(components.ravel())
+    small = sizes < min_size
+    small[0] = False
+    out = np.array(masks, copy=True)
+    out[small[components]] = 0
+    return out
+
+FILTERS = {
+    'isolated': remove_isolated,
+    'median': median,
+    'opening': opening,
+    'closing': closing,
+    'components': remove_small_components,
+}
+
+def postprocess_masks(masks, pipeline):
+    """Runs the filters of the pipeline, in order, over a stack of patch masks."""
+    for (name, params) in pipeline:
+        masks = FILTERS[name](masks, **params)
+    return masks
@@ -0,0 +1,117 @@
+"""
+Fast-startup prediction from a model exported by export_model.py.
+Only NumPy and PIL are imported up front; the default backend is the NumPy
+forward pass of numpy_inference.py, so no TensorFlow import, graph
+construction or checkpoint restore stands between the start and the first
+mask. --backend tf runs the same weights through TensorFlow instead, and
+scipy is only imported when the postprocessing pipeline needs it.
+float16 and int8 models (export_model.py --precision) are smaller files, not
+faster ones: the NumPy backend rounds to their precision but computes in
+float32 (see numpy_inference.py) and the TensorFlow backend runs their
+float32 equivalent.
+
+For every image, the pixel mask of the patch labels is saved as
+<output dir>/mask_<name>.png; --submission also writes the submission rows of
+all images (image ids are the first number of the file names).
+
+Usage: python predict.py model.npz image.png [image.png ...] [--output-dir predictions/]
+                         [--submission submission.csv] [--backend numpy|tf] [--batch-size 256]
+"""
+
+import time
+START = time.time()
+
+import argparse
+import os
+import re
+import sys
+
+import numpy as np
+from PIL import Image
+
+from numpy_inference import BATCH_SIZE, float32_weights, load_weights, NumpyModel
+from patch_extraction import extract_patches, pad_to_patches
+
+OUTPUT_DIR = 'predictions/'
+
+def read_png(filename):
+    # As matplotlib reads 8 bit PNG files
+    return np.asarray(Image.open(filename).convert('RGB'), dtype=np.float32) / 255
+
+def tf_predict_function(weights, meta, batch_size):
+    """predict(patches) running the exported weights through model.py."""
+    import tensorflow as tf
+    from model import PatchModel
+    patch_size = meta['patch_size']
+    graph = tf.Graph()
+    with graph.as_default():
+        net = PatchModel(patch_size, meta['num_channels'], meta['num_labels'], conv_sizes=meta['conv_sizes'],
+                         conv_depths=meta['conv_depths'], fc_depth=meta['fc_depth'])
+        patches_node = tf.placeholder(tf.float32, shape=(None, patch_size, patch_size, meta['num_channels']))
+        prediction = tf.nn.softmax(net.model(patches_node))
+        assign_ops = [getattr(net, name).assign(value) for (name, value) in weights.items()]
+    session = tf.Session(graph=graph)
+    session.run(assign_ops)
+    def predict(patches):
+        return np.concatenate([session.run(prediction, feed_dict={patches_node: patches[begin:begin + batch_size]})
+                               for begin in range(0, len(patches), batch_size)])
+    return predict
+
+def image_labels(predict, img, patch_size, postprocessing):
+    """Patch labels [patch row, patch column] of an image."""
+    img = pad_to_patches(img, patch_size)
+    predictions = predict(extract_patches(img, patch_size, patch_size, 0))
+    # Patches go down the rows first, then along the columns
+    (rows, cols) = (img.shape[0] // patch_size, img.shape[1] // patch_size)
+    labels = (~(predictions[:, 0] > 0.5)).reshape(cols, rows).T.astype(np.uint8)
+    if postprocessing:
+        from postprocessing import postprocess_masks
+        labels = postprocess_masks(labels[np.newaxis], postprocessing)[0]
+    return labels
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Predict masks with an exported model.')
+    parser.add_argument('model', help='.npz written by export_model.py; float16 and int8 only save size')
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR)
+    parser.add_argument('--submission', help='also write the submission rows of the images to this file')
+    parser.add_argument('--backend', default='numpy', choices=['numpy', 'tf'])
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='patches per forward pass')
+    args = parser.parse_args(argv[1:])
+
+    (weights, meta) = load_weights(args.model)
+    if args.backend == 'tf':
+        predict = tf_predict_function(float32_weights(weights, meta), meta, args.batch_size)
+    else:
+        model = NumpyModel(weights, meta)
+        predict = lambda patches: model.predict(patches, args.batch_size)
+    patch_size = meta['patch_size']
+    postprocessing = [(name, params) for (name, params) in meta['postprocessing']]
+    print('Model loaded in %.3f s (%s backend, %s)' % (time.time() - START, args.backend, meta.get('precision', 'float32')))
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    submission = []
+    for (i, filename) in enumerate(args.images):
+        img = read_png(filename)
+        labels = image_labels(predict, img, patch_size, postprocessing)
+        mask = np.repeat(np.repeat(labels, patch_size, axis=0), patch_size, axis=1)[:img.shape[0], :img.shape[1]]
+        name = os.path.splitext(os.path.basename(filename))[0]
+        Image.fromarray(mask * 255).save(os.path.join(args.output_dir, 'mask_' + name + '.png'))
+        if i == 0:
+            print('Time to first mask: %.3f s' % (time.time() - START))
+        if args.submission:
+            submission.append((int(re.search(r"\d+", name).group(0)), labels))
+
+    if args.submission:
+        from mask_to_submission import labels_to_submission_text
+        with open(args.submission, 'w') as f:
+            f.write('id,prediction\n')
+            for (image_id, labels) in submission:
+                f.write(labels_to_submission_text(labels, image_id, patch_size))
+        print('Submission written to %s' % args.submission)
+    print('%d masks written to %s in %.3f s' % (len(args.images), args.output_dir, time.time() - START))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,112 @@
+"""
+On-disk cache of per-patch probabilities.
+An entry is keyed by the digest of the checkpoint weights, the digest of the
+image pixels, the patch size and the inference mode, so reruns that only
+change e.g. the postprocessing reuse the model outputs of earlier runs, and a
+retrained model or a changed image never hits a stale entry.
+Every entry is one .npy file of float32 probabilities [patch, label]. When the
+files exceed max_bytes the least recently used ones are deleted; recency is
+the file modification time, which a hit refreshes, so it is kept across runs.
+"""
+
+import glob
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from instrumentation import count
+
+MAX_BYTES = 256 * 1024 * 1024
+
+def checkpoint_digest(checkpoint):
+    """Digest of the weight files of a checkpoint (V1 file or V2 index and data),
+    None if there are none.
+    """
+    filenames = sorted(set(glob.glob(checkpoint) + glob.glob(checkpoint + '.index') +
+                           glob.glob(checkpoint + '.data-*')))
+    if not filenames:
+        return None
+    digest = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def image_digest(img):
+    img = np.ascontiguousarray(img)
+    digest = hashlib.sha1(('%s %s ' % (img.dtype.str, img.shape)).encode('ascii'))
+    digest.update(img.data)
+    return digest.hexdigest()
+
+def cache_key(checkpoint, img, patch_size, mode):
+    """Key of the predictions of img; checkpoint is a checkpoint_digest()."""
+    text = '%s %s %d %s' % (checkpoint, image_digest(img), patch_size, mode)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+class PredictionCache(object):
+    """Least recently used entries of directory, up to max_bytes. Safe to use
+    from several threads; processes sharing a directory only ever see complete
+    files.
+    """
+
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # key -> file size, least recently used first
+        self.entries = OrderedDict()
+        filenames = glob.glob(os.path.join(directory, '*.npy'))
+        for filename in sorted(filenames, key=os.path.getmtime):
+            self.entries[os.path.basename(filename)[:-4]] = os.path.getsize(filename)
+        self.total_bytes = sum(self.entries.values())
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        """The cached predictions of key, None on a miss."""
+        with self.lock:
+            if key not in self.entries:
+                count('prediction_cache_misses')
+                return None
+            self.entries[key] = self.entries.pop(key)
+        try:
+            predictions = np.load(self.filename(key))
+            os.utime(self.filename(key), None)
+        except (IOError, OSError, ValueError):
+            # Evicted or being replaced by another process
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+            count('prediction_cache_misses')
+            return None
+        count('prediction_cache_hits')
+        return predictions
+
+    def put(self, key, predictions):
+        filename = self.filename(key)
+        tmp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+        with open(tmp_filename, 'wb') as f:
+            np.save(f, np.asarray(predictions, dtype=np.float32))
+        os.rename(tmp_filename, filename)
+        size = os.path.getsize(filename)
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                (old, old_size) = self.entries.popitem(last=False)
+                self.total_bytes -= old_size
+                try:
+                    os.remove(self.filename(old))
+                except OSError:
+                    pass
+                count('prediction_cache_evictions')
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes}
@@ -0,0 +1,34 @@
+"""
+Conversions between per-patch predictions, patch masks and pixel masks.
+Predictions are [patch index, label] arrays (softmax outputs or 1-hot rows);
+a patch is labelled road when its non-road probability is not above 0.5.
+"""
+
+import numpy as np
+
+# Patch mask [height, width] from predictions, filled row by row
+def prediction_to_mask(labels, width, height):
+    road = ~(np.asarray(labels)[:height * width, 0] > 0.5)
+    return road.reshape(height, width).astype(np.float64)
+
+# 1-hot predictions from a patch mask, read row by row
+def mask_to_prediction(mask):
+    road = np.asarray(mask).ravel() == 1
+    prediction = np.empty((len(road), 2))
+    prediction[:, 0] = ~road
+    prediction[:, 1] = road
+    return prediction
+
+# Convert array of labels to an image
+def label_to_img(imgwidth, imgheight, w, h, labels):
+    """Pixel mask [imgwidth, imgheight] with one w x h block per label.
+    Labels go down axis 0 first, then along axis 1, like the patches of
+    extract_patches; blocks at the far border are cropped.
+    """
+    n0 = -(-imgwidth // w)
+    n1 = -(-imgheight // h)
+    road = ~(np.asarray(labels)[:n0 * n1, 0] > 0.5)
+    grid = road.reshape(n1, n0).T
+    array_labels = np.empty((n0, w, n1, h))
+    array_labels[...] = grid[:, np.newaxis, :, np.newaxis]
+    return array_labels.reshape(n0 * w, n1 * h)[:imgwidth, :imgheight]
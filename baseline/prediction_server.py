@@ -0,0 +1,297 @@
+"""
+Local prediction service.
+Loads the checkpoint once and serves patch predictions of PNG tiles over HTTP,
+on a TCP port or on a Unix socket. The patches of concurrent requests are
+grouped by a DynamicBatcher into shared model runs: a run starts once it holds
+max_batch_size patches or max_wait seconds after its first request arrived,
+whichever comes first.
+
+Endpoints:
+    POST /predict?format=mask|labels|rows[&image_id=N]   body: PNG image
+        mask    PNG pixel mask, one block per patch label (image/png)
+        labels  JSON patch labels [patch row][patch column]
+        rows    submission rows of the image, as mask_to_submission.py
+    GET /stats    request latency percentiles, throughput and batch sizes
+    GET /health
+
+Images that are not a multiple of the patch size are padded by repeating their
+last pixels. The service always runs the patchwise model, as it batches the
+patches of several requests together: configurations with fcn_inference or
+test-time augmentation are refused at startup. Latency percentiles cover the
+last LATENCY_WINDOW requests, so the memory of a long-lived server stays
+bounded. See load_generator.py to measure throughput and tail latency.
+
+Usage: python prediction_server.py [--port 8000 | --socket server.sock]
+                                   [--max-batch-size 4096] [--max-wait-ms 5] [--train_dir=tmp/]
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import time
+try:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import urlparse, parse_qs
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+import instrumentation
+from instrumentation import timer, count
+from mask_to_submission import labels_to_submission_text
+from patch_extraction import extract_patches, pad_to_patches
+from postprocessing import postprocess_masks
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8000
+MAX_BATCH_SIZE = 4096 # Patches per shared model run
+MAX_WAIT = 0.005 # Seconds a model run waits for more requests
+LATENCY_WINDOW = 100000 # Latest durations per stage behind the /stats percentiles
+
+class DynamicBatcher(object):
+    """Runs predict(patches) in one thread on the concatenated patches of the
+    requests submitted meanwhile. submit() blocks until the predictions of its
+    patches are ready.
+    """
+
+    def __init__(self, predict, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, patches):
+        request = {'patches': patches, 'done': threading.Event()}
+        self.queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['predictions']
+
+    def next_requests(self):
+        """The requests of the next model run, None once closed."""
+        first = self.queue.get()
+        if first is None:
+            return None
+        requests = [first]
+        size = len(first['patches'])
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # Serve what is there, then stop
+                self.queue.put(None)
+                break
+            requests.append(request)
+            size += len(request['patches'])
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self.next_requests()
+            if requests is None:
+                return
+            sizes = [len(request['patches']) for request in requests]
+            try:
+                with timer('server_batch'):
+                    predictions = self.predict(np.concatenate([request['patches'] for request in requests]))
+                for (request, prediction) in zip(requests, np.split(predictions, np.cumsum(sizes)[:-1])):
+                    request['predictions'] = prediction
+            except Exception as e:
+                for request in requests:
+                    request['error'] = e
+            count('server_batches')
+            count('server_batched_requests', len(requests))
+            count('server_batched_patches', sum(sizes))
+            for request in requests:
+                request['done'].set()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+class PredictionService(object):
+    """Decoding, batched prediction and encoding of the answers."""
+
+    FORMATS = ('mask', 'labels', 'rows')
+
+    def __init__(self, config, batcher):
+        if config.fcn_inference or config.tta_stride > 0 or config.tta_augmentations > 0:
+            raise ValueError('The service only runs the patchwise model, '
+                             'disable fcn_inference, tta_stride and tta_augmentations')
+        self.config = config
+        self.batcher = batcher
+        self.started = time.time()
+
+    def decode(self, body):
+        try:
+            img = Image.open(io.BytesIO(body)).convert('RGB')
+        except (IOError, OSError, SyntaxError) as e:
+            raise ValueError('Cannot decode the image: %s' % e)
+        # As matplotlib reads 8 bit PNG files
+        return np.asarray(img, dtype=np.float32) / 255
+
+    def labels(self, img):
+        """Postprocessed patch labels [patch row, patch column] of an image."""
+        patch_size = self.config.img_patch_size
+        img = pad_to_patches(img, patch_size)
+        predictions = self.batcher.submit(extract_patches(img, patch_size, patch_size, 0))
+        # Patches go down the rows first, then along the columns
+        (rows, cols) = (img.shape[0] // patch_size, img.shape[1] // patch_size)
+        labels = (~(predictions[:, 0] > 0.5)).reshape(cols, rows).T.astype(np.uint8)
+        if self.config.postprocessing:
+            labels = postprocess_masks(labels[np.newaxis], self.config.postprocessing)[0]
+        return labels
+
+    def predict(self, body, output_format='mask', image_id=1):
+        """(content, content type) of the answer to a prediction request."""
+        if output_format not in PredictionService.FORMATS:
+            raise ValueError('Unknown format %r, expected one of %s' % (output_format, ', '.join(PredictionService.FORMATS)))
+        img = self.decode(body)
+        labels = self.labels(img)
+        count('server_patches', labels.size)
+        patch_size = self.config.img_patch_size
+        if output_format == 'labels':
+            return (json.dumps({'patch_size': patch_size, 'labels': labels.tolist()}).encode('utf-8'), 'application/json')
+        if output_format == 'rows':
+            return (labels_to_submission_text(labels, image_id, patch_size).encode('utf-8'), 'text/csv')
+        mask = np.repeat(np.repeat(labels, patch_size, axis=0), patch_size, axis=1)[:img.shape[0], :img.shape[1]]
+        out = io.BytesIO()
+        Image.fromarray(mask * 255).save(out, format='PNG')
+        return (out.getvalue(), 'image/png')
+
+    def stats(self):
+        uptime = time.time() - self.started
+        counters = instrumentation.default.counter_values()
+        batches = counters.get('server_batches', 0)
+        return {'uptime_s': uptime,
+                'requests': counters.get('server_requests', 0),
+                'errors': counters.get('server_errors', 0),
+                'requests_per_sec': counters.get('server_requests', 0) / uptime,
+                'patches_per_sec': counters.get('server_patches', 0) / uptime,
+                'request_latency': instrumentation.default.stage_summary('server_request'),
+                'batch_latency': instrumentation.default.stage_summary('server_batch'),
+                'batches': batches,
+                'requests_per_batch': counters.get('server_batched_requests', 0) / float(max(1, batches)),
+                'patches_per_batch': counters.get('server_batched_patches', 0) / float(max(1, batches)),
+                'max_batch_size': self.batcher.max_batch_size,
+                'max_wait_s': self.batcher.max_wait}
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, content, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            self.reply(200, b'ok\n')
+        elif path == '/stats':
+            self.reply(200, json.dumps(self.server.service.stats(), indent=2, sort_keys=True).encode('utf-8'),
+                       'application/json')
+        else:
+            self.reply(404, b'Not found\n')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/predict':
+            self.reply(404, b'Not found\n')
+            return
+        query = parse_qs(url.query)
+        try:
+            with timer('server_request'):
+                (content, content_type) = self.server.service.predict(body, query.get('format', ['mask'])[0],
+                                                                      int(query.get('image_id', ['1'])[0]))
+        except ValueError as e:
+            count('server_errors')
+            self.reply(400, (str(e) + '\n').encode('utf-8'))
+            return
+        except Exception as e:
+            count('server_errors')
+            self.reply(500, ('%s: %s\n' % (type(e).__name__, e)).encode('utf-8'))
+            return
+        count('server_requests')
+        self.reply(200, content, content_type)
+
+    # Unix socket clients have no address
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, host=SERVER_HOST, port=SERVER_PORT, socket_path=None, verbose=False):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, PredictionHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+def main(argv):
+    import tf_aerial_images
+    parser = argparse.ArgumentParser(description='Local prediction service.')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--socket', help='serve on this Unix socket instead of a TCP port')
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE, help='patches per model run')
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT * 1000, help='wait for more requests')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args(argv[1:])
+
+    # One model run evaluates a whole batch
+    config = tf_aerial_images.Config(inference_batch_size=args.max_batch_size)
+    instrumentation.default.window = LATENCY_WINDOW
+    predictor = tf_aerial_images.Predictor.from_checkpoint(config)
+    batcher = DynamicBatcher(lambda patches: predictor.engine.predict(predictor.session, patches),
+                             args.max_batch_size, args.max_wait_ms / 1000.0)
+    server = make_server(PredictionService(config, batcher), args.host, args.port, args.socket, args.verbose)
+    print('Serving %s on %s' % (config.train_dir, args.socket or 'http://%s:%d' % (args.host, args.port)))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        predictor.close()
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -1,17 +1,16 @@
 #!/usr/bin/python
 import os
 import sys
-import Image
-import math
+from PIL import Image
 import matplotlib.image as mpimg
 import numpy as np
 
+from instrumentation import timed
+
 label_file = 'dummy_submission.csv'
 
 h = 16
 w = h
-imgwidth = int(math.ceil((600.0/w))*w)
-imgheight = int(math.ceil((600.0/h))*h)
 nc = 3
 
 # Convert an array of binary labels to a uint8
@@ -19,36 +18,82 @@ def binary_to_uint8(img):
     rimg = (img * 255).round().astype(np.uint8)
     return rimg
 
-def reconstruct_from_labels(image_id):
-    im = np.zeros((imgwidth, imgheight), dtype=np.uint8)
-    f = open(label_file)
-    lines = f.readlines()
-    image_id_str = '%.3d_' % image_id
-    for i in range(1, len(lines)):
-        line = lines[i]
-        if not image_id_str in line:
-            continue
-
-        tokens = line.split(',')
-        id = tokens[0]
-        prediction = int(tokens[1])
-        tokens = id.split('_')
-        i = int(tokens[1])
-        j = int(tokens[2])
-
-        je = min(j+w, imgwidth)
-        ie = min(i+h, imgheight)
-        if prediction == 0:
-            adata = np.zeros((w,h))
-        else:
-            adata = np.ones((w,h))
-
-        im[j:je, i:ie] = binary_to_uint8(adata)
+class Submission(object):
+    """A submission file parsed once into labels[image, patch row, patch column].
+    The array is as large as the largest grid of the file; grid_shapes holds
+    the (patch rows, patch columns) of every image, which the labels and masks
+    of an image are cropped to. Masks are only upsampled when they are asked
+    for, one image at a time."""
+
+    @timed('submission_parsing')
+    def __init__(self, filename, delimiter=',', patch_size=h):
+        self.patch_size = patch_size
+        with open(filename) as f:
+            f.readline()
+            text = f.read()
+        # Every line is "<image>_<x>_<y><delimiter><label>"
+        tokens = text.replace('_', ' ').replace(delimiter, ' ').split()
+        rows = np.array(tokens, dtype=np.int64).reshape(-1, 4)
+        (self.image_ids, image_idx) = np.unique(rows[:, 0], return_inverse=True)
+        patch_cols = rows[:, 1] // patch_size
+        patch_rows = rows[:, 2] // patch_size
+        self.labels = np.zeros((len(self.image_ids), patch_rows.max() + 1, patch_cols.max() + 1), dtype=np.uint8)
+        self.labels[image_idx, patch_rows, patch_cols] = rows[:, 3]
+        self.grid_shapes = np.zeros((len(self.image_ids), 2), dtype=np.int64)
+        np.maximum.at(self.grid_shapes, image_idx, np.stack((patch_rows, patch_cols), axis=1) + 1)
+
+    def image_labels(self, image_id):
+        """Patch labels of one image, [patch row, patch column]."""
+        idx = np.searchsorted(self.image_ids, image_id)
+        if idx == len(self.image_ids) or self.image_ids[idx] != image_id:
+            raise KeyError('Image %d is not in the submission' % image_id)
+        (grid_rows, grid_cols) = self.grid_shapes[idx]
+        return self.labels[idx, :grid_rows, :grid_cols]
+
+    @timed('submission_mask')
+    def mask(self, image_id, width=None, height=None):
+        """Binary mask [height, width] of one image, one block per patch label.
+        By default the mask covers the patch grid of the image."""
+        labels = self.image_labels(image_id)
+        if width is None:
+            width = labels.shape[1] * self.patch_size
+        if height is None:
+            height = labels.shape[0] * self.patch_size
+        mask = np.repeat(np.repeat(labels, self.patch_size, axis=0), self.patch_size, axis=1)
+        out = np.zeros((height, width), dtype=np.uint8)
+        rows = min(height, mask.shape[0])
+        cols = min(width, mask.shape[1])
+        out[:rows, :cols] = mask[:rows, :cols]
+        return out
+
+    def masks(self, image_ids=None, width=None, height=None):
+        """Yields (image_id, mask) for the given images, or for all of them."""
+        if image_ids is None:
+            image_ids = self.image_ids
+        for image_id in image_ids:
+            yield (image_id, self.mask(image_id, width, height))
+
+    def diff(self, other):
+        """Number of differing patch labels per image id, for images in both
+        submissions. Patches that only one of the two grids has count as differing."""
+        counts = {}
+        for i in np.intersect1d(self.image_ids, other.image_ids):
+            (labels, other_labels) = (self.image_labels(i), other.image_labels(i))
+            (rows, cols) = (min(labels.shape[0], other_labels.shape[0]), min(labels.shape[1], other_labels.shape[1]))
+            outside = labels.size + other_labels.size - 2 * rows * cols
+            counts[int(i)] = int(np.sum(labels[:rows, :cols] != other_labels[:rows, :cols])) + outside
+        return counts
+
+def reconstruct_from_labels(image_id, submission=None):
+    if submission is None:
+        submission = Submission(label_file)
+    im = binary_to_uint8(submission.mask(image_id))
 
     Image.fromarray(im).save('prediction_' + '%.3d' % image_id + '.png')
 
     return im
 
-for i in range(1, 5):
-    reconstruct_from_labels(i)
-   
\ No newline at end of file
+if __name__ == '__main__':
+    submission = Submission(label_file)
+    for i in range(1, 5):
+        reconstruct_from_labels(i, submission)
@@ -0,0 +1,201 @@
+"""
+Parallel hyperparameter sweep on one CPU host.
+Every configuration of SWEEP is a short training job (see BASE_SETTINGS). Jobs
+run in NUM_WORKERS processes; the cores are split between them through the
+intra/inter-op thread pools of their TensorFlow sessions. The patch store of
+every (patch size, stride) is built once, before the workers start, and the
+workers read it through memory maps, so the extraction is shared.
+
+Every job is validated on the same held-out images (the last
+validation_images of BASE_SETTINGS, never trained on), labelled on the 16
+pixel submission grid whatever the patch size or class balancing of the job,
+so their errors compare; see Trainer.validate.
+
+Weak configurations stop early: after every periodic validation, a job whose
+error is above the median error the other jobs had at the same step (by more
+than EARLY_STOP_MARGIN percentage points) stops, once at least
+EARLY_STOP_MIN_REPORTS jobs reported for that step.
+
+The final validation error, F1 and throughput of every job are written as a
+ranked leaderboard.
+
+Usage: python sweep.py [--workers N] [--steps N] [--time-per-job SECONDS]
+                       [--output sweep/leaderboard.json] [--quick]
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+import instrumentation
+import tf_aerial_images
+from tf_aerial_images import Config, DataCache, Trainer, load_training_patches
+
+# Values of every swept setting, all combinations are run
+SWEEP = {
+    'img_patch_size': [8, 16, 24],
+    'img_patch_stride': [8, 16],
+    'conv_sizes': [(9, 7, 3), (5, 5, 3)],
+    'balance_size_of_classes': [True, False],
+}
+QUICK_SWEEP = {
+    'img_patch_size': [16],
+    'img_patch_stride': [8, 16],
+    'conv_sizes': [(9, 7, 3), (5, 5, 3)],
+}
+
+# Settings shared by every job of the sweep
+BASE_SETTINGS = {
+    'restore_model': False,
+    'terminate_after_time': True,
+    'img_patches_restore': True,
+    'stream_patches': False,
+    'validate': True,
+    'validation_images': 20,
+    'validation_grid': 16,
+    'validation_step': 200,
+    'recording_step': 200,
+    'visualize_prediction_on_training_set': False,
+    'run_on_test_set': False,
+    'np_seed': 201,
+}
+
+SWEEP_DIR = 'sweep/'
+NUM_WORKERS = 2
+STEPS_PER_JOB = 2000
+TIME_PER_JOB = 600 # seconds
+EARLY_STOP_MARGIN = 2.0 # percentage points above the median error
+EARLY_STOP_MIN_REPORTS = 3
+
+# Per worker process state, set by init_worker
+worker_state = {}
+
+def job_name(params):
+    return '_'.join('%s=%s' % (name, '-'.join(str(v) for v in value) if isinstance(value, (tuple, list)) else value)
+                    for (name, value) in sorted(params.items()))
+
+def sweep_jobs(sweep):
+    names = sorted(sweep)
+    return [dict(zip(names, values)) for values in itertools.product(*[sweep[name] for name in names])]
+
+def thread_split(num_workers, num_cores):
+    """(intra-op, inter-op) threads of every worker so that the workers share the cores."""
+    intra = max(1, num_cores // num_workers)
+    return (intra, 1 if intra <= 2 else 2)
+
+class EarlyStopping(object):
+    """Median rule over the validation errors the jobs report at the same step.
+    reports is a dict shared between processes, step -> list of errors.
+    """
+
+    def __init__(self, reports, lock, margin=EARLY_STOP_MARGIN, min_reports=EARLY_STOP_MIN_REPORTS):
+        self.reports = reports
+        self.lock = lock
+        self.margin = margin
+        self.min_reports = min_reports
+
+    def __call__(self, step, confusion):
+        error = confusion.error_rate()
+        with self.lock:
+            others = list(self.reports.get(step, []))
+            self.reports[step] = others + [error]
+        if len(others) < self.min_reports:
+            return False
+        return error > np.median(others) + self.margin
+
+def init_worker(reports, lock, threads):
+    worker_state['early_stopping'] = EarlyStopping(reports, lock)
+    worker_state['threads'] = threads
+    # Jobs of one worker with the same patch settings reuse the loaded patches
+    worker_state['cache'] = DataCache()
+
+def job_settings(params, steps, time_per_job, threads=(0, 0)):
+    name = job_name(params)
+    settings = dict(BASE_SETTINGS)
+    settings.update(params)
+    settings.update({'max_steps': steps, 'max_training_time_in_sec': time_per_job,
+                     'intra_op_threads': threads[0], 'inter_op_threads': threads[1],
+                     'train_dir': os.path.join(SWEEP_DIR, name),
+                     'run_report': os.path.join(SWEEP_DIR, name, 'run_report.json')})
+    return (name, settings)
+
+def run_job(job):
+    (params, steps, time_per_job) = job
+    (name, settings) = job_settings(params, steps, time_per_job, worker_state['threads'])
+    if not os.path.isdir(settings['train_dir']):
+        os.makedirs(settings['train_dir'])
+    config = Config(**settings)
+    instrumentation.default.reset()
+    start = time.time()
+    trainer = Trainer(config, worker_state['cache'])
+    try:
+        trainer.load_data()
+        trainer.train(on_validation=worker_state['early_stopping'])
+        confusion = trainer.validate()
+    finally:
+        trainer.close()
+    report = tf_aerial_images.write_run_report(config)
+    return {'name': name, 'params': params, 'validation_error': confusion.error_rate(), 'f1': confusion.f1(),
+            'steps': trainer.total_steps, 'stopped_early': trainer.stopped_early,
+            'history': trainer.validation_history, 'time_s': time.time() - start,
+            'examples_per_sec': report['throughput']['train_examples_per_sec']}
+
+def prepare_patch_stores(jobs):
+    """Builds the patch store of every (patch size, stride) once, in this process."""
+    keys = sorted(set((params['img_patch_size'], params['img_patch_stride']) for (params, _, _) in jobs))
+    for (patch_size, stride) in keys:
+        print('Preparing patches: size %d, stride %d' % (patch_size, stride))
+        load_training_patches(Config(img_patches_restore=True, img_patch_size=patch_size, img_patch_stride=stride,
+                                     validation_images=BASE_SETTINGS['validation_images']))
+
+def write_leaderboard(results, filename):
+    ranked = sorted(results, key=lambda r: (r['validation_error'], -r['f1']))
+    with open(filename, 'w') as f:
+        json.dump(ranked, f, indent=2, sort_keys=True, default=str)
+    print('%4s %-75s %8s %7s %7s %6s' % ('rank', 'configuration', 'error', 'F1', 'steps', 'early'))
+    for (rank, r) in enumerate(ranked, 1):
+        print('%4d %-75s %7.2f%% %7.4f %7d %6s' % (rank, r['name'], r['validation_error'], r['f1'], r['steps'],
+                                                  'yes' if r['stopped_early'] else ''))
+    print('Leaderboard written to %s' % filename)
+    return ranked
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Parallel hyperparameter sweep.')
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS)
+    parser.add_argument('--steps', type=int, default=STEPS_PER_JOB, help='training steps per job')
+    parser.add_argument('--time-per-job', type=float, default=TIME_PER_JOB, help='training time budget per job')
+    parser.add_argument('--output', default=os.path.join(SWEEP_DIR, 'leaderboard.json'))
+    parser.add_argument('--quick', action='store_true', help='run QUICK_SWEEP')
+    args = parser.parse_args(argv[1:])
+
+    if not os.path.isdir(SWEEP_DIR):
+        os.makedirs(SWEEP_DIR)
+    jobs = [(params, args.steps, args.time_per_job) for params in sweep_jobs(QUICK_SWEEP if args.quick else SWEEP)]
+    print('%d jobs on %d workers' % (len(jobs), args.workers))
+    prepare_patch_stores(jobs)
+
+    threads = thread_split(args.workers, multiprocessing.cpu_count())
+    print('Threads per worker: %d intra-op, %d inter-op' % threads)
+    manager = multiprocessing.Manager()
+    reports = manager.dict()
+    lock = manager.Lock()
+    pool = multiprocessing.Pool(args.workers, init_worker, (reports, lock, threads))
+    results = []
+    try:
+        for result in pool.imap_unordered(run_job, jobs):
+            print('Finished %s: error %.2f%% after %d steps' % (result['name'], result['validation_error'], result['steps']))
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    write_leaderboard(results, args.output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,65 @@
+"""
+Test-time augmentation on the patch grid.
+The patchwise model sees every patch_size cell of the submission grid once, in
+its own crop. Here the model is run on overlapping windows, stride pixels
+apart as the training patches are, and on the flips and rotations of every
+window (in augment_image order). The probabilities of the augmentations of a
+window are averaged, then every grid cell gets the mean of the windows that
+overlap it, weighted by the number of pixels they share.
+
+Everything is done on whole arrays: one call to extract_patches gives the
+windows and their augmentations, the averaging onto the grid is a product
+with the per-axis overlap matrices. The cost per image grows with
+(patch_size / stride) ** 2 * (1 + num_augmentations) model evaluations.
+"""
+
+import numpy as np
+
+from patch_extraction import MAX_TRANSFORMATIONS, extract_patches
+
+def check_stride(patch_size, stride):
+    if stride < 1 or stride > patch_size:
+        raise ValueError('Window stride %d must be between 1 and the patch size %d' % (stride, patch_size))
+
+# Number of windows along an axis of length pixels, as num_patch_positions
+def num_windows(length, patch_size, stride):
+    return max((length - patch_size) // stride + 1, 0)
+
+def overlap_weights(length, patch_size, stride):
+    """[grid cell, window] number of pixels that the patch_size cells of an axis
+    of length pixels share with the windows starting every stride pixels.
+    """
+    cells = np.arange(length // patch_size)[:, np.newaxis] * patch_size
+    windows = np.arange(num_windows(length, patch_size, stride))[np.newaxis, :] * stride
+    overlap = np.minimum(cells, windows) + patch_size - np.maximum(cells, windows)
+    return np.maximum(overlap, 0).astype(np.float64)
+
+def average_on_grid(window_predictions, shape, patch_size, stride):
+    """Per-cell probabilities, in the patch order of extract_patches(img, patch_size,
+    patch_size, 0), from the probabilities of the windows of an image of the given
+    shape, in the order of extract_patches(img, patch_size, stride, 0).
+    """
+    w0 = overlap_weights(shape[0], patch_size, stride)
+    w1 = overlap_weights(shape[1], patch_size, stride)
+    num_labels = window_predictions.shape[1]
+    # Windows go down axis 0 first, then along axis 1
+    windows = window_predictions.reshape(w1.shape[1], w0.shape[1], num_labels)
+    grid = np.einsum('bj,ai,jil->bal', w1, w0, windows)
+    norm = w1.sum(axis=1)[:, np.newaxis] * w0.sum(axis=1)[np.newaxis, :]
+    return (grid / norm[:, :, np.newaxis]).reshape(-1, num_labels)
+
+def predict_with_tta(predict, img, patch_size, stride, num_augmentations):
+    """Per-patch probabilities of img on the patch_size grid.
+    predict maps a batch of mean-subtracted patches to probabilities.
+    """
+    check_stride(patch_size, stride)
+    num_augmentations = min(num_augmentations, MAX_TRANSFORMATIONS)
+    predictions = predict(extract_patches(img, patch_size, stride, num_augmentations))
+    # The augmentations of a window are consecutive
+    predictions = predictions.reshape(-1, 1 + num_augmentations, predictions.shape[1]).mean(axis=1)
+    return average_on_grid(predictions, img.shape, patch_size, stride)
+
+def num_evaluations(shape, patch_size, stride, num_augmentations):
+    """Number of patches predict_with_tta evaluates for an image of the given shape."""
+    return (num_windows(shape[0], patch_size, stride) * num_windows(shape[1], patch_size, stride)
+            * (1 + min(num_augmentations, MAX_TRANSFORMATIONS)))
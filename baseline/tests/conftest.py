@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules of the baseline are scripts in the parent directory
+BASELINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASELINE_DIR)
@@ -0,0 +1,36 @@
+"""Index sampling of the balancing modes."""
+
+import numpy as np
+import pytest
+
+from class_balancing import BALANCING_MODES, IndexSampler
+
+def one_hot(classes):
+    return np.eye(2)[classes]
+
+LABELS = one_hot((np.random.RandomState(0).rand(500) < 0.2).astype(int))
+
+@pytest.mark.parametrize('mode', BALANCING_MODES)
+def test_validation_indices_are_distinct(mode):
+    sampler = IndexSampler(LABELS, mode, seed=3)
+    indices = sampler.distinct(300)
+    assert len(np.unique(indices)) == len(indices)
+    assert np.all(np.diff(indices) > 0)
+    if mode == 'weighted':
+        # A weighted epoch repeats patches, so fewer distinct ones may exist
+        assert 0 < len(indices) <= 300
+    else:
+        assert len(indices) == min(300, sampler.size)
+
+def test_truncate_keeps_the_first_patches_of_every_class():
+    sampler = IndexSampler(LABELS, 'truncate')
+    classes = np.argmax(LABELS, 1)
+    min_c = np.bincount(classes).min()
+    for c in range(2):
+        assert np.array_equal(sampler.indices[classes[sampler.indices] == c], np.flatnonzero(classes == c)[:min_c])
+
+@pytest.mark.parametrize('mode', BALANCING_MODES)
+def test_numbered_epochs_are_reproducible(mode):
+    (a, b) = (IndexSampler(LABELS, mode, seed=5), IndexSampler(LABELS, mode, seed=5))
+    b.epoch()
+    assert np.array_equal(a.epoch(2), b.epoch(2))
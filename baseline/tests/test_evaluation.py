@@ -0,0 +1,49 @@
+"""Whole-image validation on a common label grid."""
+
+import numpy as np
+import pytest
+
+from evaluation import evaluate_images
+from mask_to_submission import patch_labels
+
+def groundtruth(seed, size=96):
+    rng = np.random.RandomState(seed)
+    gt = np.zeros((size, size), dtype=np.float32)
+    for i in range(3):
+        row = rng.randint(0, size - 8)
+        gt[row:row + 8] = 1
+        col = rng.randint(0, size - 8)
+        gt[:, col:col + 8] = 1
+    return gt
+
+IMGS = [np.random.RandomState(i).rand(96, 96, 3).astype(np.float32) for i in range(3)]
+TRUTH = [patch_labels(groundtruth(i), 16) for i in range(3)]
+
+def constant(road):
+    return lambda patches: np.tile([[0.0, 1.0]] if road else [[1.0, 0.0]], (len(patches), 1))
+
+def test_perfect_predictions_have_no_error():
+    # Patch labels in the order of extract_patches: down axis 0 first
+    labels = iter(np.concatenate([truth.T.ravel() for truth in TRUTH]))
+    def oracle(patches):
+        road = np.array([next(labels) for i in range(len(patches))])
+        return np.column_stack((1 - road, road)).astype(np.float32)
+    confusion = evaluate_images(oracle, IMGS, TRUTH, 16, 16, 10)
+    assert confusion.total == sum(truth.size for truth in TRUTH)
+    assert confusion.error_rate() == 0
+
+@pytest.mark.parametrize('patch_size', [8, 16, 24, 40])
+def test_the_grid_does_not_depend_on_the_patch_size(patch_size):
+    road = np.mean(np.concatenate([truth.ravel() for truth in TRUTH]))
+    for (prediction, error) in [(False, 100 * road), (True, 100 * (1 - road))]:
+        confusion = evaluate_images(constant(prediction), IMGS, TRUTH, patch_size, 16, 7)
+        assert confusion.total == 3 * 36
+        assert abs(confusion.error_rate() - error) < 1e-9
+
+def test_batches_are_bounded():
+    sizes = []
+    def predict(patches):
+        sizes.append(len(patches))
+        return constant(False)(patches)
+    evaluate_images(predict, IMGS, TRUTH, 8, 16, 50)
+    assert max(sizes) <= 50 and sum(sizes) == 3 * 144
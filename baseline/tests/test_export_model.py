@@ -0,0 +1,22 @@
+"""The int8 calibration patches never come from the held-out images."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+import tf_aerial_images
+import export_model
+
+def test_calibration_reads_only_images_trained_on(monkeypatch):
+    read = []
+    def read_images(filenames, num_processes):
+        read.extend(filenames)
+        return np.random.RandomState(0).rand(len(filenames), 64, 64, 3).astype(np.float32)
+    monkeypatch.setattr(tf_aerial_images, 'read_images', read_images)
+    monkeypatch.setattr(tf_aerial_images, 'image_filenames', lambda dirname, num: ['%d' % i for i in range(1, num + 1)])
+    config = tf_aerial_images.Config(train_dir='tmp/', training_size=10, validation_images=4, img_patch_size=16,
+                                     img_patch_stride=16, num_transformations=0)
+    patches = export_model.calibration_data(config, 20, 3)
+    assert len(read) == 3 and all(int(name) <= 6 for name in read)
+    assert patches.shape == (20, 16, 16, 3)
+    assert np.array_equal(patches, export_model.calibration_data(config, 20, 3))
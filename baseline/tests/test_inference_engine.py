@@ -0,0 +1,41 @@
+"""The inference graph is built once: serving predictions never adds ops."""
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from model import PatchModel
+from tf_aerial_images import InferenceEngine
+
+PATCH_SIZE = 16
+
+def test_op_count_constant_across_calls():
+    graph = tf.Graph()
+    with graph.as_default():
+        net = PatchModel(PATCH_SIZE, conv_depths=(8, 8, 8), fc_depth=16)
+        engine = InferenceEngine(net.model, net.model_fcn, PATCH_SIZE, batch_size=32)
+        init = tf.initialize_all_variables()
+    with tf.Session(graph=graph) as session:
+        session.run(init)
+        num_ops = len(graph.get_operations())
+        rng = np.random.RandomState(0)
+        for num_patches in (1, 31, 32, 100):
+            predictions = engine.predict(session, rng.rand(num_patches, PATCH_SIZE, PATCH_SIZE, 3).astype(np.float32))
+            assert predictions.shape == (num_patches, 2)
+        for size in (32, 48):
+            predictions = engine.predict_image(session, rng.rand(size, size, 3).astype(np.float32))
+            assert predictions.shape == ((size // PATCH_SIZE) ** 2, 2)
+        assert len(graph.get_operations()) == num_ops
+
+def test_finalized_graph_serves_predictions():
+    graph = tf.Graph()
+    with graph.as_default():
+        net = PatchModel(PATCH_SIZE, conv_depths=(8, 8, 8), fc_depth=16)
+        engine = InferenceEngine(net.model, net.model_fcn, PATCH_SIZE, batch_size=8)
+        init = tf.initialize_all_variables()
+    graph.finalize()
+    with tf.Session(graph=graph) as session:
+        session.run(init)
+        predictions = engine.predict(session, np.zeros((20, PATCH_SIZE, PATCH_SIZE, 3), dtype=np.float32))
+        assert np.allclose(predictions.sum(axis=1), 1, atol=1e-5)
@@ -0,0 +1,44 @@
+"""Nested stages are reported with their exclusive time."""
+
+import time
+
+from instrumentation import Instrumentation
+
+def test_nested_stages_are_not_double_counted():
+    instrumentation = Instrumentation()
+    with instrumentation.timer('outer'):
+        time.sleep(0.02)
+        with instrumentation.timer('inner'):
+            time.sleep(0.03)
+    stages = instrumentation.report()['stages']
+    assert stages['inner']['within'] == ['outer']
+    assert 'within' not in stages['outer']
+    assert stages['outer']['total_s'] >= stages['inner']['total_s'] + 0.02
+    assert abs(stages['outer']['exclusive_s'] + stages['inner']['exclusive_s'] - stages['outer']['total_s']) < 1e-9
+    assert stages['inner']['exclusive_s'] == stages['inner']['total_s']
+
+def test_reentered_stage_is_timed_once():
+    instrumentation = Instrumentation()
+    @instrumentation.timed('decode')
+    def decode(depth):
+        return decode(depth - 1) if depth else None
+    decode(3)
+    assert instrumentation.stage_summary('decode')['count'] == 1
+
+def test_rate():
+    instrumentation = Instrumentation()
+    instrumentation.record('step', 2.0)
+    instrumentation.count('examples', 10)
+    assert instrumentation.rate('examples', 'step') == 5.0
+    assert instrumentation.rate('examples', 'missing') == 0.0
+
+def test_window_bounds_the_kept_durations():
+    instrumentation = Instrumentation(window=100)
+    for i in range(1000):
+        instrumentation.record('request', float(i))
+    assert len(instrumentation.durations['request']) < 200
+    summary = instrumentation.stage_summary('request')
+    assert summary['count'] == 1000
+    assert summary['total_s'] == sum(range(1000))
+    # Percentiles of the last 100 calls
+    assert summary['p50_ms'] == 949.5 * 1000
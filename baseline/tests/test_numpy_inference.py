@@ -0,0 +1,43 @@
+"""The int8 products of the NumPy forward pass stay within their rounding bound."""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from numpy_inference import WEIGHT_NAMES, NumpyModel, conv2d_relu, quantize
+
+def integer_conv(data, weights):
+    """conv2d of integer arrays with 'SAME' padding, accumulated in int64."""
+    (k0, k1, channels, depth) = weights.shape
+    (n, height, width, _) = data.shape
+    padded = np.pad(data, ((0, 0), ((k0 - 1) // 2, k0 // 2), ((k1 - 1) // 2, k1 // 2), (0, 0)), mode='constant')
+    s = padded.strides
+    windows = as_strided(padded, shape=(n, height, width, k0, k1, channels), strides=(s[0], s[1], s[2], s[1], s[2], s[3]))
+    return np.dot(windows.reshape(-1, k0 * k1 * channels), weights.reshape(-1, depth)).reshape(n, height, width, depth)
+
+def test_conv2_sized_int8_products_are_within_the_float32_bound():
+    # The largest sums of the model: 7*7*128 products of up to 255*127
+    rng = np.random.RandomState(0)
+    data = rng.randint(200, 256, (2, 8, 8, 128)).astype(np.int64)
+    weights = rng.randint(100, 128, (7, 7, 128, 4)).astype(np.int64)
+    expected = integer_conv(data, weights)
+    assert expected.max() > 2 ** 24
+    out = conv2d_relu(data.astype(np.float32), weights.astype(np.float32), np.zeros(4, dtype=np.float32))
+    # All the products are positive, so the sum of their absolute values is expected
+    assert np.all(np.abs(out - expected) <= 7 * 7 * 128 * 2.0 ** -24 * expected)
+
+def test_int8_model_runs_in_float32():
+    rng = np.random.RandomState(1)
+    shapes = {'conv1_weights': (9, 9, 3, 8), 'conv2_weights': (7, 7, 8, 8), 'conv3_weights': (3, 3, 8, 8),
+              'fc1_weights': (2 * 2 * 8, 16), 'fc2_weights': (16, 2)}
+    weights = dict((name, (rng.randn(*shapes[name]) * 0.1 if name in shapes
+                           else rng.randn(shapes[name.replace('biases', 'weights')][-1]) * 0.01).astype(np.float32))
+                   for name in WEIGHT_NAMES)
+    meta = {'patch_size': 16}
+    patches = rng.rand(20, 16, 16, 3).astype(np.float32) - 0.5
+    (reduced, reduced_meta) = quantize(weights, meta, 'int8', patches)
+    model = NumpyModel(reduced, reduced_meta)
+    assert model.weights['conv2_weights'].dtype == np.float32
+    predictions = model.predict(patches)
+    reference = NumpyModel(weights, meta).predict(patches)
+    assert np.allclose(predictions.sum(1), 1, atol=1e-5)
+    assert np.mean(np.argmax(predictions, 1) == np.argmax(reference, 1)) >= 0.8
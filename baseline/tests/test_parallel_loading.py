@@ -0,0 +1,30 @@
+"""Forked processes and the thread fallback give the serial result."""
+
+import glob
+import os
+
+import numpy as np
+import pytest
+
+import parallel_loading
+from parallel_loading import decode_images, extract_patches_parallel
+
+FILES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'data', 'training', 'images', '*.png')))[:4]
+
+@pytest.fixture
+def fork_unsafe():
+    saved = parallel_loading.fork_unsafe
+    yield
+    parallel_loading.fork_unsafe = saved
+
+@pytest.mark.skipif(len(FILES) < 4, reason='training images not available')
+@pytest.mark.parametrize('threads', [False, True])
+def test_pools_match_the_serial_extraction(threads, fork_unsafe):
+    expected = extract_patches_parallel(FILES, 16, 8, 2, 1)
+    parallel_loading.fork_unsafe = threads
+    assert np.array_equal(extract_patches_parallel(FILES, 16, 8, 2, 3), expected)
+    assert np.array_equal(decode_images(FILES, 3), decode_images(FILES, 1))
+
+def test_threads_started_disables_forking(fork_unsafe):
+    parallel_loading.threads_started()
+    assert not parallel_loading.can_fork()
@@ -0,0 +1,52 @@
+"""The vectorized patch extraction keeps the patch order and values of img_crop."""
+
+import numpy as np
+import pytest
+
+import patch_extraction
+from bench_patch_extraction import legacy_extract_data, legacy_extract_labels
+from prediction_masks import label_to_img
+
+# The reference subtracts the means through np.matrix
+pytestmark = pytest.mark.filterwarnings('ignore::PendingDeprecationWarning')
+
+@pytest.mark.parametrize('patch_size,stride,num_of_transformations', [
+    (16, 16, 0), (16, 16, 4), (16, 8, 4), (8, 4, 2), (12, 5, 1)])
+def test_patches_match_img_crop(patch_size, stride, num_of_transformations):
+    rng = np.random.RandomState(patch_size + stride)
+    # Non-square images catch swapped axes
+    imgs = [rng.rand(48, 64, 3).astype(np.float32), rng.rand(40, 40, 3).astype(np.float32)]
+    originals = [img.copy() for img in imgs]
+    fast = patch_extraction.extract_patches_from_images(imgs, patch_size, stride, num_of_transformations)
+    reference = legacy_extract_data([img.copy() for img in imgs], patch_size, stride, num_of_transformations,
+                                    copy_patches=True)
+    assert fast.shape == reference.shape
+    assert np.array_equal(fast, reference)
+    # The source images are never modified
+    for (img, original) in zip(imgs, originals):
+        assert np.array_equal(img, original)
+
+@pytest.mark.parametrize('patch_size,stride,num_of_transformations', [(16, 16, 0), (16, 8, 4), (8, 4, 2)])
+def test_labels_match_img_crop(patch_size, stride, num_of_transformations):
+    rng = np.random.RandomState(0)
+    gt_imgs = [(rng.rand(48, 64) > 0.6).astype(np.float32), rng.rand(40, 40).astype(np.float32)]
+    assert np.array_equal(patch_extraction.extract_labels_from_images(gt_imgs, patch_size, stride, num_of_transformations),
+                          legacy_extract_labels(gt_imgs, patch_size, stride, num_of_transformations))
+
+def test_patch_order_matches_label_to_img():
+    # Patches labelled as a checkerboard from their own position render back as that checkerboard
+    (height, width, patch_size) = (48, 80, 16)
+    corners = patch_extraction.patch_windows(np.arange(height * width).reshape(height, width), patch_size, patch_size)[:, 0, 0]
+    (rows, cols) = divmod(corners, width)
+    road = (rows // patch_size + cols // patch_size) % 2 == 1
+    img = np.zeros((height, width, 3), dtype=np.float32)
+    assert len(patch_extraction.extract_patches(img, patch_size, patch_size, 0)) == len(road)
+    mask = label_to_img(height, width, patch_size, patch_size, np.column_stack((~road, road)))
+    (pixel_rows, pixel_cols) = np.indices((height, width)) // patch_size
+    assert np.array_equal(mask, (pixel_rows + pixel_cols) % 2 == 1)
+
+def test_block_means_are_patches_in_place():
+    rng = np.random.RandomState(0)
+    img = rng.rand(48, 80, 3).astype(np.float32)
+    blocks = patch_extraction.subtract_block_means(img, 16)
+    assert np.array_equal(patch_extraction.patch_windows(blocks, 16, 16), patch_extraction.extract_patches(img, 16, 16, 0))
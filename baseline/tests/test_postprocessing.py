@@ -0,0 +1,41 @@
+"""The batched 'isolated' filter is set_to_zero_if_no_neighbours."""
+
+import numpy as np
+import pytest
+
+from bench_postprocessing import legacy_set_to_zero_if_no_neighbours
+from postprocessing import postprocess_masks, remove_isolated
+
+@pytest.mark.parametrize('shape', [(25, 25), (38, 38), (3, 17), (17, 3), (1, 5), (2, 2)])
+@pytest.mark.parametrize('density', [0.1, 0.5, 0.9])
+def test_isolated_filter_matches_original_loop(shape, density):
+    rng = np.random.RandomState(int(density * 10) + shape[0] * 100 + shape[1])
+    masks = (rng.rand(5, *shape) < density).astype(np.float64)
+    reference = np.asarray([legacy_set_to_zero_if_no_neighbours(mask.copy()) for mask in masks])
+    assert np.array_equal(remove_isolated(masks), reference)
+
+def test_filters_do_not_modify_their_input():
+    masks = (np.random.RandomState(0).rand(3, 20, 20) < 0.5).astype(np.float64)
+    original = masks.copy()
+    postprocess_masks(masks, [('isolated', {}), ('median', {'size': 3}), ('closing', {'size': 2}),
+                              ('components', {'min_size': 4})])
+    assert np.array_equal(masks, original)
+
+def test_batch_equals_one_mask_at_a_time():
+    masks = (np.random.RandomState(1).rand(4, 20, 30) < 0.4).astype(np.float64)
+    pipeline = [('isolated', {}), ('opening', {'size': 2}), ('components', {'min_size': 3})]
+    assert np.array_equal(postprocess_masks(masks, pipeline),
+                          np.concatenate([postprocess_masks(mask[np.newaxis], pipeline) for mask in masks]))
+
+def test_predictor_postprocesses_all_images_at_once():
+    tf_aerial_images = pytest.importorskip('tf_aerial_images')
+    from prediction_masks import prediction_to_mask, mask_to_prediction
+    pipeline = [('isolated', {}), ('components', {'min_size': 3})]
+    config = tf_aerial_images.Config(img_patch_size=16, postprocessing=pipeline, train_dir='tmp/')
+    predictor = tf_aerial_images.Predictor(config, None, None)
+    rng = np.random.RandomState(2)
+    imgs = [np.zeros(shape) for shape in [(320, 320, 3), (480, 320, 3), (320, 320, 3)]]
+    predictions = [rng.rand(img.shape[0] * img.shape[1] // 256, 2) for img in imgs]
+    for (img, prediction, postprocessed) in zip(imgs, predictions, predictor.postprocess_predictions(imgs, predictions)):
+        mask = prediction_to_mask(prediction, img.shape[0] // 16, img.shape[1] // 16)
+        assert np.array_equal(postprocessed, mask_to_prediction(postprocess_masks(mask[np.newaxis], pipeline)[0]))
@@ -0,0 +1,42 @@
+"""Property tests of the vectorized mask conversions against the original loops."""
+
+import numpy as np
+import pytest
+
+import prediction_masks
+from bench_prediction_masks import (legacy_label_to_img, legacy_mask_to_prediction, legacy_prediction_to_mask,
+                                    random_predictions)
+
+SEEDS = range(20)
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_prediction_to_mask(seed):
+    rng = np.random.RandomState(seed)
+    (width, height) = rng.randint(1, 50, 2)
+    # Extra rows beyond the grid are ignored by both
+    labels = random_predictions(rng, width * height + rng.randint(0, 3))
+    assert np.array_equal(prediction_masks.prediction_to_mask(labels, width, height),
+                          legacy_prediction_to_mask(labels, width, height))
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_mask_to_prediction(seed):
+    rng = np.random.RandomState(seed)
+    mask = rng.randint(0, 3, rng.randint(1, 50, 2)).astype(np.float64)
+    assert np.array_equal(prediction_masks.mask_to_prediction(mask), legacy_mask_to_prediction(mask))
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_label_to_img(seed):
+    rng = np.random.RandomState(seed)
+    (w, h) = rng.randint(1, 20, 2)
+    (imgwidth, imgheight) = rng.randint(1, 200, 2)
+    labels = random_predictions(rng, (-(-imgwidth // w)) * (-(-imgheight // h)))
+    assert np.array_equal(prediction_masks.label_to_img(imgwidth, imgheight, w, h, labels),
+                          legacy_label_to_img(imgwidth, imgheight, w, h, labels))
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_mask_round_trip(seed):
+    rng = np.random.RandomState(seed)
+    (width, height) = rng.randint(1, 40, 2)
+    mask = rng.randint(0, 2, (height, width)).astype(np.float64)
+    prediction = prediction_masks.mask_to_prediction(mask)
+    assert np.array_equal(prediction_masks.prediction_to_mask(prediction, width, height), mask)
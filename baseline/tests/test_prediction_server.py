@@ -0,0 +1,12 @@
+"""The prediction service refuses the inference modes it does not run."""
+
+import pytest
+
+pytest.importorskip('tensorflow')
+import tf_aerial_images
+from prediction_server import PredictionService
+
+@pytest.mark.parametrize('settings', [{'fcn_inference': True}, {'tta_stride': 8}, {'tta_augmentations': 2}])
+def test_unsupported_inference_modes_are_refused(settings):
+    with pytest.raises(ValueError):
+        PredictionService(tf_aerial_images.Config(train_dir='tmp/', **settings), None)
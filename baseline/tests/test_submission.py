@@ -0,0 +1,61 @@
+"""Submission files round-trip through write_submission and Submission."""
+
+import os
+
+import numpy as np
+import pytest
+
+from bench_submission import legacy_masks_to_submission
+from mask_to_submission import patch_labels, write_submission
+from submission_to_mask import Submission
+
+def random_masks(rng, num_masks, size):
+    # Patch-wise masks with some noise, so that partial patches exercise the threshold
+    labels = rng.rand(num_masks, size // 16 + 1, size // 16 + 1) < 0.3
+    masks = np.repeat(np.repeat(labels, 16, axis=1), 16, axis=2)[:, :size, :size].astype(np.float32)
+    return np.where(rng.rand(*masks.shape) < 0.1, 1 - masks, masks)
+
+@pytest.mark.parametrize('size', [400, 608])
+def test_write_submission_matches_original_encoder(tmpdir, size):
+    masks = random_masks(np.random.RandomState(size), 3, size)
+    (fast, legacy) = (str(tmpdir.join('fast.csv')), str(tmpdir.join('legacy.csv')))
+    write_submission(fast, masks, [1, 7, 12])
+    legacy_masks_to_submission(legacy, masks, [1, 7, 12])
+    with open(fast) as f, open(legacy) as g:
+        assert f.read() == g.read()
+
+@pytest.mark.parametrize('patch_size', [8, 16])
+def test_submission_round_trip(tmpdir, patch_size):
+    masks = random_masks(np.random.RandomState(patch_size), 4, 400)
+    filename = str(tmpdir.join('submission.csv'))
+    write_submission(filename, masks, [3, 1, 2, 10], patch_size)
+    submission = Submission(filename, patch_size=patch_size)
+    assert list(submission.image_ids) == [1, 2, 3, 10]
+    for (image_id, mask) in zip([3, 1, 2, 10], masks):
+        labels = patch_labels(mask, patch_size)
+        assert np.array_equal(submission.image_labels(image_id), labels)
+        # The upsampled labels encode to the same rows again
+        assert np.array_equal(patch_labels(submission.mask(image_id, 400, 400), patch_size), labels)
+
+def test_missing_image(tmpdir):
+    filename = str(tmpdir.join('submission.csv'))
+    write_submission(filename, random_masks(np.random.RandomState(0), 1, 400), [5])
+    with pytest.raises(KeyError):
+        Submission(filename).image_labels(4)
+
+def test_images_of_different_sizes(tmpdir):
+    rng = np.random.RandomState(3)
+    (small, large) = (random_masks(rng, 1, 400)[0], random_masks(rng, 1, 608)[0])
+    filename = str(tmpdir.join('submission.csv'))
+    write_submission(filename, [large, small], [1, 2])
+    submission = Submission(filename)
+    assert submission.image_labels(1).shape == (38, 38)
+    assert submission.image_labels(2).shape == (25, 25)
+    assert np.array_equal(submission.image_labels(2), patch_labels(small, 16))
+    assert submission.mask(2).shape == (400, 400)
+    assert [mask.shape for (_, mask) in submission.masks()] == [(608, 608), (400, 400)]
+    # The same images, the second one cropped: only its own patches compare
+    other_filename = str(tmpdir.join('other.csv'))
+    write_submission(other_filename, [large, large[:400, :400]], [1, 2])
+    expected = int(np.sum(patch_labels(large[:400, :400], 16) != patch_labels(small, 16)))
+    assert Submission(other_filename).diff(submission) == {1: 0, 2: expected}
@@ -0,0 +1,19 @@
+"""PIL rasters keep Pillow's decompression bomb guard for the rest of the process."""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip('tensorflow')
+from tiled_inference import PilRaster
+
+def test_pil_raster_restores_the_pillow_limit(tmp_path):
+    filename = str(tmp_path / 'raster.png')
+    Image.fromarray(np.zeros((40, 60, 3), dtype=np.uint8)).save(filename)
+    default_max_pixels = Image.MAX_IMAGE_PIXELS
+    raster = PilRaster(filename, max_pixels=10 ** 9)
+    assert raster.shape == (40, 60)
+    assert Image.MAX_IMAGE_PIXELS == default_max_pixels
+    with pytest.raises(ValueError):
+        PilRaster(filename, max_pixels=1000)
+    assert Image.MAX_IMAGE_PIXELS == default_max_pixels
@@ -1,8 +1,17 @@
 """
 Baseline for CIL project on road segmentation.
 This simple baseline consits of a CNN with two convolutional+pooling layers with a soft-max loss
+
+The constants below are the defaults of Config. Runs can also be driven from
+Python, e.g. in a sweep that shares the decoded images and patch stores:
+    cache = DataCache()
+    trainer = Trainer(Config(batch_size=128, restore_model=False), cache)
+    trainer.load_data()
+    trainer.train()
+    predictor = trainer.predictor()
 """
 
+import copy
 import gzip
 import os
 import sys
@@ -10,16 +19,32 @@ import urllib
 import matplotlib.image as mpimg
 from PIL import Image
 
-import csv
 import time
 import code
 import tensorflow.python.platform
 import numpy as np
 import tensorflow as tf
 import math
+import multiprocessing
 import scipy
 import scipy.signal
 
+from patch_extraction import extract_patches, extract_patches_from_images, subtract_block_means, num_patches
+from parallel_loading import decode_images, extract_patches_parallel, extract_labels_parallel, threads_started
+from input_pipeline import PatchSampler, IndexedBatchSource, BatchPrefetcher
+from patch_store import PatchStore
+from class_balancing import IndexSampler, class_histogram
+from mask_to_submission import patch_labels, write_submission
+from prediction_masks import prediction_to_mask, mask_to_prediction, label_to_img
+from postprocessing import postprocess_masks
+from test_time_augmentation import predict_with_tta
+from prediction_cache import PredictionCache, cache_key, checkpoint_digest
+from model import PatchModel, CONV_SIZES, CONV_DEPTHS, FC_DEPTH # Defaults of conv_sizes, conv_depths and fc_depth
+from checkpointing import CheckpointManager
+from evaluation import evaluate, evaluate_images
+import instrumentation
+from instrumentation import timer, timed, count
+
 NUM_CHANNELS = 3 # RGB images
 PIXEL_DEPTH = 255
 NUM_LABELS = 2
@@ -28,167 +53,117 @@ SEED = 201
 NP_SEED = int(time.time());
 BATCH_SIZE = 64 # 64
 BALANCE_SIZE_OF_CLASSES = True
+BALANCING_MODE = 'truncate' # 'truncate' (first patches of every class, as originally), 'stratified' or 'weighted', see class_balancing.py
 
 RESTORE_MODEL = True # If True, restore existing model instead of training a new one
 TERMINATE_AFTER_TIME = True
 NUM_EPOCHS = 1
 MAX_TRAINING_TIME_IN_SEC = 2 * 28800
 RECORDING_STEP = 1000
+MAX_STEPS = 0 # If > 0, stop training after this many steps
+INTRA_OP_THREADS = 0 # Threads of one TensorFlow op, 0 lets TensorFlow choose
+INTER_OP_THREADS = 0 # TensorFlow ops run concurrently, 0 lets TensorFlow choose
+CHECKPOINT_EVERY_STEPS = 5000 # Save a resumable checkpoint every this many steps (0 to disable)
+CHECKPOINT_EVERY_SECS = 600 # ... and every this many seconds of training (0 to disable)
+CHECKPOINTS_TO_KEEP = 3 # Number of most recent resumable checkpoints kept in train_dir
+RESUME_TRAINING = True # If True, training continues from the latest resumable checkpoint, see checkpointing.py
 
 # Set image patch size
 # IMG_PATCH_SIZE should be a multiple of 4
 # image size should be an integer multiple of this number!
-IMG_PATCHES_RESTORE = True
+IMG_PATCHES_RESTORE = True # If True, use the on-disk patch store (see patch_store.py) instead of extracting in memory
+PATCH_STORE_DIR = 'patch_store/'
 IMG_WIDTH = 400;
 IMG_HEIGHT = 400;
 IMG_PATCH_SIZE = 16
 IMG_PATCH_STRIDE = 8
+NUM_TRANSFORMATIONS = 4 # Number of flips/rotations added for every training patch
+STREAM_PATCHES = False # If True, cut training patches from the images on the fly instead of extracting them all
+PREFETCH_BATCHES = 16 # Number of minibatches prepared ahead of the training loop
+PREFETCH_THREADS = 2 # Background threads gathering the minibatches
 
 ###### POST TRAINING SETTINGS ######
+FCN_INFERENCE = False # If True, predict whole images at once with the fully convolutional model
+FCN_COMPARE_PATCHWISE = False # If True, also run the patchwise model and report the label agreement
+TTA_STRIDE = 0 # If > 0, predict overlapping windows this many pixels apart and average them onto the patch grid (see test_time_augmentation.py)
+TTA_AUGMENTATIONS = 0 # Flips/rotations of every window also predicted and averaged (up to 4); with TTA_STRIDE = 0 the windows are the grid patches
 VALIDATION_SIZE = 20000  # Size of the validation set.
+VALIDATION_STEP = 10000 # Evaluate the validation set every this many training steps (0 to only validate at the end)
+VALIDATION_IMAGES = 0 # If > 0, the last this many of the TRAINING_SIZE images are left out of training and validated whole instead of VALIDATION_SIZE training patches
+VALIDATION_GRID = 16 # Pixels per label of the held-out validation, the submission grid whatever the patch size
+INFERENCE_BATCH_SIZE = 1024 # Number of patches per inference run
+PREDICTION_CACHE_DIR = 'prediction_cache/' # Per-patch probabilities reused while the checkpoint and the image are unchanged ('' disables, see prediction_cache.py)
+PREDICTION_CACHE_SIZE = 256 * 1024 * 1024 # Bytes of cached predictions, the least recently used are evicted
+LOADER_PROCESSES = multiprocessing.cpu_count() # Worker processes used to decode images and extract patches
 VALIDATE = True;
 VISUALIZE_PREDICTION_ON_TRAINING_SET = True
 VISUALIZE_NUM = -1
 RUN_ON_TEST_SET = True
 TEST_SIZE = 50
+# Filters applied to the patch masks, in order (see postprocessing.py), e.g.
+# [('isolated', {}), ('median', {'size': 3}), ('components', {'min_size': 4})]
+POSTPROCESSING = [('isolated', {})]
+RUN_REPORT = 'run_report.json' # Per-stage timings, counters and throughput of the run (see instrumentation.py)
+TRAIN_DATA_DIR = 'data/training/images/'
+TRAIN_LABELS_DIR = 'data/training/groundtruth/'
+TEST_DATA_DIR = 'data/test_set/'
+PREDICTION_TRAINING_DIR = 'predictions_training/'
+PREDICTION_TEST_DIR = 'predictions_test/'
+SUBMISSION_FILENAME = 'submission.csv'
 
 tf.app.flags.DEFINE_string('train_dir', 'tmp/',
                            """Directory where to write event logs """
                            """and checkpoint.""")
 FLAGS = tf.app.flags.FLAGS
 
-def subtract_mean(img):
-    gray_img = 0.2989*img[:,:,0] + 0.5870*img[:,:,1] + 0.1140*img[:,:,2]
-    img -= np.matrix(gray_img).mean()
-
-def prediction_to_mask(labels, width, height):
-    mask = np.zeros([height, width])
-    idx = 0
-    for i in range(0,height):
-        for j in range(0,width):
-            mask[i][j] = 0 if labels[idx][0] > 0.5 else 1
-            idx = idx + 1
-    return mask
-
-def mask_to_prediction(mask):
-    (height, width) = mask.shape;
-    prediction = np.zeros([height * width, 2])
-    idx = 0
-    for i in range(0,height):
-        for j in range(0,width):
-            if mask[i][j] == 1:
-                prediction[idx][1] = 1
-            else:
-                prediction[idx][0] = 1
-            idx = idx + 1
-    return prediction
-
-def augment_image(img, out_ls, num_of_transformations):
-    out_ls.append(img)
-    if num_of_transformations > 0:
-        out_ls.append(np.fliplr(img))
-    if num_of_transformations > 1:
-        out_ls.append(np.flipud(img))
-    if num_of_transformations > 2:
-        out_ls.append(np.rot90(img))
-    if num_of_transformations > 3:
-        out_ls.append(np.rot90(np.rot90(img)))
-
-# Extract patches from a given image
-def img_crop(im, patch_size, stride, num_of_transformations):
-    list_patches = []
-    imgwidth = im.shape[0]
-    imgheight = im.shape[1]
-    is_2d = len(im.shape) < 3
-
-    for i in range(0,imgheight - patch_size + 1, stride):
-        for j in range(0,imgwidth - patch_size + 1, stride):
-            if is_2d:
-                im_patch = [im[j:j+patch_size, i:i+patch_size]]
-            else:
-                im_patch = im[j:j+patch_size, i:i+patch_size, :]
-                subtract_mean(im_patch)
-            augment_image(im_patch, list_patches, num_of_transformations)
-    return list_patches
-
-def extract_data(filename, num_images, patch_size = IMG_PATCH_SIZE, patch_stride = IMG_PATCH_STRIDE, num_of_transformations = 4):
-    """Extract the images into a 4D tensor [image index, y, x, channels].
-    Values are rescaled from [0, 255] down to [-0.5, 0.5].
-    """
-    imgs = []
+def image_filenames(filename, num_images):
+    filenames = []
     for i in range(1, num_images+1):
         imageid = "satImage_%.3d" % i
         image_filename = filename + imageid + ".png"
         if os.path.isfile(image_filename):
-            print ('Loading ' + image_filename)
-            img = mpimg.imread(image_filename)
-            imgs.append(img)
+            filenames.append(image_filename)
         else:
             print ('File ' + image_filename + ' does not exist')
-
-    num_images = len(imgs)
-    IMG_WIDTH = imgs[0].shape[0]
-    IMG_HEIGHT = imgs[0].shape[1]
-    N_PATCHES_PER_IMAGE = (IMG_WIDTH/patch_size)*(IMG_HEIGHT/patch_size)
-    print('Extracting patches...')
-    img_patches = [img_crop(imgs[i], patch_size, patch_stride, num_of_transformations) for i in range(num_images)]
-    data = [img_patches[i][j] for i in range(len(img_patches)) for j in range(len(img_patches[i]))]
+    return filenames
+
+@timed('decode')
+def load_images(filename, num_images, num_processes = LOADER_PROCESSES):
+    filenames = image_filenames(filename, num_images)
+    print ('Loading %d images from %s' % (len(filenames), filename))
+    return decode_images(filenames, num_processes)
+
+# Decode the given PNG files in parallel (in threads once a session is open, as
+# for the test set, see parallel_loading.py)
+@timed('decode')
+def read_images(filenames, num_processes = LOADER_PROCESSES):
+    return decode_images(filenames, num_processes)
+
+@timed('extract_patches')
+def extract_data(filename, num_images, patch_size = IMG_PATCH_SIZE, patch_stride = IMG_PATCH_STRIDE, num_of_transformations = NUM_TRANSFORMATIONS, num_processes = LOADER_PROCESSES):
+    """Extract the images into a 4D tensor [image index, y, x, channels].
+    Every patch has the mean gray level of the patch subtracted.
+    Images are decoded and cropped by num_processes worker processes.
+    """
+    filenames = image_filenames(filename, num_images)
+    print('Extracting patches of %d images...' % len(filenames))
+    data = extract_patches_parallel(filenames, patch_size, patch_stride, num_of_transformations, num_processes)
     print(str(len(data)) + ' patches extracted.')
-
-    return np.asarray(data)
-        
-# Assign a label to a patch v
-def value_to_class(v):
-    foreground_threshold = 0.25 # percentage of pixels > 1 required to assign a foreground label to a patch
-    df = np.sum(v)
-    if df > foreground_threshold:
-        # Road
-        return [0, 1]
-    else:
-        # Non-road
-        return [1, 0]
+    return data
 
 # Extract label images
-def extract_labels(filename, num_images, patch_size = IMG_PATCH_SIZE, patch_stride = IMG_PATCH_STRIDE, num_of_transformations = 4):
+@timed('extract_labels')
+def extract_labels(filename, num_images, patch_size = IMG_PATCH_SIZE, patch_stride = IMG_PATCH_STRIDE, num_of_transformations = NUM_TRANSFORMATIONS, num_processes = LOADER_PROCESSES):
     """Extract the labels into a 1-hot matrix [image index, label index]."""
-    gt_imgs = []
-    for i in range(1, num_images+1):
-        imageid = "satImage_%.3d" % i
-        image_filename = filename + imageid + ".png"
-        if os.path.isfile(image_filename):
-            print ('Loading ' + image_filename)
-            img = mpimg.imread(image_filename)
-            gt_imgs.append(img)
-        else:
-            print ('File ' + image_filename + ' does not exist')
-
-    num_images = len(gt_imgs)
-    print('Extracting patches...')
-    gt_patches = [img_crop(gt_imgs[i], patch_size, patch_stride, num_of_transformations) for i in range(num_images)]
-    data = np.asarray([gt_patches[i][j] for i in range(len(gt_patches)) for j in range(len(gt_patches[i]))])
-    labels = np.asarray([value_to_class(np.mean(data[i])) for i in range(len(data))])
-    print(str(len(data)) + ' patches extracted.')
-
-    # Convert to dense 1-hot representation.
-    return labels.astype(np.float32)
+    filenames = image_filenames(filename, num_images)
+    print('Extracting patches of %d groundtruth images...' % len(filenames))
+    labels = extract_labels_parallel(filenames, patch_size, patch_stride, num_of_transformations, num_processes)
+    print(str(len(labels)) + ' patches extracted.')
+    return labels
 
 def error_rate(predictions, labels):
     return 100.0 - (100.0 * np.sum(np.argmax(predictions, 1) == np.argmax(labels, 1)) / predictions.shape[0])
 
-# Convert array of labels to an image
-def label_to_img(imgwidth, imgheight, w, h, labels):
-    array_labels = np.zeros([imgwidth, imgheight])
-    idx = 0
-    for i in range(0,imgheight,h):
-        for j in range(0,imgwidth,w):
-            if labels[idx][0] > 0.5:
-                l = 0
-            else:
-                l = 1
-            array_labels[j:j+w, i:i+h] = l
-            idx = idx + 1
-    return array_labels
-
 def img_float_to_uint8(img):
     rimg = img - np.min(img)
     rimg = (rimg / np.max(rimg) * PIXEL_DEPTH).round().astype(np.uint8)
@@ -210,12 +185,13 @@ def concatenate_images(img, gt_img):
         cimg = np.concatenate((img8, gt_img_3c), axis=1)
     return cimg
 
+@timed('overlay_rendering')
 def make_img_overlay(img, predicted_img, true_img = None):
     w = img.shape[0]
     h = img.shape[1]
     color_mask = np.zeros((w, h, 3), dtype=np.uint8)
     color_mask[:,:,0] = predicted_img * PIXEL_DEPTH
-    if (true_img != None):
+    if true_img is not None:
         color_mask[:,:,1] = true_img * PIXEL_DEPTH
 
     img8 = img_float_to_uint8(img)
@@ -224,475 +200,772 @@ def make_img_overlay(img, predicted_img, true_img = None):
     new_img = Image.blend(background, overlay, 0.2)
     return new_img
 
-def main(argv=None):  # pylint: disable=unused-argument
-    np.random.seed(NP_SEED)
-    train_data_filename = 'data/training/images/'
-    train_labels_filename = 'data/training/groundtruth/'
-    test_data_filename = 'data/test_set/'
-
-    # Extract it into np arrays.
-    if IMG_PATCHES_RESTORE:
-        if BALANCE_SIZE_OF_CLASSES:
-            train_data = np.load('patches_imgs_balanced.npy')
-            train_labels = np.load('patches_labels_balanced.npy')
-            train_size = train_labels.shape[0]
-        else:
-            train_data = np.load('patches_imgs.npy')
-            train_labels = np.load('patches_labels.npy')
+# Writes plain Summary protobufs, so no op is added to the graph
+def add_scalars(summary_writer, values, step):
+    summary_writer.add_summary(tf.Summary(value=[
+        tf.Summary.Value(tag=tag, simple_value=value) for (tag, value) in values]), step)
+
+class InferenceEngine(object):
+    """Placeholder-fed inference graph, built once and reused for every prediction.
+    Serving a prediction only feeds the placeholders, so the graph does not grow
+    with the number of images.
+    """
+
+    def __init__(self, model, model_fcn, patch_size = IMG_PATCH_SIZE, batch_size = INFERENCE_BATCH_SIZE):
+        self.patch_size = patch_size
+        self.batch_size = batch_size
+        self.patches_node = tf.placeholder(tf.float32, shape=(None, patch_size, patch_size, NUM_CHANNELS))
+        self.patches_prediction = tf.nn.softmax(model(self.patches_node))
+        self.image_node = tf.placeholder(tf.float32, shape=(1, None, None, NUM_CHANNELS))
+        self.image_prediction = tf.nn.softmax(tf.reshape(model_fcn(self.image_node), [-1, NUM_LABELS]))
+
+    def predict(self, session, patches):
+        """Probabilities for any number of patches, evaluated batch_size at a time."""
+        predictions = np.empty((len(patches), NUM_LABELS), dtype=np.float32)
+        for begin in range(0, len(patches), self.batch_size):
+            end = min(begin + self.batch_size, len(patches))
+            with timer('inference_batch'):
+                predictions[begin:end] = session.run(self.patches_prediction,
+                                                     feed_dict={self.patches_node: patches[begin:end]})
+            count('patches_predicted', end - begin)
+        return predictions
+
+    def predict_image(self, session, img):
+        """Per-patch probabilities of a whole image through the fully convolutional
+        model, in the patch order of extract_patches.
+        """
+        data = subtract_block_means(img, self.patch_size)
+        with timer('inference_image'):
+            score_map = session.run(self.image_prediction, feed_dict={self.image_node: data[np.newaxis]})
+        count('images_predicted')
+        rows = data.shape[0] // self.patch_size
+        cols = data.shape[1] // self.patch_size
+        # Patches are ordered column by column
+        return score_map.reshape(rows, cols, NUM_LABELS).transpose(1, 0, 2).reshape(-1, NUM_LABELS)
+
+class Config(object):
+    """Settings of one run. Every setting defaults to the module constant of the
+    same name in upper case and can be overridden by keyword, e.g.
+        Config(batch_size=128, img_patch_size=8, restore_model=False)
+    """
+
+    NAMES = ['training_size', 'np_seed', 'seed', 'batch_size', 'balance_size_of_classes', 'balancing_mode',
+             'conv_sizes', 'conv_depths', 'fc_depth', 'restore_model', 'terminate_after_time', 'num_epochs',
+             'max_training_time_in_sec', 'recording_step', 'max_steps', 'intra_op_threads',
+             'inter_op_threads', 'checkpoint_every_steps', 'checkpoint_every_secs', 'checkpoints_to_keep',
+             'resume_training', 'img_patches_restore', 'patch_store_dir',
+             'img_patch_size', 'img_patch_stride', 'num_transformations', 'stream_patches',
+             'prefetch_batches', 'prefetch_threads', 'fcn_inference', 'fcn_compare_patchwise', 'tta_stride',
+             'tta_augmentations', 'validation_size', 'validation_step', 'validation_images', 'validation_grid', 'inference_batch_size',
+             'prediction_cache_dir', 'prediction_cache_size', 'loader_processes', 'validate', 'visualize_prediction_on_training_set', 'visualize_num', 'run_on_test_set', 'test_size',
+             'postprocessing', 'run_report', 'train_data_dir', 'train_labels_dir', 'test_data_dir',
+             'prediction_training_dir', 'prediction_test_dir', 'submission_filename', 'train_dir']
+
+    def __init__(self, **overrides):
+        defaults = globals()
+        for name in Config.NAMES:
+            if name == 'train_dir':
+                # The flag is only read when no train_dir is given
+                self.train_dir = overrides['train_dir'] if 'train_dir' in overrides else FLAGS.train_dir
+            else:
+                setattr(self, name, defaults[name.upper()])
+        self.update(**overrides)
+
+    def update(self, **overrides):
+        for (name, value) in overrides.items():
+            if name not in Config.NAMES:
+                raise TypeError('Unknown setting %r' % name)
+            setattr(self, name, value)
+        return self
+
+    def replace(self, **overrides):
+        """A copy of this configuration with some settings changed."""
+        return copy.copy(self).update(**overrides)
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in Config.NAMES)
+
+class DataCache(object):
+    """Decoded images and training patches shared by the runs of one process.
+    Entries are keyed by the settings they depend on, so runs that only differ
+    in e.g. the batch size or the architecture reuse the same arrays.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key, build):
+        if key not in self.entries:
+            self.entries[key] = build()
+        return self.entries[key]
+
+    def images(self, directory, num_images, num_processes = LOADER_PROCESSES):
+        return self.get(('images', directory, num_images),
+                        lambda: load_images(directory, num_images, num_processes))
+
+    def training_patches(self, config):
+        key = ('patches', config.train_data_dir, config.train_labels_dir, num_training_images(config),
+               config.img_patch_size, config.img_patch_stride, config.num_transformations,
+               config.img_patches_restore, config.patch_store_dir)
+        return self.get(key, lambda: load_training_patches(config))
+
+    def validation_images(self, config):
+        key = ('validation', config.train_data_dir, config.train_labels_dir, config.training_size,
+               config.validation_images, config.validation_grid)
+        return self.get(key, lambda: load_validation_images(config))
+
+# Number of images trained on, the last validation_images of training_size are held out
+def num_training_images(config):
+    if not 0 <= config.validation_images < config.training_size:
+        raise ValueError('validation_images must be below training_size (%d), got %d'
+                         % (config.training_size, config.validation_images))
+    return config.training_size - config.validation_images
+
+# Held-out images and the labels of their groundtruth on the validation grid
+def load_validation_images(config):
+    first = num_training_images(config)
+    imgs = read_images(image_filenames(config.train_data_dir, config.training_size)[first:], config.loader_processes)
+    gt_imgs = read_images(image_filenames(config.train_labels_dir, config.training_size)[first:], config.loader_processes)
+    return (imgs, [patch_labels(gt_img, config.validation_grid) for gt_img in gt_imgs])
+
+# Load (or extract) the materialized training patches
+def load_training_patches(config):
+    if config.img_patches_restore:
+        # Memory-mapped patch cache, rebuilt where it no longer matches the sources.
+        # Every (patch size, stride, transformations) has its own store.
+        store_dir = os.path.join(config.patch_store_dir, 'p%d_s%d_t%d' % (
+            config.img_patch_size, config.img_patch_stride, config.num_transformations))
+        store = PatchStore(store_dir, config.img_patch_size, config.img_patch_stride, config.num_transformations)
+        with timer('patch_store_sync'):
+            store.sync(image_filenames(config.train_data_dir, num_training_images(config)),
+                       image_filenames(config.train_labels_dir, num_training_images(config)), config.loader_processes)
+        train_data = store
+        train_labels = store.labels
     else:
-        train_data = extract_data(train_data_filename, TRAINING_SIZE)
-        train_labels = extract_labels(train_labels_filename, TRAINING_SIZE)
-        np.save('patches_imgs',train_data)
-        np.save('patches_labels',train_labels)
+        # Extract it into np arrays.
+        train_data = extract_data(config.train_data_dir, num_training_images(config), config.img_patch_size,
+                                  config.img_patch_stride, config.num_transformations, config.loader_processes)
+        train_labels = extract_labels(config.train_labels_dir, num_training_images(config), config.img_patch_size,
+                                      config.img_patch_stride, config.num_transformations, config.loader_processes)
 
     print('Total number of patches: ' + str(len(train_data)))
     print('Total number of labels: ' + str(len(train_data)))
     print('Shape of patches: ' + str(train_data.shape))
     print('Shape of labels: ' + str(train_labels.shape))
+    return (train_data, train_labels)
 
-    num_epochs = NUM_EPOCHS
-
-    c0 = 0
-    c1 = 0
-    for i in range(len(train_labels)):
-        if train_labels[i][0] == 1:
-            c0 = c0 + 1
-        else:
-            c1 = c1 + 1
+# Balance the classes of the training patches
+# Returns the IndexSampler giving the patch indices of every epoch
+def balance_training_patches(train_labels, config):
+    (c0, c1) = class_histogram(train_labels)
     print ('Number of data points per class: c0 = ' + str(c0) + ' c1 = ' + str(c1))
 
-    if BALANCE_SIZE_OF_CLASSES:
-        if IMG_PATCHES_RESTORE:
-            print('Skipping balancing - balanced data already loaded from the disk.')
+    # Only patch indices are balanced, the patches themselves are never copied
+    mode = config.balancing_mode if config.balance_size_of_classes else 'none'
+    if mode != 'none':
+        print ('Balancing training data (%s)...' % mode)
+    with timer('balancing'):
+        index_sampler = IndexSampler(train_labels, mode, config.np_seed)
+    if index_sampler.indices is not None:
+        (c0, c1) = class_histogram(train_labels[index_sampler.indices])
+        print ('Number of data points per class: c0 = ' + str(c0) + ' c1 = ' + str(c1))
+    return index_sampler
+
+# Thread pools of the TensorFlow session, so that concurrent runs can split the cores
+def session_config(config):
+    return tf.ConfigProto(intra_op_parallelism_threads=config.intra_op_threads,
+                          inter_op_parallelism_threads=config.inter_op_threads)
+
+# From now on the loaders use threads, forking next to the session's threads is unsafe
+def new_session(graph, config):
+    threads_started()
+    return tf.Session(graph=graph, config=session_config(config))
+
+class Trainer(object):
+    """Training run of one configuration.
+    The training and inference graphs are built once, in their own tf.Graph and
+    session, so several trainers can live in one process. Entry points:
+    load_data(), train() or restore(), validate(), predictor() and close().
+    """
+
+    def __init__(self, config, cache=None):
+        self.config = config
+        self.cache = cache if cache is not None else DataCache()
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.build_graph()
+        # Opened on first use, so that load_data() can still fork its loader processes
+        self._session = None
+        self.checkpoints = CheckpointManager(self.saver, config.train_dir, config.checkpoints_to_keep,
+                                             config.checkpoint_every_steps, config.checkpoint_every_secs)
+        self.validation_data = None
+        # (step, validation error, road F1) of every validation during training
+        self.validation_history = []
+        self.stopped_early = False
+
+    def build_graph(self):
+        config = self.config
+        ##### CREATING VARIABLES FOR GRAPH #####
+        # This is where training samples and labels are fed to the graph.
+        # These placeholder nodes will be fed a batch of training data at each
+        # training step using the {feed_dict} argument to the Run() call below.
+        self.train_data_node = tf.placeholder(
+            tf.float32,
+            shape=(config.batch_size, config.img_patch_size, config.img_patch_size, NUM_CHANNELS))
+        self.train_labels_node = tf.placeholder(tf.float32,
+                                                shape=(config.batch_size, NUM_LABELS))
+
+        # The trainable weights, shared by the training and inference graphs
+        net = PatchModel(config.img_patch_size, NUM_CHANNELS, NUM_LABELS,
+                         conv_sizes=config.conv_sizes, conv_depths=config.conv_depths,
+                         fc_depth=config.fc_depth, seed=config.seed)
+        self.net = net
+
+        # Training computation: logits + cross-entropy loss.
+        logits = net.model(self.train_data_node, True) # BATCH_SIZE*NUM_LABELS
+        self.loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(
+            logits, self.train_labels_node))
+        tf.scalar_summary('loss', self.loss)
+
+        all_params_node = [net.conv1_weights, net.conv1_biases, net.conv2_weights, net.conv2_biases, net.fc1_weights, net.fc1_biases, net.fc2_weights, net.fc2_biases]
+        all_params_names = ['conv1_weights', 'conv1_biases', 'conv2_weights', 'conv2_biases', 'fc1_weights', 'fc1_biases', 'fc2_weights', 'fc2_biases']
+        all_grads_node = tf.gradients(self.loss, all_params_node)
+        all_grad_norms_node = []
+        for i in range(0, len(all_grads_node)):
+            norm_grad_i = tf.global_norm([all_grads_node[i]])
+            all_grad_norms_node.append(norm_grad_i)
+            tf.scalar_summary(all_params_names[i], norm_grad_i)
+
+        # L2 regularization for the fully connected parameters.
+        regularizers = (tf.nn.l2_loss(net.fc1_weights) + tf.nn.l2_loss(net.fc1_biases) +
+                        tf.nn.l2_loss(net.fc2_weights) + tf.nn.l2_loss(net.fc2_biases))
+        # Add the regularization term to the loss.
+        # loss += 5e-4 * regularizers
+
+        # # Optimizer: set up a variable that's incremented once per batch and
+        # # controls the learning rate decay.
+        # batch = tf.Variable(0)
+        # # Decay once per epoch, using an exponential schedule starting at 0.01.
+        # learning_rate = tf.train.exponential_decay(
+        #     0.01,                # Base learning rate.
+        #     batch * BATCH_SIZE,  # Current index into the dataset.
+        #     train_size,          # Decay step.
+        #     0.95,                # Decay rate.
+        #     staircase=True)
+
+        self.batch = tf.Variable(1)
+        self.learning_rate = tf.div(1, self.batch);
+        tf.scalar_summary('learning_rate', self.learning_rate)
+
+        # Use simple momentum for the optimization.
+        self.optimizer = tf.train.MomentumOptimizer(self.learning_rate, 0.9).minimize(self.loss, global_step=self.batch)
+
+        # Predictions for the minibatch, validation set and test set.
+        self.train_prediction = tf.nn.softmax(logits)
+        # Shared inference graph used by every prediction and by the validation.
+        self.engine = InferenceEngine(net.model, net.model_fcn, config.img_patch_size, config.inference_batch_size)
+
+        # Build the summary operation based on the TF collection of Summaries.
+        self.summary_op = tf.merge_all_summaries()
+        self.init_op = tf.initialize_all_variables()
+        # Add ops to save and restore all the variables. Old resumable checkpoints
+        # are deleted by the CheckpointManager.
+        self.saver = tf.train.Saver(max_to_keep=0)
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = new_session(self.graph, self.config)
+        return self._session
+
+    def checkpoint_path(self):
+        return self.config.train_dir + "/model.ckpt"
+
+    def load_data(self):
+        """Training patches (or the streaming sampler) and the validation set."""
+        config = self.config
+        if config.stream_patches:
+            # Patches are cut from the source images on the fly, see input_pipeline.py
+            self.sampler = PatchSampler(self.cache.images(config.train_data_dir, num_training_images(config), config.loader_processes),
+                                        self.cache.images(config.train_labels_dir, num_training_images(config), config.loader_processes),
+                                        config.img_patch_size, config.img_patch_stride, config.num_transformations,
+                                        config.balance_size_of_classes, config.np_seed)
+            (c0, c1) = self.sampler.class_counts()
+            print ('Number of patch positions per class: c0 = ' + str(c0) + ' c1 = ' + str(c1))
+            self.train_size = self.sampler.epoch_size
+        else:
+            (self.train_data, self.train_labels) = self.cache.training_patches(config)
+            self.index_sampler = balance_training_patches(self.train_labels, config)
+            self.train_size = self.index_sampler.size
+
+        ##### SETTING UP VALIDATION SET #####
+        if config.validate:
+            if config.validation_images > 0:
+                # Whole images never trained on, with the same labels whatever the patch size and balancing
+                (self.validation_data, self.validation_labels) = self.cache.validation_images(config)
+                self.validation_indices = None
+                print('Validation images: %d, labelled on a %d pixel grid' % (len(self.validation_data), config.validation_grid))
+            elif config.stream_patches:
+                (self.validation_data, self.validation_labels) = self.sampler.next_batch(config.validation_size)
+                self.validation_indices = None
+                print('Size of validation set: ' + str(len(self.validation_data)))
+            else:
+                # Validation patches are gathered from the training patches chunk by chunk
+                (self.validation_data, self.validation_labels) = (self.train_data, self.train_labels)
+                self.validation_indices = self.index_sampler.distinct(config.validation_size)
+                print('Size of validation set: ' + str(len(self.validation_indices)))
+
+    def restore(self):
+        # Restore variables from disk.
+        self.saver.restore(self.session, self.checkpoint_path())
+        print("Model restored.")
+
+    # Confusion matrix of the validation set, streamed through the inference engine:
+    # of the held-out images on the validation grid, or of the validation patches
+    @timed('validation')
+    def validate(self):
+        print('Validation started.')
+        config = self.config
+        predict = lambda patches: self.engine.predict(self.session, patches)
+        if config.validation_images > 0:
+            return evaluate_images(predict, self.validation_data, self.validation_labels, config.img_patch_size,
+                                   config.validation_grid, config.inference_batch_size, NUM_LABELS)
+        return evaluate(predict, self.validation_data, self.validation_labels, config.inference_batch_size,
+                        self.validation_indices, NUM_LABELS)
+
+    def train(self, on_validation=None, resume=None):
+        """Trains from freshly initialized weights, or from the resumable
+        checkpoint state resume (see CheckpointManager.latest()) at the step it
+        was saved. The minibatch of every step only depends on the seeds and the
+        step, so a resumed run follows the data order of an uninterrupted one.
+        Resumable checkpoints are saved on the intervals of the configuration and
+        when training stops, model.ckpt after every epoch. With
+        terminate_after_time the time budget (summed over resumed runs) is checked
+        before every step.
+        on_validation(step, confusion) is called after every periodic validation;
+        training stops early when it returns True.
+        """
+        config = self.config
+        s = self.session
+        if resume is None:
+            # Run all the initializers to prepare the trainable parameters.
+            s.run(self.init_op)
+            (total_steps, elapsed) = (0, 0.0)
+            print ('Initialized!')
         else:
-            print ('Balancing training data...')
-            min_c = min(c0, c1)
-            idx0 = [i for i, j in enumerate(train_labels) if j[0] == 1]
-            idx1 = [i for i, j in enumerate(train_labels) if j[1] == 1]
-            new_indices = idx0[0:min_c] + idx1[0:min_c]
-            train_data = train_data[new_indices,:,:,:]
-            train_labels = train_labels[new_indices]
-
-            train_size = train_labels.shape[0]
-            c0 = 0
-            c1 = 0
-            for i in range(len(train_labels)):
-                if train_labels[i][0] == 1:
-                    c0 = c0 + 1
-                else:
-                    c1 = c1 + 1
-            print ('Number of data points per class: c0 = ' + str(c0) + ' c1 = ' + str(c1))
-            np.save('patches_imgs_balanced',train_data)
-            np.save('patches_labels_balanced',train_labels)
-
-    ##### SETTING UP VALIDATION SET #####
-    if VALIDATE:
-        perm_indices = np.random.permutation(np.arange(0,len(train_data)))
-        validation_data = train_data[perm_indices[0:VALIDATION_SIZE]]
-        validation_labels = train_labels[perm_indices[0:VALIDATION_SIZE]]
-        print('Size of validation set: ' + str(len(validation_data)))
-        print('Shape of validation set: ' + str(validation_data.shape))
-
-    ##### CREATING VARIABLES FOR GRAPH #####
-    # This is where training samples and labels are fed to the graph.
-    # These placeholder nodes will be fed a batch of training data at each
-    # training step using the {feed_dict} argument to the Run() call below.
-    train_data_node = tf.placeholder(
-        tf.float32,
-        shape=(BATCH_SIZE, IMG_PATCH_SIZE, IMG_PATCH_SIZE, NUM_CHANNELS))
-    train_labels_node = tf.placeholder(tf.float32,
-                                       shape=(BATCH_SIZE, NUM_LABELS))
-    train_all_data_node = tf.constant(train_data)
-
-    # The variables below hold all the trainable weights. They are passed an
-    # initial value which will be assigned when when we call:
-    # {tf.initialize_all_variables().run()}
-
-    conv1_weights = tf.Variable(
-        tf.truncated_normal([9, 9, NUM_CHANNELS, 128],  # 5x5 filter, depth 32.
-                            stddev=0.1,
-                            seed=SEED))
-    conv1_biases = tf.Variable(tf.zeros([128]))
-
-
-    # conv1_weights = tf.Variable(
-    #     tf.truncated_normal([5, 5, NUM_CHANNELS, 32],  # 5x5 filter, depth 32.
-    #                         stddev=0.1,
-    #                         seed=SEED))
-    # conv1_biases = tf.Variable(tf.zeros([32]))
-
-    conv2_weights = tf.Variable(
-        tf.truncated_normal([7, 7, 128, 64],
-                            stddev=0.1,
-                            seed=SEED))
-    conv2_biases = tf.Variable(tf.constant(0.1, shape=[64]))
-
-    # conv2_weights = tf.Variable(
-    #     tf.truncated_normal([5, 5, 32, 64],
-    #                         stddev=0.1,
-    #                         seed=SEED))
-    # conv2_biases = tf.Variable(tf.constant(0.1, shape=[64]))
-
-    conv3_weights = tf.Variable(
-        tf.truncated_normal([3, 3, 64, 64],
-                            stddev=0.1,
-                            seed=SEED))
-    conv3_biases = tf.Variable(tf.constant(0.1, shape=[64]))
-
-    fc1_weights = tf.Variable(  # fully connected, depth 512.
-        tf.truncated_normal([int((IMG_PATCH_SIZE / 8) * (IMG_PATCH_SIZE / 8) * 64), 512],
-                            stddev=0.1,
-                            seed=SEED))
-    fc1_biases = tf.Variable(tf.constant(0.1, shape=[512]))
-
-    # fc1_weights = tf.Variable(  # fully connected, depth 512.
-    #     tf.truncated_normal([int(IMG_PATCH_SIZE / 4 * IMG_PATCH_SIZE / 4 * 64), 512],
-    #                         stddev=0.1,
-    #                         seed=SEED))
-    # fc1_biases = tf.Variable(tf.constant(0.1, shape=[512]))
-    fc2_weights = tf.Variable(
-        tf.truncated_normal([512, NUM_LABELS],
-                            stddev=0.1,
-                            seed=SEED))
-    fc2_biases = tf.Variable(tf.constant(0.1, shape=[NUM_LABELS]))
-
-    # Make an image summary for 4d tensor image with index idx
-    def get_image_summary(img, idx = 0):
-        V = tf.slice(img, (0, 0, 0, idx), (1, -1, -1, 1))
-        img_w = img.get_shape().as_list()[1]
-        img_h = img.get_shape().as_list()[2]
-        min_value = tf.reduce_min(V)
-        V = V - min_value
-        max_value = tf.reduce_max(V)
-        V = V / (max_value*PIXEL_DEPTH)
-        V = tf.reshape(V, (img_w, img_h, 1))
-        V = tf.transpose(V, (2, 0, 1))
-        V = tf.reshape(V, (-1, img_w, img_h, 1))
-        return V
-    
-    # Make an image summary for 3d tensor image with index idx
-    def get_image_summary_3d(img):
-        V = tf.slice(img, (0, 0, 0), (1, -1, -1))
-        img_w = img.get_shape().as_list()[1]
-        img_h = img.get_shape().as_list()[2]
-        V = tf.reshape(V, (img_w, img_h, 1))
-        V = tf.transpose(V, (2, 0, 1))
-        V = tf.reshape(V, (-1, img_w, img_h, 1))
-        return V
-
-    def set_to_zero_if_no_neighbours(mask):
-        (height, width) = mask.shape
-        for i in range(1, height - 1):
-            for j in range(1, width - 1):
-                if mask[i][j] == 1 \
-                and mask[i + 1][j] == 0 \
-                and mask[i - 1][j] == 0 \
-                and mask[i][j + 1] == 0 \
-                and mask[i][j - 1] == 0:
-                    mask[i][j] = 0
-                if mask[i][j] == 0 \
-                and mask[i + 1][j] == 1 \
-                and mask[i - 1][j] == 1 \
-                and mask[i][j + 1] == 1 \
-                and mask[i][j - 1] == 1:
-                    mask[i][j] = 1
-        return mask
-
-    def postprocess_prediction(prediction,  width, height):
-        mask = prediction_to_mask(prediction, width, height);
-        # scipy.misc.imsave('test_before.png', mask)
-        mask = set_to_zero_if_no_neighbours(mask)
-        # mask = scipy.signal.medfilt(mask, 3)
-        # scipy.misc.imsave('test_after.png', mask)
-        return mask_to_prediction(mask)
-    
-    # Get prediction for given input image 
-    def get_prediction(img, ):
-        data = np.asarray(img_crop(img, IMG_PATCH_SIZE, IMG_PATCH_SIZE, 0))
-        data_node = tf.constant(data)
-        output = tf.nn.softmax(model(data_node))
-        output_prediction = s.run(output)
-        output_prediction_postprocessed = postprocess_prediction(output_prediction, int(img.shape[0] / IMG_PATCH_SIZE), int(img.shape[1] / IMG_PATCH_SIZE))
-
-        img_prediction = label_to_img(img.shape[0], img.shape[1], IMG_PATCH_SIZE, IMG_PATCH_SIZE, output_prediction)
-        img_prediction_postprocessed = label_to_img(img.shape[0], img.shape[1], IMG_PATCH_SIZE, IMG_PATCH_SIZE, output_prediction_postprocessed)
+            self.saver.restore(s, resume['path'])
+            np.random.set_state(resume['np_random_state'])
+            (total_steps, elapsed) = (resume['step'], resume['elapsed'])
+            self.validation_history = list(resume['validation_history'])
+            print ('Resumed from %s at step %d (%.0f s of training done)' % (resume['path'], total_steps, elapsed))
+
+        summary_writer = tf.train.SummaryWriter(config.train_dir,
+                                                graph=self.graph)
+        # Loop through training steps.
+        steps_per_epoch = max(1, int(self.train_size / config.batch_size))
+        print ('Total number of iterations = ' + str(int(config.num_epochs * self.train_size / config.batch_size)))
+
+        # Minibatches are gathered in background threads while the current step runs
+        if config.stream_patches:
+            batch_at = self.sampler.batch_at
+        else:
+            batch_at = IndexedBatchSource(self.train_data, self.train_labels, self.index_sampler).batch_at
+        prefetcher = BatchPrefetcher(batch_at, config.batch_size, config.prefetch_batches, config.prefetch_threads,
+                                     start=total_steps)
+        # Training time of this run and of the runs it resumes
+        start = time.time() - elapsed
+        self.checkpoints.restart_timer()
+        step_time = 0.0
+        saved_step = None
+
+        def checkpoint_state():
+            return {'elapsed': time.time() - start, 'epoch': total_steps // steps_per_epoch,
+                    'np_seed': config.np_seed, 'np_random_state': np.random.get_state(),
+                    'validation_history': self.validation_history}
+
+        while True:
+            step = total_steps % steps_per_epoch
+            iepoch = total_steps // steps_per_epoch
+            if not config.terminate_after_time and iepoch >= config.num_epochs:
+                break
+            if config.max_steps > 0 and total_steps >= config.max_steps:
+                break
+            # Stop before the step that would overrun the time budget
+            if config.terminate_after_time and time.time() - start + step_time > config.max_training_time_in_sec:
+                print('Training time budget reached after %d steps' % total_steps)
+                break
+            step_start = time.time()
+
+            # The minibatch of this step
+            with timer('input_wait'):
+                (batch_data, batch_labels) = prefetcher.get()
+            # This dictionary maps the batch data (as a np array) to the
+            # node in the graph is should be fed to.
+            feed_dict = {self.train_data_node: batch_data,
+                         self.train_labels_node: batch_labels}
+
+            if step % config.recording_step == 0:
+
+                with timer('train_step'):
+                    summary_str, _, l, lr, predictions = s.run(
+                        [self.summary_op, self.optimizer, self.loss, self.learning_rate, self.train_prediction],
+                        feed_dict=feed_dict)
+                #summary_str = s.run(summary_op, feed_dict=feed_dict)
+                summary_writer.add_summary(summary_str, step)
+                summary_writer.flush()
+
+                # print_predictions(predictions, batch_labels)
+
+                print ('Epoch %d / %d' % (iepoch, config.num_epochs))
+                print ('Minibatch loss: %.3f, learning rate: %.6f' % (l, lr))
+                print ('Minibatch error: %.1f%%' % error_rate(predictions, batch_labels))
+                end = time.time()
+                print("Time elapsed: %.3f" %(end - start))
+                # Input pipeline health: a starved model finds the queue empty
+                stats = prefetcher.stats()
+                prefetcher.reset_stats()
+                print('Input queue: mean depth %.1f / %d, %d stalls, %.3f s waiting for batches'
+                      % (stats['queue_depth'], stats['capacity'], stats['stalls'], stats['stall_time']))
+                # Step latency and throughput over the last recording_step steps
+                recent = instrumentation.default.stage_summary('train_step', config.recording_step)
+                examples_per_sec = recent['count'] * config.batch_size / recent['total_s'] if recent['count'] else 0.0
+                print('Training: %.1f examples/sec' % examples_per_sec)
+                add_scalars(summary_writer, [('input_queue_depth', stats['queue_depth']),
+                                             ('input_stall_time', stats['stall_time']),
+                                             ('examples_per_sec', examples_per_sec)]
+                            + instrumentation.default.scalars(['train_step', 'input_wait'], config.recording_step), total_steps)
+                sys.stdout.flush()
+            else:
+                # Run the graph and fetch some of the nodes.
+                with timer('train_step'):
+                    _, l, lr, predictions = s.run(
+                        [self.optimizer, self.loss, self.learning_rate, self.train_prediction],
+                        feed_dict=feed_dict)
+
+            count('train_examples', len(batch_labels))
+            total_steps += 1
+            step_time = time.time() - step_start
+            if config.validate and config.validation_step > 0 and total_steps % config.validation_step == 0:
+                confusion = self.validate()
+                print('Validation error: %.1f%%, road F1: %.4f' % (confusion.error_rate(), confusion.f1()))
+                add_scalars(summary_writer, [('validation_error', confusion.error_rate()),
+                                             ('validation_f1', confusion.f1())], total_steps)
+                summary_writer.flush()
+                self.validation_history.append((total_steps, confusion.error_rate(), confusion.f1()))
+                if on_validation is not None and on_validation(total_steps, confusion):
+                    print('Stopping early at step %d' % total_steps)
+                    self.stopped_early = True
+                    break
+
+            if total_steps % steps_per_epoch == 0:
+                # Save the variables to disk.
+                with timer('checkpoint'):
+                    save_path = self.saver.save(s, self.checkpoint_path())
+                print("Model saved in file: %s" % save_path)
+            if self.checkpoints.due(total_steps):
+                with timer('checkpoint'):
+                    saved_step = total_steps
+                    print('Resumable checkpoint saved in file: %s'
+                          % self.checkpoints.save(s, total_steps, checkpoint_state()))
+
+        if total_steps % steps_per_epoch != 0 or total_steps == 0:
+            with timer('checkpoint'):
+                save_path = self.saver.save(s, self.checkpoint_path())
+            print("Model saved in file: %s" % save_path)
+        if saved_step != total_steps:
+            with timer('checkpoint'):
+                print('Resumable checkpoint saved in file: %s'
+                      % self.checkpoints.save(s, total_steps, checkpoint_state()))
+        prefetcher.close()
+        summary_writer.close()
+        self.total_steps = total_steps
+
+    def finalize(self):
+        # Nothing below may add ops: predictions only feed the engine's placeholders.
+        self.graph.finalize()
+        print('Inference graph finalized with %d ops.' % len(self.graph.get_operations()))
+
+    def predictor(self):
+        """Predictor sharing this trainer's session and weights, which are those
+        of model.ckpt once train() or restore() ran.
+        """
+        return Predictor(self.config, self.session, self.engine, self.checkpoint_path())
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+class Predictor(object):
+    """Predictions, visualizations and submissions of a trained model.
+    Either shares the session of a Trainer, or holds its own inference-only
+    graph restored from a checkpoint (from_checkpoint), which a long-lived
+    process can keep and reuse for any number of images.
+    Given the checkpoint holding its weights, predictions go through the
+    prediction cache of the configuration.
+    """
+
+    def __init__(self, config, session, engine, checkpoint=None):
+        self.config = config
+        self.session = session
+        self.engine = engine
+        self.cache = None
+        if checkpoint is not None and config.prediction_cache_dir:
+            self.checkpoint_digest = checkpoint_digest(checkpoint)
+            if self.checkpoint_digest is not None:
+                self.cache = PredictionCache(config.prediction_cache_dir, config.prediction_cache_size)
+
+    @classmethod
+    def from_checkpoint(cls, config, checkpoint=None):
+        graph = tf.Graph()
+        with graph.as_default():
+            net = PatchModel(config.img_patch_size, NUM_CHANNELS, NUM_LABELS,
+                             conv_sizes=config.conv_sizes, conv_depths=config.conv_depths,
+                             fc_depth=config.fc_depth, seed=config.seed)
+            engine = InferenceEngine(net.model, net.model_fcn, config.img_patch_size, config.inference_batch_size)
+            saver = tf.train.Saver()
+        session = new_session(graph, config)
+        checkpoint = checkpoint or config.train_dir + "/model.ckpt"
+        saver.restore(session, checkpoint)
+        graph.finalize()
+        return cls(config, session, engine, checkpoint)
+
+    def close(self):
+        self.session.close()
+
+    @timed('postprocessing')
+    def postprocess_predictions(self, imgs, predictions):
+        """Postprocessed per-patch predictions of several images. The masks of
+        all the images of a size go through the filters in one stack."""
+        patch_size = self.config.img_patch_size
+        masks = [prediction_to_mask(prediction, int(img.shape[0] / patch_size), int(img.shape[1] / patch_size))
+                 for (img, prediction) in zip(imgs, predictions)]
+        for shape in set(mask.shape for mask in masks):
+            indices = [i for (i, mask) in enumerate(masks) if mask.shape == shape]
+            stack = postprocess_masks(np.stack([masks[i] for i in indices]), self.config.postprocessing)
+            for (i, mask) in zip(indices, stack):
+                masks[i] = mask
+        return [mask_to_prediction(mask) for mask in masks]
+
+    # Per-patch probabilities of an image, in the patch order of extract_patches
+    def predict_patches(self, img):
+        patch_size = self.config.img_patch_size
+        return self.engine.predict(self.session, extract_patches(img, patch_size, patch_size, 0))
+
+    # Same as predict_patches, but the whole image goes through model_fcn once.
+    # Each patch keeps its own mean subtraction; unlike the patchwise model, the
+    # convolutions see the neighbouring patches instead of zero padding, so the
+    # labels differ on some patches (bench_fcn.py measures by how much).
+    def predict_patches_fcn(self, img):
+        return self.engine.predict_image(self.session, img)
+
+    # Test-time augmentation: overlapping windows and their flips/rotations,
+    # averaged onto the patch grid, in the patch order of extract_patches
+    @timed('tta_averaging')
+    def predict_patches_tta(self, img):
+        config = self.config
+        return predict_with_tta(lambda patches: self.engine.predict(self.session, patches), img,
+                                config.img_patch_size, config.tta_stride or config.img_patch_size,
+                                config.tta_augmentations)
+
+    def tta_enabled(self):
+        return self.config.tta_stride > 0 or self.config.tta_augmentations > 0
+
+    def inference_mode(self):
+        if self.tta_enabled():
+            return 'tta stride %d, %d augmentations' % (self.config.tta_stride or self.config.img_patch_size,
+                                                       self.config.tta_augmentations)
+        return 'fcn' if self.config.fcn_inference else 'patchwise'
+
+    # Per-patch probabilities of several images, from the prediction cache where
+    # possible. In patchwise mode the patches of all the other images are
+    # evaluated together, in batches that span image boundaries.
+    def predict_images(self, imgs):
+        if self.cache is None:
+            return self.compute_predictions(imgs)
+        keys = [cache_key(self.checkpoint_digest, img, self.config.img_patch_size, self.inference_mode())
+                for img in imgs]
+        predictions = [self.cache.get(key) for key in keys]
+        missing = [i for (i, prediction) in enumerate(predictions) if prediction is None]
+        if missing:
+            for (i, prediction) in zip(missing, self.compute_predictions([imgs[i] for i in missing])):
+                self.cache.put(keys[i], prediction)
+                predictions[i] = prediction
+        return predictions
+
+    def compute_predictions(self, imgs):
+        if self.tta_enabled():
+            return [self.predict_patches_tta(img) for img in imgs]
+        if self.config.fcn_inference:
+            return [self.predict_patches_fcn(img) for img in imgs]
+        patch_size = self.config.img_patch_size
+        data = extract_patches_from_images(imgs, patch_size, patch_size, 0)
+        predictions = self.engine.predict(self.session, data)
+        counts = [num_patches(img, patch_size, patch_size, 0) for img in imgs]
+        return np.split(predictions, np.cumsum(counts)[:-1])
+
+    # Prediction images (raw and postprocessed) from the per-patch probabilities
+    # and their postprocess_predictions
+    @timed('mask_rendering')
+    def prediction_images(self, img, output_prediction, output_prediction_postprocessed):
+        patch_size = self.config.img_patch_size
+        img_prediction = label_to_img(img.shape[0], img.shape[1], patch_size, patch_size, output_prediction)
+        img_prediction_postprocessed = label_to_img(img.shape[0], img.shape[1], patch_size, patch_size, output_prediction_postprocessed)
         return (img_prediction, img_prediction_postprocessed)
 
-    # Get test prediction
-    def get_prediction_test(image_idx, overlay = False):
-        imageid = "test_%d" % image_idx
-        image_filename = test_data_filename + imageid + ".png"
-        img = mpimg.imread(image_filename)
-        (img_prediction, img_prediction_postprocessed) = get_prediction(img)
+    # Get prediction for given input image
+    def get_prediction(self, img):
+        config = self.config
+        start = time.time()
+        output_prediction = self.predict_images([img])[0]
+        print('Inference latency: %.3f s (%s)' % (time.time() - start, self.inference_mode()))
+        if config.fcn_inference and config.fcn_compare_patchwise and not self.tta_enabled():
+            patchwise_prediction = self.predict_patches(img)
+            agreement = np.mean(np.argmax(output_prediction, 1) == np.argmax(patchwise_prediction, 1))
+            print('FCN agreement with patchwise labels: %.1f%%' % (100.0 * agreement))
+        return self.prediction_images(img, output_prediction, self.postprocess_predictions([img], [output_prediction])[0])
 
-        if overlay:
-            img_prediction = make_img_overlay(img, img_prediction)
-            img_prediction_postprocessed = make_img_overlay(img, img_prediction_postprocessed)
-        return (img_prediction, img_prediction_postprocessed)
-    
     # Get a concatenation of the prediction and groundtruth for given input file
-    def get_prediction_with_groundtruth(filename, image_idx):
+    def get_prediction_with_groundtruth(self, filename, image_idx):
         imageid = "satImage_%.3d" % image_idx
         image_filename = filename + imageid + ".png"
         img = mpimg.imread(image_filename)
 
-        (img_prediction,_) = get_prediction(img)
+        (img_prediction,_) = self.get_prediction(img)
         cimg = concatenate_images(img, img_prediction)
 
         return cimg
 
     # Get prediction overlaid on the original image for given input file
-    def get_prediction_with_overlay(img_filename, truth_filename, image_idx):
+    def get_prediction_with_overlay(self, img_filename, truth_filename, image_idx):
         imageid = "satImage_%.3d" % image_idx
-        
+
         image_filename = img_filename + imageid + ".png"
         img = mpimg.imread(image_filename)
 
-        (img_prediction, img_prediction_postprocessed) = get_prediction(img)
+        (img_prediction, img_prediction_postprocessed) = self.get_prediction(img)
 
         truth_filename = truth_filename + imageid + ".png"
         img_truth = mpimg.imread(truth_filename)
+        return self.overlays(img, img_truth, img_prediction, img_prediction_postprocessed)
 
+    # Raw and postprocessed prediction images overlaid on the image and its groundtruth
+    def overlays(self, img, img_truth, img_prediction, img_prediction_postprocessed):
         oimg = make_img_overlay(img, img_prediction, img_truth)
         oimg_postprocessed = make_img_overlay(img, img_prediction_postprocessed, img_truth)
         return (oimg, oimg_postprocessed)
 
-    def validate(patches, labels):
-        print('Validation started.')
-        data = np.asarray(patches)
-        data_node = tf.constant(data)
-        prediction = s.run(tf.nn.softmax(model(data_node)))
-
-        return error_rate(prediction, labels)
-
-    # We will replicate the model structure for the training subgraph, as well
-    # as the evaluation subgraphs, while sharing the trainable parameters.
-    def model(data, train=False):
-        """The Model definition."""
-        # 2D convolution, with 'SAME' padding (i.e. the output feature map has
-        # the same size as the input). Note that {strides} is a 4D array whose
-        # shape matches the data layout: [image index, y, x, depth].
-        # LAYER 1
-        conv = tf.nn.conv2d(data, conv1_weights, strides=[1, 1, 1, 1], padding='SAME')
-        # Bias and rectified linear non-linearity.
-        relu = tf.nn.relu(tf.nn.bias_add(conv, conv1_biases))
-        # Max pooling. The kernel size spec {ksize} also follows the layout of
-        # the data. Here we have a pooling window of 2, and a stride of 2.
-        pool = tf.nn.max_pool(relu, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME')
-        # LAYER 2
-        conv2 = tf.nn.conv2d(pool, conv2_weights, strides=[1, 1, 1, 1], padding='SAME')
-        relu2 = tf.nn.relu(tf.nn.bias_add(conv2, conv2_biases))
-        pool2 = tf.nn.max_pool(relu2, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME')
-        # LAYER 3
-        conv3 = tf.nn.conv2d(pool2, conv3_weights, strides=[1, 1, 1, 1], padding='SAME')
-        relu3 = tf.nn.relu(tf.nn.bias_add(conv3, conv3_biases))
-        pool3 = tf.nn.max_pool(relu3, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME')
-
-        # Uncomment these lines to check the size of each layer
-        # print 'data ' + str(data.get_shape())
-        # print 'conv ' + str(conv.get_shape())
-        # print 'relu ' + str(relu.get_shape())
-        # print 'pool ' + str(pool.get_shape())
-        # print 'pool2 ' + str(pool2.get_shape())
-
-
-        # Reshape the feature map cuboid into a 2D matrix to feed it to the
-        # fully connected layers.
-        pool_shape = pool3.get_shape().as_list()
-        reshape = tf.reshape(
-            pool3,
-            [pool_shape[0], pool_shape[1] * pool_shape[2] * pool_shape[3]])
-        # Fully connected layer. Note that the '+' operation automatically
-        # broadcasts the biases.
-        hidden = tf.nn.relu(tf.matmul(reshape, fc1_weights) + fc1_biases)
-        # Add a 50% dropout during training only. Dropout also scales
-        # activations such that no rescaling is needed at evaluation time.
-        if train:
-           hidden = tf.nn.dropout(hidden, 0.5, seed=SEED)
-        out = tf.matmul(hidden, fc2_weights) + fc2_biases
-
-        if train == True:
-            tf.image_summary('summary_data', get_image_summary(data))
-            tf.image_summary('summary_conv', get_image_summary(conv))
-            tf.image_summary('summary_pool', get_image_summary(pool))
-            tf.image_summary('summary_conv2', get_image_summary(conv2))
-            tf.image_summary('summary_pool2', get_image_summary(pool2))
-            tf.image_summary('summary_conv3', get_image_summary(conv3))
-            tf.image_summary('summary_pool3', get_image_summary(pool3))
-        return out
-
-    # Training computation: logits + cross-entropy loss.
-    logits = model(train_data_node, True) # BATCH_SIZE*NUM_LABELS
-    # print 'logits = ' + str(logits.get_shape()) + ' train_labels_node = ' + str(train_labels_node.get_shape())
-    loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(
-        logits, train_labels_node))
-    tf.scalar_summary('loss', loss)
-
-    all_params_node = [conv1_weights, conv1_biases, conv2_weights, conv2_biases, fc1_weights, fc1_biases, fc2_weights, fc2_biases]
-    all_params_names = ['conv1_weights', 'conv1_biases', 'conv2_weights', 'conv2_biases', 'fc1_weights', 'fc1_biases', 'fc2_weights', 'fc2_biases']
-    all_grads_node = tf.gradients(loss, all_params_node)
-    all_grad_norms_node = []
-    for i in range(0, len(all_grads_node)):
-        norm_grad_i = tf.global_norm([all_grads_node[i]])
-        all_grad_norms_node.append(norm_grad_i)
-        tf.scalar_summary(all_params_names[i], norm_grad_i)
-    
-    # L2 regularization for the fully connected parameters.
-    regularizers = (tf.nn.l2_loss(fc1_weights) + tf.nn.l2_loss(fc1_biases) +
-                    tf.nn.l2_loss(fc2_weights) + tf.nn.l2_loss(fc2_biases))
-    # Add the regularization term to the loss.
-    # loss += 5e-4 * regularizers
-
-    # # Optimizer: set up a variable that's incremented once per batch and
-    # # controls the learning rate decay.
-    # batch = tf.Variable(0)
-    # # Decay once per epoch, using an exponential schedule starting at 0.01.
-    # learning_rate = tf.train.exponential_decay(
-    #     0.01,                # Base learning rate.
-    #     batch * BATCH_SIZE,  # Current index into the dataset.
-    #     train_size,          # Decay step.
-    #     0.95,                # Decay rate.
-    #     staircase=True)
-
-    batch = tf.Variable(1)
-    learning_rate = tf.div(1, batch);
-    tf.scalar_summary('learning_rate', learning_rate)
-    
-    # Use simple momentum for the optimization.
-    optimizer = tf.train.MomentumOptimizer(learning_rate, 0.9).minimize(loss, global_step=batch)
-
-    # Predictions for the minibatch, validation set and test set.
-    train_prediction = tf.nn.softmax(logits)
-    # We'll compute them only once in a while by calling their {eval()} method.
-    train_all_prediction = tf.nn.softmax(model(train_all_data_node))
-
-    # Add ops to save and restore all the variables.
-    saver = tf.train.Saver()
-
-    # Create a local session to run this computation.
-    with tf.Session() as s:
-        if RESTORE_MODEL:
-            # Restore variables from disk.
-            saver.restore(s, FLAGS.train_dir + "/model.ckpt")
-            print("Model restored.")
+    def visualize_training_set(self):
+        config = self.config
+        print ("Visualizing prediction on training set")
+        prediction_training_dir = config.prediction_training_dir
+        if not os.path.isdir(prediction_training_dir):
+            os.mkdir(prediction_training_dir)
+        limit = config.training_size + 1 if config.visualize_num == -1 else config.visualize_num
+        start = time.time()
+        imgs = read_images(image_filenames(config.train_data_dir, limit - 1), config.loader_processes)
+        truths = read_images(image_filenames(config.train_labels_dir, limit - 1), config.loader_processes)
+        # One inference pass and one postprocessing stack for all the images
+        predictions = self.predict_images(imgs)
+        postprocessed = self.postprocess_predictions(imgs, predictions)
+        print("Training set decoding, inference and postprocessing: %.3f s" % (time.time() - start))
+        for i in range(1, limit):
+            print ("Image: " + str(i))
+            # pimg = get_prediction_with_groundtruth(train_data_filename, i)
+            # Image.fromarray(pimg).save(prediction_training_dir + "prediction_" + str(i) + ".png")
+            img = imgs[i - 1]
+            (img_prediction, img_prediction_postprocessed) = self.prediction_images(img, predictions[i - 1], postprocessed[i - 1])
+            (oimg, oimg_postprocessed) = self.overlays(img, truths[i - 1], img_prediction, img_prediction_postprocessed)
+            with timer('image_saving'):
+                oimg.save(prediction_training_dir + "overlay_" + str(i) + ".png")
+                oimg_postprocessed.save(prediction_training_dir + "overlay_" + str(i) + "_postprocessed.png")
 
-        else:
-            # Run all the initializers to prepare the trainable parameters.
-            tf.initialize_all_variables().run()
+    def submit(self, submission_filename=None):
+        """Predicts the test set, saves the overlays and writes the submission file."""
+        config = self.config
+        print ("Running prediction on test set")
+        prediction_test_dir = config.prediction_test_dir
+        if not os.path.isdir(prediction_test_dir):
+            os.mkdir(prediction_test_dir)
+
+        start = time.time()
+        test_filenames = [config.test_data_dir + "test_%d" % i + ".png" for i in range(1, config.test_size + 1)]
+        test_imgs = read_images(test_filenames, config.loader_processes)
+        # A single inference pass and one postprocessing stack feed both the
+        # visualization and the submission
+        test_predictions = self.predict_images(test_imgs)
+        test_postprocessed = self.postprocess_predictions(test_imgs, test_predictions)
+        print("Test set decoding, inference and postprocessing: %.3f s" % (time.time() - start))
+
+        submission_masks = []
+        for i in range(1, config.test_size + 1):
+            print("Test img: " + str(i))
+            img = test_imgs[i - 1]
+            (img_prediction, prediction) = self.prediction_images(img, test_predictions[i - 1], test_postprocessed[i - 1])
+
+            # Visualization
+            pimg = make_img_overlay(img, img_prediction)
+            pimg_postprocessed = make_img_overlay(img, prediction)
+            with timer('image_saving'):
+                pimg.save(prediction_test_dir + "test" + str(i) + ".png")
+                pimg_postprocessed.save(prediction_test_dir + "test" + str(i) + "_postprocessed.png")
+            submission_masks.append(prediction)
+
+        # Construction of the submission file
+        write_submission(submission_filename or config.submission_filename, submission_masks,
+                         range(1, config.test_size + 1), config.img_patch_size)
+        print("Test set total time: %.3f s" % (time.time() - start))
+
+# Structured run report: per-stage latencies, counters and throughput
+def write_run_report(config, **extra):
+    report = instrumentation.default.write_report(config.run_report,
+        config={'img_patch_size': config.img_patch_size, 'img_patch_stride': config.img_patch_stride,
+                'batch_size': config.batch_size, 'inference_batch_size': config.inference_batch_size,
+                'num_transformations': config.num_transformations, 'stream_patches': config.stream_patches,
+                'fcn_inference': config.fcn_inference, 'tta_stride': config.tta_stride,
+                'tta_augmentations': config.tta_augmentations, 'restore_model': config.restore_model},
+        throughput={'train_examples_per_sec': instrumentation.default.rate('train_examples', 'train_step'),
+                    'inference_patches_per_sec': instrumentation.default.rate('patches_predicted', 'inference_batch')},
+        **extra)
+    print('Run report written to %s' % config.run_report)
+    # total includes the nested stages, exclusive does not (see instrumentation.py)
+    print('  %-20s %12s %12s %12s  %s' % ('stage', 'calls', 'total', 'exclusive', 'within'))
+    for (name, stage) in sorted(report['stages'].items()):
+        print('  %-20s %6d calls %10.3f s %10.3f s  %s' % (name, stage['count'], stage['total_s'], stage['exclusive_s'],
+                                                          ', '.join(stage.get('within', []))))
+    return report
 
-            # Build the summary operation based on the TF collection of Summaries.
-            summary_op = tf.merge_all_summaries()
-            summary_writer = tf.train.SummaryWriter(FLAGS.train_dir,
-                                                    graph=s.graph)
-            print ('Initialized!')
-            # Loop through training steps.
-            print ('Total number of iterations = ' + str(int(num_epochs * train_size / BATCH_SIZE)))
-
-            training_indices = range(train_size)
-            start = time.time()
-            run_training = True
-            iepoch = 0
-            while run_training:
-            # for iepoch in range(num_epochs):
-                # Permute training indices
-                perm_indices = np.random.permutation(training_indices)
-
-                for step in range (int(train_size / BATCH_SIZE)):
-
-                    offset = (step * BATCH_SIZE) % (train_size - BATCH_SIZE)
-                    batch_indices = perm_indices[offset:(offset + BATCH_SIZE)]
-
-                    # Compute the offset of the current minibatch in the data.
-                    # Note that we could use better randomization across epochs.
-                    batch_data = train_data[batch_indices, :, :, :]
-                    batch_labels = train_labels[batch_indices]
-                    # This dictionary maps the batch data (as a np array) to the
-                    # node in the graph is should be fed to.
-                    feed_dict = {train_data_node: batch_data,
-                                 train_labels_node: batch_labels}
-
-                    learning_rate = tf.div(1, batch)
-                    if step % RECORDING_STEP == 0:
-
-                        summary_str, _, l, lr, predictions = s.run(
-                            [summary_op, optimizer, loss, learning_rate, train_prediction],
-                            feed_dict=feed_dict)
-                        #summary_str = s.run(summary_op, feed_dict=feed_dict)
-                        summary_writer.add_summary(summary_str, step)
-                        summary_writer.flush()
-
-                        # print_predictions(predictions, batch_labels)
-
-                        print ('Epoch %d / %d' % (iepoch, num_epochs))
-                        print ('Minibatch loss: %.3f, learning rate: %.6f' % (l, lr))
-                        print ('Minibatch error: %.1f%%' % error_rate(predictions, batch_labels))
-                        end = time.time()
-                        print("Time elapsed: %.3f" %(end - start))
-                        sys.stdout.flush()
-                    else:
-                        # Run the graph and fetch some of the nodes.
-                        _, l, lr, predictions = s.run(
-                            [optimizer, loss, learning_rate, train_prediction],
-                            feed_dict=feed_dict)
+def main(argv=None):  # pylint: disable=unused-argument
+    config = Config()
+    trainer = Trainer(config)
+    resume = None
+    if not config.restore_model and config.resume_training:
+        resume = trainer.checkpoints.latest()
+        if resume is not None:
+            # Same seeds, so the same data order and validation set as the interrupted run
+            config.np_seed = resume['np_seed']
+    np.random.seed(config.np_seed)
+    if not config.restore_model or config.validate:
+        trainer.load_data()
+    if config.restore_model:
+        trainer.restore()
+    else:
+        trainer.train(resume=resume)
+    trainer.finalize()
 
-                # Save the variables to disk.
-                save_path = saver.save(s, FLAGS.train_dir + "/model.ckpt")
-                print("Model saved in file: %s" % save_path)
-                iepoch += 1
-                if (TERMINATE_AFTER_TIME and time.time() - start > MAX_TRAINING_TIME_IN_SEC):
-                    run_training = False;
-                if (not TERMINATE_AFTER_TIME and iepoch >= NUM_EPOCHS):
-                    run_training = False;
-
-
-
-        if VISUALIZE_PREDICTION_ON_TRAINING_SET:
-            print ("Visualizing prediction on training set")
-            prediction_training_dir = "predictions_training/"
-            if not os.path.isdir(prediction_training_dir):
-                os.mkdir(prediction_training_dir)
-            limit = TRAINING_SIZE + 1 if VISUALIZE_NUM == -1 else VISUALIZE_NUM
-            for i in range(1, limit):
-                print ("Image: " + str(i))
-                # pimg = get_prediction_with_groundtruth(train_data_filename, i)
-                # Image.fromarray(pimg).save(prediction_training_dir + "prediction_" + str(i) + ".png")
-                (oimg, oimg_postprocessed) = get_prediction_with_overlay(train_data_filename, train_labels_filename, i)
-                oimg.save(prediction_training_dir + "overlay_" + str(i) + ".png")
-                oimg_postprocessed.save(prediction_training_dir + "overlay_" + str(i) + "_postprocessed.png")
-        
-        if VALIDATE:
-            err = validate(validation_data, validation_labels)
-            print('Validation error: %.1f%%' % err)
-
-        if RUN_ON_TEST_SET:
-            print ("Running prediction on test set")
-            prediction_test_dir = "predictions_test/"
-            if not os.path.isdir(prediction_test_dir):
-                os.mkdir(prediction_test_dir)
-
-            with open('submission.csv', 'w') as csvfile:
-                writer = csv.writer(csvfile, delimiter=',')
-                writer.writerow(['id','prediction'])
-                for i in range(1, TEST_SIZE + 1):
-                    print("Test img: " + str(i))
-                    # Visualization
-                    (pimg, pimg_postprocessed) = get_prediction_test(i, True)
-                    pimg.save(prediction_test_dir + "test" + str(i) + ".png")
-                    pimg_postprocessed.save(prediction_test_dir + "test" + str(i) + "_postprocessed.png")
-
-                    # Construction of the submission file
-                    (_,prediction) = get_prediction_test(i);
-                    prediction = prediction.astype(np.int)
-                    num_rows = prediction.shape[0]
-                    num_cols = prediction.shape[1]
-                    rows_out = np.empty((0,2))
-                    for x in range(0, num_rows, IMG_PATCH_SIZE):
-                        for y in range(0, num_cols, IMG_PATCH_SIZE):
-                            id = str(i).zfill(3) + "_" + str(x) + "_" + str(y)
-                            next_row = np.array([[id, str(prediction[y,x])]])
-                            rows_out = np.concatenate((rows_out, next_row))
-                    writer.writerows(rows_out)
-            csvfile.close()
+    predictor = trainer.predictor()
+    if config.visualize_prediction_on_training_set:
+        predictor.visualize_training_set()
+
+    if config.validate:
+        confusion = trainer.validate()
+        print('Validation error: %.1f%%' % confusion.error_rate())
+        print(confusion.summary())
+
+    if config.run_on_test_set:
+        predictor.submit()
+
+    write_run_report(config)
+    trainer.close()
 
 if __name__ == '__main__':
     tf.app.run()
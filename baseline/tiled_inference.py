@@ -0,0 +1,209 @@
+"""
+Tiled inference for aerial rasters of any size.
+The raster is read in windowed blocks of TILE_SIZE pixels, plus TILE_MARGIN
+pixels of context on every side, so the memory used does not depend on the
+size of the raster. Every tile goes through the Predictor (patchwise, fcn or
+test-time augmentation, as configured, bypassing the prediction cache since no
+tile is seen twice) and the postprocessing filters; the patch labels of the
+tile without its margins are written into the label grid on disk. Rasters whose size is not a multiple of the patch size are padded by
+repeating their last pixels, so the partial patches at the border also get a
+label. Postprocessing filters only see one tile and its margins.
+
+Outputs, in the output directory:
+    labels.npy      patch labels [patch row, patch column], uint8
+    mask.npy        pixel mask [row, column], uint8 0 or 255
+    submission.csv  submission rows, column by column as mask_to_submission.py
+The .npy files are written through memory maps, the mask and the submission
+rows block by block.
+
+.npy rasters are memory-mapped. Other formats are read with windowed reads
+through rasterio when it is installed (GeoTIFF, JPEG2000, ...). Only these two
+keep the memory bounded: without rasterio, PIL decodes the whole image on first
+access, and rasters of more than PIL_MAX_PIXELS pixels are refused (convert
+them to .npy or install rasterio).
+
+Usage: python tiled_inference.py raster [--output-dir tiled/] [--image-id 1]
+                                 [--tile-size 2048] [--margin 64] [--train_dir=tmp/]
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+try:
+    import rasterio
+    from rasterio.windows import Window
+except ImportError:
+    rasterio = None
+
+from instrumentation import timed, count
+from mask_to_submission import labels_to_submission_text
+from patch_extraction import pad_to_patches
+from postprocessing import postprocess_masks
+
+TILE_SIZE = 2048 # Pixels per tile side, rounded down to whole patches
+TILE_MARGIN = 64 # Context read around every tile, in pixels (rounded up to whole patches)
+PIL_MAX_PIXELS = 100000000 # Largest raster decoded whole through PIL, about 300 MB of RGB
+OUTPUT_DIR = 'tiled/'
+LABELS_FILENAME = 'labels.npy'
+MASK_FILENAME = 'mask.npy'
+SUBMISSION_FILENAME = 'submission.csv'
+
+# RGB floats in [0, 1], as matplotlib reads PNG files
+def to_float(block):
+    block = np.asarray(block)
+    if block.ndim == 2:
+        block = np.repeat(block[:, :, np.newaxis], 3, axis=2)
+    block = block[:, :, :3]
+    if np.issubdtype(block.dtype, np.integer):
+        return block.astype(np.float32) / np.iinfo(block.dtype).max
+    return block.astype(np.float32)
+
+class NpyRaster(object):
+    """Memory-mapped [row, column, channel] array saved with np.save."""
+
+    def __init__(self, filename):
+        self.array = np.load(filename, mmap_mode='r')
+        self.shape = self.array.shape[:2]
+
+    def read(self, row, col, rows, cols):
+        return to_float(self.array[row:row + rows, col:col + cols])
+
+class RasterioRaster(object):
+    """Windowed reads of the first three bands (or the only one) of a raster."""
+
+    def __init__(self, filename):
+        self.dataset = rasterio.open(filename)
+        self.shape = (self.dataset.height, self.dataset.width)
+        self.bands = [1, 2, 3] if self.dataset.count >= 3 else [1]
+
+    def read(self, row, col, rows, cols):
+        block = self.dataset.read(self.bands, window=Window(col, row, cols, rows))
+        return to_float(block.transpose(1, 2, 0))
+
+class PilRaster(object):
+    """The whole image, decoded on the first read."""
+
+    def __init__(self, filename, max_pixels=PIL_MAX_PIXELS):
+        # Large orthophotos are not decompression bombs, the size is checked below.
+        # The limit is only raised while opening, the rest of the process keeps
+        # Pillow's guard.
+        default_max_pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = max(default_max_pixels or 0, max_pixels)
+        try:
+            self.image = Image.open(filename)
+        finally:
+            Image.MAX_IMAGE_PIXELS = default_max_pixels
+        self.shape = (self.image.size[1], self.image.size[0])
+        if self.shape[0] * self.shape[1] > max_pixels:
+            raise ValueError('%s has %d x %d pixels, more than PIL decodes in bounded memory (%d); '
+                             'convert it to .npy or install rasterio' % (filename, self.shape[1], self.shape[0], max_pixels))
+
+    def read(self, row, col, rows, cols):
+        return to_float(self.image.crop((col, row, col + cols, row + rows)).convert('RGB'))
+
+def open_raster(filename):
+    if filename.endswith('.npy'):
+        return NpyRaster(filename)
+    if rasterio is not None:
+        return RasterioRaster(filename)
+    return PilRaster(filename)
+
+def tile_ranges(num_cells, tile_cells, margin_cells):
+    """(begin, end, padded begin, padded end) patch ranges of the tiles along an axis."""
+    return [(begin, min(begin + tile_cells, num_cells),
+             max(0, begin - margin_cells), min(begin + tile_cells + margin_cells, num_cells))
+            for begin in range(0, num_cells, tile_cells)]
+
+@timed('tile_reading')
+def read_block(raster, rows, cols, patch_size):
+    """Pixels of the patch rows and columns ranges, padded to whole patches."""
+    (height, width) = raster.shape
+    (row, col) = (rows[0] * patch_size, cols[0] * patch_size)
+    return pad_to_patches(raster.read(row, col, min(height, rows[1] * patch_size) - row,
+                                      min(width, cols[1] * patch_size) - col), patch_size)
+
+def predict_labels(predictor, raster, filename, tile_size=TILE_SIZE, margin=TILE_MARGIN):
+    """Writes the patch labels of the whole raster to a .npy file, tile by tile.
+    Returns the label grid, memory-mapped.
+    """
+    config = predictor.config
+    patch_size = config.img_patch_size
+    (height, width) = raster.shape
+    grid_shape = (-(-height // patch_size), -(-width // patch_size))
+    labels = np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8, shape=grid_shape)
+    tile_cells = max(1, tile_size // patch_size)
+    margin_cells = -(-margin // patch_size)
+    for cols in tile_ranges(grid_shape[1], tile_cells, margin_cells):
+        for rows in tile_ranges(grid_shape[0], tile_cells, margin_cells):
+            block = read_block(raster, rows[2:], cols[2:], patch_size)
+            prediction = predictor.compute_predictions([block])[0]
+            # Patches go down the rows first, then along the columns
+            grid = (~(prediction[:, 0] > 0.5)).reshape(cols[3] - cols[2], rows[3] - rows[2]).T.astype(np.uint8)
+            if config.postprocessing:
+                grid = postprocess_masks(grid[np.newaxis], config.postprocessing)[0]
+            labels[rows[0]:rows[1], cols[0]:cols[1]] = grid[rows[0] - rows[2]:rows[1] - rows[2],
+                                                            cols[0] - cols[2]:cols[1] - cols[2]]
+            count('tiles_predicted')
+    labels.flush()
+    return labels
+
+@timed('mask_writing')
+def write_mask(labels, filename, shape, patch_size, block_rows):
+    """Pixel mask of the patch labels, block_rows patch rows at a time."""
+    mask = np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8, shape=shape)
+    for begin in range(0, labels.shape[0], block_rows):
+        block = np.repeat(np.repeat(labels[begin:begin + block_rows], patch_size, axis=0), patch_size, axis=1)
+        row = begin * patch_size
+        rows = min(shape[0], row + block.shape[0]) - row
+        mask[row:row + rows] = block[:rows, :shape[1]] * 255
+    mask.flush()
+
+@timed('submission_writing')
+def write_submission_rows(labels, filename, image_id, patch_size, block_cols):
+    """Submission rows of the patch labels, block_cols patch columns at a time."""
+    with open(filename, 'w') as f:
+        f.write('id,prediction\n')
+        for begin in range(0, labels.shape[1], block_cols):
+            text = labels_to_submission_text(labels[:, begin:begin + block_cols], image_id, patch_size, 0, begin)
+            f.write(text)
+            count('submission_bytes', len(text))
+
+def predict_raster(predictor, raster, output_dir=OUTPUT_DIR, image_id=1, tile_size=TILE_SIZE, margin=TILE_MARGIN):
+    """Label grid, pixel mask and submission rows of a raster, written to output_dir."""
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    patch_size = predictor.config.img_patch_size
+    labels = predict_labels(predictor, raster, os.path.join(output_dir, LABELS_FILENAME), tile_size, margin)
+    block = max(1, tile_size // patch_size)
+    write_mask(labels, os.path.join(output_dir, MASK_FILENAME), raster.shape, patch_size, block)
+    write_submission_rows(labels, os.path.join(output_dir, SUBMISSION_FILENAME), image_id, patch_size, block)
+    return labels
+
+def main(argv):
+    import tf_aerial_images
+    parser = argparse.ArgumentParser(description='Tiled inference on a large raster.')
+    parser.add_argument('raster')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR)
+    parser.add_argument('--image-id', type=int, default=1, help='image number of the submission rows')
+    parser.add_argument('--tile-size', type=int, default=TILE_SIZE)
+    parser.add_argument('--margin', type=int, default=TILE_MARGIN)
+    args = parser.parse_args(argv[1:])
+
+    config = tf_aerial_images.Config()
+    predictor = tf_aerial_images.Predictor.from_checkpoint(config)
+    raster = open_raster(args.raster)
+    print('Raster %s: %d x %d pixels' % (args.raster, raster.shape[1], raster.shape[0]))
+    start = time.time()
+    labels = predict_raster(predictor, raster, args.output_dir, args.image_id, args.tile_size, args.margin)
+    print('%d x %d patches labelled in %.3f s, %.1f%% road' % (labels.shape[1], labels.shape[0],
+                                                               time.time() - start, 100.0 * labels.mean()))
+    print('Outputs written to %s' % args.output_dir)
+    tf_aerial_images.write_run_report(config)
+    predictor.close()
+
+if __name__ == '__main__':
+    tf.app.run()